@@ -0,0 +1,109 @@
+import asyncio
+from collections import Counter, namedtuple
+from typing import Dict, Tuple
+
+import spotify
+from spotify.errors import HTTPException, NotFound
+from spotify.http import HTTPClient, Route
+
+from src.fake_spotify import FakeSpotify
+
+"""
+In-process fakes for benchmarking the app without a network: a Spotify client answering from a graph (the same
+objects src/fake_spotify.py serves, minus the HTTP), and a Redis wrapper counting round trips.
+"""
+
+# the parts of an aiohttp response spotify.errors reads
+FakeResponse = namedtuple('FakeResponse', ['status', 'reason'])
+
+
+class InMemoryHTTPClient(HTTPClient):
+	# no session: requests are answered from the fake's graph
+	def __init__(self, fake: FakeSpotify, latency: float=0):
+		self.fake = fake
+		# seconds added to every request
+		self.latency = latency
+		self.client_id = 'benchmark'
+		self.client_secret = 'benchmark'
+		self.bearer_info = None
+		# requests made, by endpoint
+		self.requests = Counter()
+
+	async def close(self):
+		pass
+
+	def respond(self, route: Route, params: Dict) -> Tuple[str, int, Dict]:
+		parts = route.url[len(Route.BASE):].strip('/').split('/')
+		if parts == ['artists']:
+			ids = [i for i in str(params.get('ids', '')).split(',') if i]
+			return 'artists', 200, {'artists': [self.fake.artist_object(i) for i in ids]}
+		if parts[0] == 'artists' and len(parts) == 2:
+			artist = self.fake.artist_object(parts[1])
+			if artist is None:
+				return 'artist', 404, {'error': {'status': 404, 'message': 'non existing id'}}
+			return 'artist', 200, artist
+		if parts[0] == 'artists' and parts[2:] == ['related-artists']:
+			if self.fake.artist_object(parts[1]) is None:
+				return 'related-artists', 404, {'error': {'status': 404, 'message': 'non existing id'}}
+			return 'related-artists', 200, {'artists': [self.fake.artist_object(i) for i in self.fake.related.get(parts[1], [])]}
+		if parts == ['search']:
+			query = str(params.get('q', '')).lower()
+			limit = int(params.get('limit', 20))
+			offset = int(params.get('offset', 0))
+			matches = [self.fake.artist_object(i) for i, info in self.fake.artists.items() if query in info.get('name', i).lower()]
+			matches.sort(key=lambda a: -a['followers']['total'])
+			return 'search', 200, {'artists': {'items': matches[offset:offset + limit], 'total': len(matches), 'limit': limit, 'offset': offset}}
+		return 'unknown', 404, {'error': {'status': 404, 'message': 'no such endpoint'}}
+
+	async def request(self, route, **kwargs):
+		endpoint, status, data = self.respond(route, kwargs.get('params') or {})
+		self.requests[endpoint] += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		if status == 404:
+			raise NotFound(FakeResponse(status, 'Not Found'), data)
+		if status != 200:
+			raise HTTPException(FakeResponse(status, 'Error'), data)
+		return data
+
+
+class InMemorySpotifyClient(spotify.Client):
+	def __init__(self, fake: FakeSpotify, latency: float=0):
+		self.loop = asyncio.get_event_loop()
+		self.http = InMemoryHTTPClient(fake, latency)
+
+	def calls(self) -> int:
+		return sum(self.http.requests.values())
+
+
+# an aioredis connection that counts round trips: one per command, or per pipeline/transaction executed
+class CountingRedis:
+	def __init__(self, redis):
+		self.redis = redis
+		self.round_trips = 0
+
+	def __getattr__(self, name):
+		attr = getattr(self.redis, name)
+		if name in ('pipeline', 'multi_exec'):
+			return lambda *args, **kwargs: CountingPipeline(self, attr(*args, **kwargs))
+		# iscan is only used when loading at startup, and closing isn't a command
+		if not callable(attr) or name in ('iscan', 'close', 'wait_closed'):
+			return attr
+
+		def command(*args, **kwargs):
+			self.round_trips += 1
+			return attr(*args, **kwargs)
+		return command
+
+
+class CountingPipeline:
+	def __init__(self, counter: CountingRedis, pipeline):
+		self.counter = counter
+		self.pipeline = pipeline
+
+	def __getattr__(self, name):
+		return getattr(self.pipeline, name)
+
+	async def execute(self, *args, **kwargs):
+		self.counter.round_trips += 1
+		return await self.pipeline.execute(*args, **kwargs)
@@ -0,0 +1,89 @@
+import argparse
+import itertools
+import json
+import random
+from typing import Dict, List
+
+"""
+Seeded synthetic related artists graphs, in the graph file format src/fake_spotify.py serves.
+
+The main component is made of communities (think genres) that are hub heavy like Spotify's: artist popularity
+follows a power law and related artists are mostly drawn from the artist's own community in proportion to it, so
+each community's stars appear in most of its lists, while a few related artists anywhere link the communities. Small islands of artists only
+related to each other give pairs with no connection.
+
+python -m benchmarks.graph graph.json --artists 20000 --seed 1
+"""
+
+ID_ALPHABET: str = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+ID_LENGTH: int = 22
+
+
+def artist_id(rnd: random.Random) -> str:
+	return ''.join(rnd.choice(ID_ALPHABET) for _ in range(ID_LENGTH))
+
+
+def artist_info(n: int, followers: int) -> Dict:
+	return {
+		'name': 'Artist {}'.format(n),
+		'followers': followers,
+		'popularity': min(100, followers // 1000),
+		'genres': [],
+	}
+
+
+# {"artists": {...}, "related": {...}} for `artists` connected artists with up to `related` related artists each,
+# plus `islands` groups of `island_size` artists
+def generate(artists: int=20000, related: int=20, islands: int=20, island_size: int=8, community_size: int=200, outside_fraction: float=0.1, exponent: float=1.5, seed: int=0) -> Dict:
+	rnd = random.Random(seed)
+	graph: Dict = {'artists': {}, 'related': {}, 'islands': []}
+
+	ids: List[str] = [artist_id(rnd) for _ in range(artists)]
+	followers = [int(1000 * rnd.paretovariate(exponent)) for _ in ids]
+	for n, (i, f) in enumerate(zip(ids, followers)):
+		graph['artists'][i] = artist_info(n, f)
+	# artists are related mostly within their community (think genre), drawn by popularity
+	communities = [range(start, min(start + community_size, artists)) for start in range(0, artists, community_size)]
+	for community in communities:
+		members = [ids[n] for n in community]
+		cumulative = list(itertools.accumulate(followers[n] for n in community))
+		for n in community:
+			outside = sum(rnd.random() < outside_fraction for _ in range(related))
+			# a few extra draws make up for duplicates and the artist itself
+			picks = rnd.choices(members, cum_weights=cumulative, k=related - outside + related // 2)
+			picks = rnd.choices(ids, k=outside) + picks
+			graph['related'][ids[n]] = list(dict.fromkeys(j for j in picks if j != ids[n]))[:related]
+
+	n = artists
+	for _ in range(islands):
+		island = [artist_id(rnd) for _ in range(island_size)]
+		for i in island:
+			graph['artists'][i] = artist_info(n, int(1000 * rnd.paretovariate(exponent)))
+			n += 1
+		for i in island:
+			others = [j for j in island if j != i]
+			graph['related'][i] = rnd.sample(others, min(related, len(others)))
+		graph['islands'].append(island)
+	return graph
+
+
+# the artists of the main component, i.e. every artist not on an island
+def connected_artists(graph: Dict) -> List[str]:
+	island_artists = set(i for island in graph.get('islands', []) for i in island)
+	return [i for i in graph['related'] if i not in island_artists]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Write a synthetic related artists graph for src/fake_spotify.py")
+	parser.add_argument('path', help="JSON graph file to write")
+	parser.add_argument('--artists', type=int, default=20000, help="artists in the main component")
+	parser.add_argument('--related', type=int, default=20, help="related artists per artist")
+	parser.add_argument('--islands', type=int, default=20, help="disconnected groups of artists")
+	parser.add_argument('--island-size', type=int, default=8, help="artists per island")
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	graph = generate(args.artists, args.related, args.islands, args.island_size, seed=args.seed)
+	with open(args.path, 'w') as f:
+		json.dump(graph, f)
+	print("Wrote {} artists to {}".format(len(graph['related']), args.path))
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+from collections import Counter, defaultdict
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+import src.fake_spotify as fake_spotify
+from benchmarks.graph import connected_artists, generate
+from benchmarks.report import percentile
+
+"""
+End-to-end load test: boots the app (src.wsgi:app) under hypercorn, the way the Procfile runs it, against a local
+fake Spotify server and a local Redis, then drives a mix of /api/connect, /api/search, /api/artist and /api/stats
+traffic at a target request rate and reports latency percentiles, throughput and error rates per route.
+
+Requests are sent on a fixed schedule whatever the responses (open loop), and latency is measured from when each
+request was due, so a server falling behind (e.g. an event loop blocked by CPU-bound work) shows up as growing
+latency instead of a lower request rate.
+
+The fake Spotify server runs in this process and serves a synthetic graph (see benchmarks/graph.py) or --graph,
+plus responses recorded from the real API (--recorded), with optional latency and 429s. Redis is a redis-server
+started on a free port for the run (--redis-server), or the one in REDISCLOUD_URL / on localhost.
+
+python -m benchmarks.loadtest --rps 50 --duration 30 --workers 2 --spotify-latency 0.05 --throttle-rate 0.01
+"""
+
+ROUTES: Tuple[str, ...] = ('connect', 'search', 'artist', 'stats')
+
+
+def free_port() -> int:
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+# route -> weight, from e.g. "connect=4,search=3,artist=2,stats=1"
+def parse_mix(mix: str) -> Dict[str, float]:
+	weights: Dict[str, float] = {}
+	for part in mix.split(','):
+		route, _, weight = part.partition('=')
+		if route not in ROUTES:
+			raise argparse.ArgumentTypeError("unknown route {}".format(route))
+		weights[route] = float(weight or 1)
+	return weights
+
+
+class Traffic:
+	def __init__(self, graph: Dict, seed: int=0, popular_pairs: int=200):
+		self.rnd = random.Random(seed)
+		self.artists = connected_artists(graph) or list(graph.get('related', {}))
+		self.names = [graph['artists'][i]['name'] for i in self.artists if i in graph.get('artists', {})]
+		# a few connections are searched over and over, like the popular ones on the site
+		self.pairs = [tuple(self.rnd.sample(self.artists, 2)) for _ in range(popular_pairs)]
+
+	def path(self, route: str) -> str:
+		if route == 'connect':
+			if self.rnd.random() < 0.5:
+				# weighted towards the first pairs
+				a, b = self.pairs[min(int(self.rnd.paretovariate(1)) - 1, len(self.pairs) - 1)]
+			else:
+				a, b = self.rnd.sample(self.artists, 2)
+			return '/api/connect/{}/{}'.format(a, b)
+		if route == 'search':
+			# a typed prefix of a name
+			name = self.rnd.choice(self.names) if self.names else 'a'
+			return '/api/search/{}'.format(name[:self.rnd.randint(1, len(name))])
+		if route == 'artist':
+			return '/api/artist/{}'.format(self.rnd.choice(self.artists))
+		return '/api/stats'
+
+
+class Servers:
+	def __init__(self, args):
+		self.args = args
+		self.fake: Optional[fake_spotify.FakeSpotify] = None
+		self.fake_runner = None
+		self.redis_process: Optional[subprocess.Popen] = None
+		self.app_process: Optional[subprocess.Popen] = None
+		self.app_url = ""
+
+	async def start(self, graph: Dict):
+		args = self.args
+		self.fake = fake_spotify.FakeSpotify(graph, latency=args.spotify_latency, throttle_rate=args.throttle_rate, max_concurrency=args.max_concurrency, retry_after=args.retry_after, seed=args.seed)
+		if args.recorded:
+			self.fake.recorded = fake_spotify.load_recording(args.recorded)
+		fake_port = free_port()
+		self.fake_runner = await fake_spotify.start(self.fake, '127.0.0.1', fake_port)
+
+		env = dict(os.environ)
+		env.update({
+			'SIX_DEGREES_CLIENT_ID': 'loadtest',
+			'SIX_DEGREES_CLIENT_SECRET': 'loadtest',
+			'SIX_DEGREES_SPOTIFY_API_URL': 'http://127.0.0.1:{}/v1'.format(fake_port),
+			'SIX_DEGREES_SPOTIFY_TOKEN_URL': 'http://127.0.0.1:{}/api/token'.format(fake_port),
+		})
+		env.pop('SIX_DEGREES_SPOTIFY_RECORD_PATH', None)
+		if args.redis_server:
+			redis_port = free_port()
+			self.redis_process = subprocess.Popen([args.redis_server, '--port', str(redis_port), '--save', '', '--appendonly', 'no'], stdout=subprocess.DEVNULL)
+			env['REDISCLOUD_URL'] = 'redis://127.0.0.1:{}'.format(redis_port)
+
+		app_port = free_port()
+		self.app_url = 'http://127.0.0.1:{}'.format(app_port)
+		command = [sys.executable, '-m', 'hypercorn', '-b', '127.0.0.1:{}'.format(app_port), '-w', str(args.workers), 'src.wsgi:app']
+		self.app_process = subprocess.Popen(command, env=env, stdout=None if args.verbose else subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+		await self.wait_for_app()
+
+	async def wait_for_app(self, timeout: float=30):
+		deadline = monotonic() + timeout
+		async with aiohttp.ClientSession() as session:
+			while monotonic() < deadline:
+				if self.app_process.poll() is not None:
+					raise RuntimeError("hypercorn exited with status {}".format(self.app_process.returncode))
+				try:
+					async with session.get(self.app_url + '/api/stats') as response:
+						await response.read()
+						return
+				except aiohttp.ClientError:
+					await asyncio.sleep(0.2)
+		raise RuntimeError("app didn't start within {} seconds".format(timeout))
+
+	async def stop(self):
+		for process in (self.app_process, self.redis_process):
+			if process is not None and process.poll() is None:
+				process.send_signal(signal.SIGINT)
+				try:
+					process.wait(10)
+				except subprocess.TimeoutExpired:
+					process.kill()
+		if self.fake_runner is not None:
+			await self.fake_runner.cleanup()
+
+
+# send requests at `rps` for `duration` seconds; returns (route, status or None on a client error, latency) each
+async def drive(app_url: str, traffic: Traffic, mix: Dict[str, float], rps: float, duration: float, timeout: float) -> List[Tuple[str, Optional[int], float]]:
+	routes = list(mix)
+	weights = [mix[r] for r in routes]
+	samples: List[Tuple[str, Optional[int], float]] = []
+	connector = aiohttp.TCPConnector(limit=0)
+	async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+		async def send(route: str, path: str, due: float):
+			status = None
+			try:
+				async with session.get(app_url + path) as response:
+					await response.read()
+					status = response.status
+			except (aiohttp.ClientError, asyncio.TimeoutError):
+				pass
+			samples.append((route, status, monotonic() - due))
+
+		start = monotonic()
+		tasks = []
+		for i in range(int(rps * duration)):
+			due = start + i / rps
+			delay = due - monotonic()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			route = traffic.rnd.choices(routes, weights)[0]
+			tasks.append(asyncio.ensure_future(send(route, traffic.path(route), due)))
+		await asyncio.gather(*tasks)
+	return samples
+
+
+def report(samples: List[Tuple[str, Optional[int], float]], duration: float) -> Dict[str, Dict]:
+	by_route: Dict[str, List[Tuple[Optional[int], float]]] = defaultdict(list)
+	for route, status, latency in samples:
+		by_route[route].append((status, latency))
+		by_route['all'].append((status, latency))
+	res: Dict[str, Dict] = {}
+	for route, route_samples in sorted(by_route.items()):
+		latencies = [latency * 1000 for _, latency in route_samples]
+		# 404s are answers (e.g. unknown artists); failures are 5xx and requests that got no response
+		errors = sum(1 for status, _ in route_samples if status is None or status >= 500)
+		res[route] = {
+			'requests': len(route_samples),
+			'throughput_rps': round(len(route_samples) / duration, 2),
+			'error_rate': round(errors / len(route_samples), 4),
+			'latency_ms_p50': round(percentile(latencies, 50), 2),
+			'latency_ms_p95': round(percentile(latencies, 95), 2),
+			'latency_ms_p99': round(percentile(latencies, 99), 2),
+			'statuses': dict(Counter(str(status) for status, _ in route_samples)),
+		}
+	return res
+
+
+async def main(args) -> Dict:
+	graph = fake_spotify.load_graph(args.graph) if args.graph else generate(args.artists, seed=args.seed)
+	servers = Servers(args)
+	try:
+		await servers.start(graph)
+		traffic = Traffic(graph, args.seed)
+		if args.warmup:
+			await drive(servers.app_url, traffic, args.mix, args.rps, args.warmup, args.timeout)
+		start = monotonic()
+		samples = await drive(servers.app_url, traffic, args.mix, args.rps, args.duration, args.timeout)
+		elapsed = monotonic() - start
+	finally:
+		await servers.stop()
+	return {
+		'config': {'rps': args.rps, 'duration': args.duration, 'workers': args.workers, 'mix': args.mix, 'spotify_latency': args.spotify_latency, 'throttle_rate': args.throttle_rate},
+		'routes': report(samples, elapsed),
+		'spotify_requests': dict(servers.fake.requests),
+	}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Load test the app under hypercorn against a fake Spotify server and Redis")
+	parser.add_argument('--rps', type=float, default=20, help="requests per second to send")
+	parser.add_argument('--duration', type=float, default=30, help="seconds to send requests for")
+	parser.add_argument('--warmup', type=float, default=0, help="seconds of traffic before measuring")
+	parser.add_argument('--mix', type=parse_mix, default=parse_mix('connect=4,search=3,artist=2,stats=1'), help="route weights, e.g. connect=4,search=3,artist=2,stats=1")
+	parser.add_argument('--timeout', type=float, default=30, help="seconds before a request counts as failed")
+	parser.add_argument('--workers', type=int, default=1, help="hypercorn worker processes")
+	parser.add_argument('--graph', default="", help="graph file to serve (default: a synthetic graph)")
+	parser.add_argument('--artists', type=int, default=20000, help="artists in the synthetic graph")
+	parser.add_argument('--recorded', default="", help="recorded Spotify responses to replay")
+	parser.add_argument('--spotify-latency', type=float, default=0.05, help="seconds added to every Spotify response")
+	parser.add_argument('--throttle-rate', type=float, default=0, help="fraction of Spotify requests answered with 429")
+	parser.add_argument('--max-concurrency', type=int, default=0, help="Spotify answers 429 beyond this many requests in flight")
+	parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with a 429")
+	parser.add_argument('--redis-server', nargs='?', const=shutil.which('redis-server') or 'redis-server', default="", help="start this redis-server for the run (default: use REDISCLOUD_URL or localhost)")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--output', default="", help="JSON file to write the report to")
+	parser.add_argument('--verbose', action='store_true', help="show the app's output")
+	args = parser.parse_args()
+
+	loop = asyncio.get_event_loop()
+	results = loop.run_until_complete(main(args))
+	for route, metrics in results['routes'].items():
+		print("{:<8} {}".format(route, "  ".join("{}={}".format(k, v) for k, v in metrics.items())))
+	print("spotify  {}".format(results['spotify_requests']))
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent='\t')
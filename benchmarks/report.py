@@ -0,0 +1,12 @@
+from typing import List
+
+
+def percentile(values: List[float], p: float) -> float:
+	values = sorted(values)
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def mean(values: List[float]) -> float:
+	return sum(values) / len(values) if values else 0.0
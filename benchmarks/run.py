@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import Counter
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+# before the app reads its settings: only the fakes are used, and stats are only rebuilt when measured
+os.environ['SIX_DEGREES_STATS_REFRESH_INTERVAL'] = '86400'
+os.environ['SIX_DEGREES_STATS_REFRESH_AFTER_CONNECTIONS'] = '1000000000'
+for name in ('SIX_DEGREES_CLIENT_ID', 'SIX_DEGREES_CLIENT_SECRET', 'SIX_DEGREES_SNAPSHOT_PATH'):
+	os.environ.pop(name, None)
+
+try:
+	import fakeredis.aioredis
+except ImportError:
+	fakeredis = None
+
+import src.api as api
+import src.cache as cache
+import src.clients as clients
+import src.metadata as metadata
+import src.responses as responses
+import src.snapshot as snapshot
+import src.typeahead as typeahead
+from src.fake_spotify import FakeSpotify
+
+from benchmarks import fakes
+from benchmarks.graph import connected_artists, generate
+from benchmarks.report import mean, percentile
+
+"""
+Offline benchmarks of the search and cache paths, run against the real app (routes, search engine, cache code) with
+a synthetic graph served by an in-process fake Spotify client and fakeredis (pip install -r benchmarks/requirements.txt).
+
+Scenarios:
+cold 		-> /api/connect for random pairs (and some with no connection) with nothing cached
+warm 		-> the same pairs again, answered from the cache
+snapshot 	-> the same pairs with nothing cached but a graph snapshot loaded
+stats_<N> 	-> rebuilding the /api/stats document, and serving it, after N connections have been recorded
+
+Per query they record latency, artists expanded by the search, Spotify requests and Redis round trips (a pipeline or
+transaction is one). Counts depend only on the seeded graph and the code, so they can be compared anywhere;
+latencies should be compared against a baseline recorded on the same machine.
+
+python -m benchmarks.run 						-> print results
+python -m benchmarks.run --save-baseline 		-> also store them as benchmarks/baseline.json
+python -m benchmarks.run --check 				-> exit 1 if any metric regressed from the baseline
+"""
+
+BASELINE_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def summarize(samples: List[Dict]) -> Dict:
+	latencies = [s['latency_ms'] for s in samples]
+	return {
+		'queries': len(samples),
+		'latency_ms_p50': round(percentile(latencies, 50), 3),
+		'latency_ms_p95': round(percentile(latencies, 95), 3),
+		'expanded_mean': round(mean([s['expanded'] for s in samples]), 2),
+		'spotify_calls_mean': round(mean([s['spotify_calls'] for s in samples]), 2),
+		'redis_round_trips_mean': round(mean([s['redis_round_trips'] for s in samples]), 2),
+		'statuses': dict(Counter(s['status'] for s in samples)),
+	}
+
+
+class Bench:
+	def __init__(self, graph: Dict, spotify_latency: float=0):
+		self.graph = graph
+		self.spotify = fakes.InMemorySpotifyClient(FakeSpotify(graph), spotify_latency)
+		self.redis = None
+		self.app = None
+		self.client = None
+
+	async def start(self):
+		# installed before startup, so the app uses it instead of connecting to a server
+		self.redis = fakes.CountingRedis(await fakeredis.aioredis.create_redis_pool())
+		clients.redis = self.redis
+		self.app = api.create_app()
+		await self.app.startup()
+		await self.app.typeahead_loader
+		self.app.spotify = clients.spotify = self.spotify
+		self.client = self.app.test_client()
+
+	async def stop(self):
+		await self.app.cleanup()
+
+	# forget everything cached, in Redis and in process
+	async def reset(self):
+		await self.redis.redis.flushall()
+		cache.related_artists_tier.clear()
+		metadata.artist_dict_tier.clear()
+		responses.cache.clear()
+		typeahead.result_cache.clear()
+		typeahead.index = typeahead.PrefixIndex()
+
+	async def connect(self, artist1_id: str, artist2_id: str) -> Dict:
+		calls, round_trips = self.spotify.calls(), self.redis.round_trips
+		start = perf_counter()
+		response = await self.client.get('/api/connect/{}/{}'.format(artist1_id, artist2_id))
+		await response.get_data()
+		return {
+			'latency_ms': (perf_counter() - start) * 1000,
+			'expanded': int(response.headers.get('X-Search-Expanded', 0)),
+			'spotify_calls': self.spotify.calls() - calls,
+			'redis_round_trips': self.redis.round_trips - round_trips,
+			'status': response.headers.get('X-Search-Status', str(response.status_code)),
+		}
+
+	async def connect_all(self, pairs: List[Tuple[str, str]]) -> Dict:
+		return summarize([await self.connect(a, b) for a, b in pairs])
+
+	async def with_snapshot(self, pairs: List[Tuple[str, str]]) -> Dict:
+		path = tempfile.mkdtemp(prefix="six-degrees-benchmark-")
+		try:
+			snapshot.write(os.path.join(path, "graph"), self.graph['related'])
+			clients.snapshot = snapshot.load(os.path.join(path, "graph"))
+			return await self.connect_all(pairs)
+		finally:
+			clients.snapshot = None
+			shutil.rmtree(path, ignore_errors=True)
+
+	# record connections (random paths through the graph) until `count` have been recorded
+	async def record_history(self, rnd: random.Random, artists: List[str], count: int):
+		recorded = int(await cache.get_number_connections_searched() or 0)
+		while recorded < count:
+			a, b = rnd.sample(artists, 2)
+			path = [a] + rnd.sample(artists, rnd.randint(0, 4)) + [b]
+			if await cache.new_connection_stats(a, b, path):
+				recorded += 1
+
+	async def stats(self) -> Dict:
+		calls, round_trips = self.spotify.calls(), self.redis.round_trips
+		start = perf_counter()
+		await self.app.stats.refresh()
+		refresh_ms = (perf_counter() - start) * 1000
+		refresh_calls, refresh_round_trips = self.spotify.calls() - calls, self.redis.round_trips - round_trips
+
+		start = perf_counter()
+		response = await self.client.get('/api/stats')
+		await response.get_data()
+		return {
+			'refresh_ms': round(refresh_ms, 3),
+			'refresh_spotify_calls': refresh_calls,
+			'refresh_redis_round_trips': refresh_round_trips,
+			'get_ms': round((perf_counter() - start) * 1000, 3),
+		}
+
+
+async def run(args) -> Dict:
+	graph = generate(args.artists, seed=args.seed)
+	rnd = random.Random(args.seed)
+	artists = connected_artists(graph)
+	pairs = [tuple(rnd.sample(artists, 2)) for _ in range(args.pairs)]
+	pairs += [(rnd.choice(artists), rnd.choice(rnd.choice(graph['islands']))) for _ in range(args.disconnected_pairs)]
+
+	bench = Bench(graph, args.spotify_latency)
+	await bench.start()
+	scenarios: Dict[str, Dict] = {}
+	try:
+		await bench.reset()
+		scenarios['cold'] = await bench.connect_all(pairs)
+		scenarios['warm'] = await bench.connect_all(pairs)
+		await bench.reset()
+		scenarios['snapshot'] = await bench.with_snapshot(pairs)
+
+		await bench.reset()
+		for count in args.history:
+			await bench.record_history(rnd, artists, count)
+			scenarios['stats_{}'.format(count)] = await bench.stats()
+	finally:
+		await bench.stop()
+
+	config = {
+		'artists': args.artists,
+		'pairs': args.pairs,
+		'disconnected_pairs': args.disconnected_pairs,
+		'history': args.history,
+		'seed': args.seed,
+		'spotify_latency': args.spotify_latency,
+	}
+	return {'config': config, 'scenarios': scenarios}
+
+
+def is_latency(metric: str) -> bool:
+	return metric.endswith('_ms') or '_ms_' in metric
+
+
+# (scenario, metric, baseline, result) for every metric worse than the baseline allows
+# latencies may grow by latency_tolerance (a fraction) plus half a millisecond of noise, counts by count_tolerance
+def regressions(baseline: Dict, results: Dict, count_tolerance: float, latency_tolerance: float, check_latency: bool=True) -> List[Tuple[str, str, object, object]]:
+	res = []
+	for scenario, base_metrics in baseline['scenarios'].items():
+		metrics = results['scenarios'].get(scenario)
+		if metrics is None:
+			res.append((scenario, '(missing)', None, None))
+			continue
+		for metric, base in base_metrics.items():
+			value = metrics.get(metric)
+			if metric == 'queries':
+				continue
+			if metric == 'statuses':
+				if value != base:
+					res.append((scenario, metric, base, value))
+				continue
+			if is_latency(metric):
+				if check_latency and value > base * (1 + latency_tolerance) + 0.5:
+					res.append((scenario, metric, base, value))
+			elif value > base * (1 + count_tolerance):
+				res.append((scenario, metric, base, value))
+	return res
+
+
+def print_results(results: Dict):
+	for scenario, metrics in results['scenarios'].items():
+		print("{:<12} {}".format(scenario, "  ".join("{}={}".format(k, v) for k, v in metrics.items())))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmark search and cache paths against a synthetic graph")
+	parser.add_argument('--artists', type=int, default=20000, help="artists in the synthetic graph")
+	parser.add_argument('--pairs', type=int, default=50, help="connected pairs to search")
+	parser.add_argument('--disconnected-pairs', type=int, default=5, help="pairs with no connection to search")
+	parser.add_argument('--history', type=lambda s: [int(i) for i in s.split(',')], default=[100, 1000, 5000], help="connections recorded before each stats measurement, e.g. 100,1000")
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--spotify-latency', type=float, default=0, help="seconds added to every Spotify request")
+	parser.add_argument('--output', default="", help="JSON file to write the results to")
+	parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline JSON file")
+	parser.add_argument('--save-baseline', action='store_true', help="store the results as the baseline")
+	parser.add_argument('--check', action='store_true', help="compare against the baseline, exiting 1 on regressions")
+	parser.add_argument('--count-tolerance', type=float, default=0.1, help="allowed growth of counts, as a fraction")
+	parser.add_argument('--latency-tolerance', type=float, default=0.5, help="allowed growth of latencies, as a fraction")
+	parser.add_argument('--no-latency', action='store_true', help="only check counts (for baselines from other machines)")
+	args = parser.parse_args()
+
+	if fakeredis is None:
+		print("The benchmarks need fakeredis: pip install -r benchmarks/requirements.txt")
+		sys.exit(2)
+
+	loop = asyncio.get_event_loop()
+	results = loop.run_until_complete(run(args))
+	print_results(results)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent='\t')
+	if args.save_baseline:
+		with open(args.baseline, 'w') as f:
+			json.dump(results, f, indent='\t')
+		print("Saved baseline to {}".format(args.baseline))
+	if args.check:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline['config'] != results['config']:
+			print("Baseline was recorded with different options: {}".format(baseline['config']))
+		found = regressions(baseline, results, args.count_tolerance, args.latency_tolerance, not args.no_latency)
+		for scenario, metric, base, value in found:
+			print("REGRESSION {} {}: {} -> {}".format(scenario, metric, base, value))
+		if found:
+			sys.exit(1)
+		print("No regressions against {}".format(args.baseline))
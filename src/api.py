@@ -1,44 +1,83 @@
-from quart import Quart, Response, abort
+from quart import Quart, Response, abort, g, request
 import json
+import math
+from collections import Counter
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple, Union
 from quart_cors import cors
-import urllib.parse as urlparse
 
 
 from src.main import *
 import src.clients as clients
+import src.landmarks as landmarks
+import src.metadata as metadata
+import src.metrics as metrics
+import src.responses as responses
+import src.search as search
+import src.settings as settings
+import src.singleflight as singleflight
+import src.snapshot as snapshot
+import src.stats as stats
+import src.transport as transport
+import src.typeahead as typeahead
 from src.custom_types import *
 
 
-def init_clients():
-	redis_url = None
-	try:
-		redis_url = os.environ['REDISCLOUD_URL']
-	except KeyError as e:
-		pass
+SEARCH_RESULTS_LIMIT: int = 20
 
-	if redis_url:
-		url = urlparse.urlparse(redis_url)
-		clients.redis = redis.Redis(host=url.hostname, port=url.port, password=url.password)
-	else:
-		clients.redis = redis.Redis()
 
-	client_ID = None
-	client_secret = None
-	try:
-		client_ID = os.environ.get("SIX_DEGREES_CLIENT_ID")
-		client_secret = os.environ.get("SIX_DEGREES_CLIENT_SECRET")
-	except KeyError as e:
-		print("You must set the client ID and secret in SIX_DEGREES_CLIENT_ID and SIX_DEGREES_CLIENT_SECRET (environment variables)")
-		return False
+# the default search budget, scaled up for retries that asked for a bigger one
+def search_budget(scale: float=1) -> search.SearchBudget:
+	return search.SearchBudget(settings.SEARCH_MAX_EXPANDED, settings.SEARCH_MAX_FETCHES, settings.SEARCH_DEADLINE).scaled(scale)
 
-	if client_ID and client_secret:
-		clients.spotify = spotify.Client(client_ID, client_secret)
-	return True
 
-# clients_init = asyncio.run(init_clients())
-#
-# if not clients_init:
-# 	print("Error initiating clients")
+# the budget scale asked for with ?budget=<factor>, clamped to what is allowed, or None if it isn't a number
+def budget_scale(value: str) -> Optional[float]:
+	try:
+		scale = float(value)
+	except ValueError:
+		return None
+	if not math.isfinite(scale):
+		return None
+	return min(max(scale, 1), settings.SEARCH_MAX_BUDGET_SCALE)
+
+
+# one server-sent event
+def sse_event(event: str, data) -> bytes:
+	return "event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode('utf-8')
+
+
+# pairs from a batch request body, either {"pairs": [[a, b], ...]} or {"sources": [...], "targets": [...]}
+# returns None if the body is malformed
+def batch_pairs(body) -> Optional[List[Tuple[ArtistID, ArtistID]]]:
+	if not isinstance(body, dict):
+		return None
+	if 'pairs' in body:
+		pairs = body['pairs']
+		if not isinstance(pairs, list) or not all(isinstance(p, list) and len(p) == 2 for p in pairs):
+			return None
+	else:
+		sources = body.get('sources')
+		targets = body.get('targets')
+		if not isinstance(sources, list) or not isinstance(targets, list):
+			return None
+		pairs = [[a, b] for a in sources for b in targets]
+	if not all(isinstance(i, str) for pair in pairs for i in pair):
+		return None
+	return list(dict.fromkeys((a, b) for a, b in pairs))
+
+
+# group pairs under whichever endpoint more pairs share, so each group can be one multi-target search
+# returns {root: [(other endpoint, whether the pair was requested as (other, root))]}
+def group_pairs(pairs: List[Tuple[ArtistID, ArtistID]]) -> Dict[ArtistID, List[Tuple[ArtistID, bool]]]:
+	counts = Counter(i for pair in pairs for i in set(pair))
+	groups: Dict[ArtistID, List[Tuple[ArtistID, bool]]] = {}
+	for a, b in pairs:
+		if counts[b] > counts[a]:
+			groups.setdefault(b, []).append((a, True))
+		else:
+			groups.setdefault(a, []).append((b, False))
+	return groups
 
 
 def create_app():
@@ -46,10 +85,46 @@ def create_app():
 	app = cors(app)
 	app.spotify = None
 
-	clients_init = init_clients()
-
-	if not clients_init:
-		print("Error initiating clients")
+	# mapped read-only, so workers share the snapshot's pages
+	clients.snapshot = snapshot.load(settings.SNAPSHOT_PATH)
+	clients.landmarks = landmarks.load(clients.snapshot)
+
+	# /api/stats is served from a document rebuilt in the background
+	app.stats = None
+
+	@app.before_serving
+	async def before_serving():
+		await clients.init_redis()
+		if clients.redis is None:
+			# cache calls fail fast while the health probe keeps trying to connect
+			cache.health.trip()
+		await cache.ensure_stats_indexes()
+		if clients.snapshot is not None:
+			clients.search_pool = snapshot.SearchPool(clients.snapshot, settings.SEARCH_PROCESSES)
+			await clients.search_pool.start()
+		app.typeahead_loader = asyncio.ensure_future(typeahead.load_from_redis())
+		# one Spotify client (connection pool, rate limit state and concurrency limit) for every request
+		client_ID = os.environ.get("SIX_DEGREES_CLIENT_ID")
+		client_secret = os.environ.get("SIX_DEGREES_CLIENT_SECRET")
+		if client_ID and client_secret:
+			clients.spotify = transport.create_client(client_ID, client_secret)
+			app.spotify = clients.spotify
+		app.stats = stats.StatsSnapshot(build_stats, settings.STATS_REFRESH_INTERVAL, settings.STATS_REFRESH_AFTER_CONNECTIONS)
+		# the refresh task inherits the priority, so its Spotify requests wait behind interactive ones
+		with transport.priority(transport.BACKGROUND):
+			app.stats.start()
+
+	@app.after_serving
+	async def after_serving():
+		app.typeahead_loader.cancel()
+		await app.stats.stop()
+		if clients.search_pool is not None:
+			clients.search_pool.stop()
+			clients.search_pool = None
+		if app.spotify:
+			await app.spotify.close()
+		await cache.health.close()
+		await clients.close_redis()
 
 	@app.before_request
 	def before_request():
@@ -61,92 +136,272 @@ def create_app():
 				print(
 					"You must set the client ID and secret in SIX_DEGREES_CLIENT_ID and SIX_DEGREES_CLIENT_SECRET (environment variables)")
 				return False
-			app.spotify = spotify.Client(client_ID, client_secret)
+			app.spotify = transport.create_client(client_ID, client_secret)
+
+	@app.before_request
+	async def start_request_metrics():
+		if not metrics.enabled:
+			return
+		g.request_started = perf_counter()
+		if metrics.tracing and 'X-Debug-Trace' in request.headers:
+			metrics.start_trace()
+
+	@app.after_request
+	async def record_request_metrics(response):
+		if not metrics.enabled or not hasattr(g, 'request_started'):
+			return response
+		# streamed responses are timed until their body starts
+		metrics.record(metrics.http_request_seconds, perf_counter() - g.request_started, request.endpoint or 'unmatched', request.method, str(response.status_code), span='route')
+		trace = metrics.current_trace.get()
+		if trace is not None:
+			response.headers['X-Debug-Trace'] = trace.header()
+		return response
+
+	# Prometheus metrics for this worker, if enabled (SIX_DEGREES_METRICS)
+	@app.route('/metrics', methods=['GET'])
+	async def get_metrics():
+		if not metrics.enabled:
+			abort(404)
+		return Response(metrics.render(), mimetype='text/plain')
 
 	# route for getting path given artist IDs
+	# an empty list means no path was found; X-Search-Status tells whether the artists are not connected
+	# or the search ran out of budget (retry with e.g. ?budget=2 to search twice as far)
+	# X-Search-Expanded is the number of artists searched to answer (0 if it was cached)
+	# found and disconnected answers are final, so they are cached (in process and by clients) and carry an ETag
 	@app.route('/api/connect/<artist1_id>/<artist2_id>', methods=['GET'])
 	async def find_connections(artist1_id, artist2_id):
-		artist1: Artist = await app.spotify.get_artist(artist1_id)
-		artist2: Artist = await app.spotify.get_artist(artist2_id)
-		id_path, artists_searched = await bi_bfs(artist1, artist2)
-		artist_dicts = []
-		for i in id_path:
-			artist_dict = await get_artist_dict(i)
-			artist_dicts.append(artist_dict)
-
-		res = artist_dicts
-
-		return Response(json.dumps(res), mimetype='text/json')
+		scale = budget_scale(request.args.get('budget', '1'))
+		if scale is None:
+			abort(400)
+		budget = search_budget(scale)
+
+		key = ('connect', artist1_id, artist2_id)
+		cached = responses.get(key)
+		metrics.cache_lookups.inc('response', 'miss' if cached is None else 'hit')
+		if cached is not None:
+			# still a view of the connection for the stats
+			if not await cache.cached_connection_stats(artist1_id, artist2_id, cached.context):
+				print("Error storing cached connection stats")
+			app.stats.connection_recorded()
+			return cached.response(request.headers, {'X-Search-Expanded': '0'})
+
+		endpoints = await metadata.get_artist_dicts(app.spotify, [artist1_id, artist2_id])
+		if artist1_id not in endpoints or artist2_id not in endpoints:
+			abort(404)
+		result = await bi_bfs(artist1_id, artist2_id, budget)
+		app.stats.connection_recorded()
+		artist_dicts = await metadata.get_artist_dicts(app.spotify, result.path)
+
+		res = [artist_dicts[i] for i in result.path if i in artist_dicts]
+
+		final = result.status in (search.FOUND, search.DISCONNECTED)
+		response = responses.JSONResponse(res, {'X-Search-Status': result.status}, settings.RESPONSE_MAX_AGE if final else 0, result.path)
+		if final:
+			responses.store(key, response)
+		return response.response(request.headers, {'X-Search-Expanded': str(result.expanded)})
+
+	# server-sent events version of /api/connect for showing progress: "progress" events with the artists searched
+	# and how deep the search is from each end, then one "result" event with the status and path
+	# the search is cancelled if the client disconnects before it finishes
+	@app.route('/api/connect/<artist1_id>/<artist2_id>/stream', methods=['GET'])
+	async def find_connections_stream(artist1_id, artist2_id):
+		scale = budget_scale(request.args.get('budget', '1'))
+		if scale is None:
+			abort(400)
+		budget = search_budget(scale)
+
+		endpoints = await metadata.get_artist_dicts(app.spotify, [artist1_id, artist2_id])
+		if artist1_id not in endpoints or artist2_id not in endpoints:
+			abort(404)
+
+		async def generate():
+			events: asyncio.Queue = asyncio.Queue()
+
+			def progress(expanded: int, forward_depth: int, backward_depth: int):
+				events.put_nowait({"artists_searched": expanded, "depth": forward_depth + backward_depth, "source_depth": forward_depth, "target_depth": backward_depth})
+
+			search_task = asyncio.ensure_future(bi_bfs(artist1_id, artist2_id, budget, progress))
+			search_task.add_done_callback(lambda _: events.put_nowait(None))
+			try:
+				while True:
+					event = await events.get()
+					if event is None:
+						break
+					yield sse_event("progress", event)
+				result = search_task.result()
+				app.stats.connection_recorded()
+				artist_dicts = await metadata.get_artist_dicts(app.spotify, result.path)
+				yield sse_event("result", {"status": result.status, "path": [artist_dicts[i] for i in result.path if i in artist_dicts]})
+			finally:
+				if not search_task.done():
+					search_task.cancel()
+
+		return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+	# route for many connections at once, given {"pairs": [[a, b], ...]} or {"sources": [...], "targets": [...]}
+	# streams one JSON object per line as each pair is resolved:
+	# {"source": a, "target": b, "status": <X-Search-Status, "not_found" or "error">, "path": [artist dicts]}
+	@app.route('/api/connect/batch', methods=['POST'])
+	async def find_connections_batch():
+		pairs = batch_pairs(await request.get_json(force=True, silent=True))
+		if pairs is None or len(pairs) > settings.BATCH_MAX_PAIRS:
+			abort(400)
+
+		async def generate():
+			endpoints = await metadata.get_artist_dicts(app.spotify, [i for pair in pairs for i in pair])
+			found = [(a, b) for a, b in pairs if a in endpoints and b in endpoints]
+			for a, b in pairs:
+				if a not in endpoints or b not in endpoints:
+					yield (json.dumps({"source": a, "target": b, "status": "not_found", "path": []}) + "\n").encode('utf-8')
+
+			results: asyncio.Queue = asyncio.Queue()
+			memo: Dict[ArtistID, List[ArtistID]] = {}
+			# bulk work: its Spotify requests wait behind single connections
+			with transport.priority(transport.BACKGROUND):
+				tasks = [asyncio.ensure_future(bi_bfs_group(root, others, memo, results)) for root, others in group_pairs(found).items()]
+			try:
+				for _ in range(len(found)):
+					artist1_id, artist2_id, result = await results.get()
+					if result is None:
+						line = {"source": artist1_id, "target": artist2_id, "status": "error", "path": []}
+					else:
+						app.stats.connection_recorded()
+						artist_dicts = await metadata.get_artist_dicts(app.spotify, result.path)
+						line = {"source": artist1_id, "target": artist2_id, "status": result.status, "path": [artist_dicts[i] for i in result.path if i in artist_dicts]}
+					yield (json.dumps(line) + "\n").encode('utf-8')
+			finally:
+				# stop searching if the client goes away
+				for t in tasks:
+					t.cancel()
+
+		return Response(generate(), mimetype='application/x-ndjson')
+
+	# route for the artists within some degrees of an artist (?depth=<hops>), streamed one layer per line
+	# as each completes: {"depth": <hops>, "count": <number of artists>, "artists": [IDs]}
+	# the BFS tree is stored, so later connections from this artist are read off it instead of searched
+	@app.route('/api/degrees/<artist_id>', methods=['GET'])
+	async def get_degrees(artist_id):
+		try:
+			max_depth = int(request.args.get('depth', settings.DEGREES_DEFAULT_DEPTH))
+		except ValueError:
+			abort(400)
+		max_depth = min(max(max_depth, 1), settings.DEGREES_MAX_DEPTH)
+		if await metadata.get_artist_dict(app.spotify, artist_id) is None:
+			abort(404)
+
+		async def generate():
+			budget = search_budget()
+			bfs = search.MultiTargetSearch(expand_related_artists, artist_id)
+			layers = bfs.layers(max_depth, budget)
+			try:
+				async for depth, layer in layers:
+					yield (json.dumps({"depth": depth, "count": len(layer), "artists": layer}) + "\n").encode('utf-8')
+			finally:
+				await layers.aclose()
+				# every artist reached has its shortest path in the tree, even if the last layer wasn't finished
+				if len(bfs.forward.parents) > 1:
+					await cache.store_tree(artist_id, bfs.forward.parents, settings.TREE_TTL)
+
+		return Response(generate(), mimetype='application/x-ndjson')
+
+	# route for bounds on degrees of separation from the landmarks, without searching
+	@app.route('/api/bounds/<artist1_id>/<artist2_id>', methods=['GET'])
+	async def get_bounds(artist1_id, artist2_id):
+		if clients.landmarks is None:
+			abort(404)
+		bounds = clients.landmarks.bounds(artist1_id, artist2_id)
+		if bounds is None:
+			abort(404)
+		lower, upper = bounds
+		return Response(json.dumps({"lower": lower, "upper": upper}), mimetype='text/json')
 
 	# route for getting search results for web app
 	@app.route('/api/search/<artist_name>', methods=['GET'])
 	async def search_artists(artist_name):
-		results = await app.spotify.search(artist_name, types=['artist'], limit="20")
-		artists: List[Artist] = results['artists']
-		artist_dicts: List[Dict] = []
-		for a in artists:
-			artist: Dict = generate_artist_dict(a)
-			artist_dicts.append(artist)
-		res = artist_dicts
+		# most keystrokes are answered from the local index or result cache
+		res = typeahead.lookup(artist_name, SEARCH_RESULTS_LIMIT)
+		if res is None:
+			results = await app.spotify.search(artist_name, types=['artist'], limit=str(SEARCH_RESULTS_LIMIT))
+			artists: List[Artist] = results['artists']
+			artist_dicts: List[Dict] = []
+			for a in artists:
+				artist: Dict = metadata.generate_artist_dict(a)
+				artist_dicts.append(artist)
+			await metadata.remember_artist_dicts(artist_dicts)
+			typeahead.cache_results(artist_name, artist_dicts)
+			res = artist_dicts
 		return Response(json.dumps(res), mimetype='text/json')
 
 	# route for getting one artist (after path found)
 	@app.route('/api/artist/<artist_id>', methods=['GET'])
 	async def get_artist(artist_id):
-		artist: Artist = await app.spotify.get_artist(artist_id)
-		artist_dict: Dict = generate_artist_dict(artist)
-		return Response(json.dumps(artist_dict), mimetype='text/json')
+		key = ('artist', artist_id)
+		cached = responses.get(key)
+		metrics.cache_lookups.inc('response', 'miss' if cached is None else 'hit')
+		if cached is None:
+			artist_dict: Dict = await metadata.get_artist_dict(app.spotify, artist_id)
+			if artist_dict is None:
+				abort(404)
+			cached = responses.store(key, responses.JSONResponse(artist_dict, max_age=settings.RESPONSE_MAX_AGE))
+		return cached.response(request.headers)
 
 	@app.route('/api/stats', methods=['GET'])
 	async def get_stats():
-		if not cache.redis_connected():
-			error_message = json.dumps({ "message": "Could not connect to Redis server"})
+		document = await app.stats.get()
+		if document is None:
 			abort(500)
 
-		stats = {}
-		stats['top_artists'] = []
-		stats['top_connections'] = []
-		stats['nonexistent_connections'] = []
-
-		top_artist_ids = cache.get_top_artists()
-		for i in top_artist_ids:
-			res = await get_artist_dict(i)
-			stats['top_artists'].append(res)
-
-		top_connection_keys = cache.get_top_connections()
-		for i in top_connection_keys:
-			connection_dict = dict()
-			connection_dict['url'] = i.replace(":", "/")
-			connection_dict['artists'] = []
-			for j in i.split(":"):
-				artist_dict = await get_artist_dict(j)
-				connection_dict['artists'].append(artist_dict)
-			stats['top_connections'].append(connection_dict)
-
-		stats['mean_degrees'] = cache.get_average_degrees_of_separation()
-
-		stats['connections_searched'] = cache.get_number_connections_searched()
-
-		max_degrees_connection = cache.get_longest_path()
-		# just return the artists that identify the connection
-		artist_ids = [max_degrees_connection[0], max_degrees_connection[-1]]
-		artist_dicts = []
-		for i in artist_ids:
-			res = await get_artist_dict(i)
-			artist_dicts.append(res)
-		stats['max_degrees_path'] = {"artists": artist_dicts, "degrees": len(max_degrees_connection)-1, "url": "/".join(artist_ids)}
-
-		nonexistent_connection_keys = cache.get_nonexistent_connections()
-		for i in nonexistent_connection_keys:
-			connection_dict = dict()
-			connection_dict['url'] = i.replace(":", "/")
-			connection_dict['artists'] = []
-			for j in i.split(":"):
-				artist_dict = await get_artist_dict(j)
-				connection_dict['artists'].append(artist_dict)
-			stats['nonexistent_connections'].append(connection_dict)
-
-		return Response(json.dumps(stats), mimetype='text/json')
+		headers = {'ETag': document.etag, 'Last-Modified': document.last_modified_header, 'Cache-Control': 'no-cache'}
+		if document.not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+			return Response('', status=304, headers=headers)
+		return Response(document.body, mimetype='text/json', headers=headers)
+
+	# the /api/stats document, or None if Redis is unavailable
+	async def build_stats() -> Optional[Dict]:
+		if not cache.redis_connected():
+			print("Could not connect to Redis server")
+			return None
+
+		top_artist_ids = await cache.get_top_artists()
+		top_connection_keys = await cache.get_top_connections()
+		max_degrees_connection = await cache.get_longest_path()
+		nonexistent_connection_keys = await cache.get_nonexistent_connections()
+
+		# resolve every artist the stats mention in one batch
+		artist_ids: List[ArtistID] = list(top_artist_ids)
+		for i in top_connection_keys + nonexistent_connection_keys:
+			artist_ids += i.split(":")
+		if max_degrees_connection:
+			artist_ids += [max_degrees_connection[0], max_degrees_connection[-1]]
+		artist_dicts = await metadata.get_artist_dicts(app.spotify, artist_ids)
+
+		def connection_dicts(connection_keys: List[str]) -> List[Dict]:
+			res = []
+			for i in connection_keys:
+				connection_dict = dict()
+				connection_dict['url'] = i.replace(":", "/")
+				connection_dict['artists'] = [artist_dicts.get(j) for j in i.split(":")]
+				res.append(connection_dict)
+			return res
+
+		document = {}
+		document['top_artists'] = [artist_dicts.get(i) for i in top_artist_ids]
+		document['top_connections'] = connection_dicts(top_connection_keys)
+
+		document['mean_degrees'] = await cache.get_average_degrees_of_separation()
+
+		document['connections_searched'] = await cache.get_number_connections_searched()
+
+		document['max_degrees_path'] = None
+		if max_degrees_connection:
+			# just return the artists that identify the connection
+			endpoint_ids = [max_degrees_connection[0], max_degrees_connection[-1]]
+			document['max_degrees_path'] = {"artists": [artist_dicts.get(i) for i in endpoint_ids], "degrees": len(max_degrees_connection)-1, "url": "/".join(endpoint_ids)}
+
+		document['nonexistent_connections'] = connection_dicts(nonexistent_connection_keys)
+
+		return document
 
 	async def get_artist(name: str) -> Artist:
 		res = await app.spotify.search(name, types=['artist'], limit=1)
@@ -158,137 +413,232 @@ def create_app():
 			return False
 		return artist
 
-	async def get_related_artists(artist_id: ArtistID) -> List[ArtistID]:
-		if not cache.redis_connected() or not cache.get_related_artists(artist_id):
-			related = await app.spotify.http.artist_related_artists(artist_id)
-			related_ids: List[ArtistID] = [a['id'] for a in related['artists']]
-			cache.store_related_artists(artist_id, related_ids)
-			return related_ids
-		else:
-			return cache.get_related_artists(artist_id)
-
-	async def get_artist_dict(artist_id):
-		artist: Artist = await app.spotify.get_artist(artist_id)
-		return generate_artist_dict(artist)
-
-	async def bi_bfs(artist1: Artist, artist2: Artist) -> Tuple[List[ArtistID], int]:
-		cached_path = cache.get_path(artist1.id, artist2.id)
+	# concurrent searches for the same connection (by connection key and budget), and concurrent lookups of
+	# the same artist's related artists, each share one in-flight task
+	# tasks run at the priority of the request that started them, so requests only share those at their own priority
+	# (an interactive request would otherwise wait behind a batch's background requests)
+	searches = singleflight.SingleFlight()
+	related_artists_fetches = singleflight.SingleFlight()
+
+	async def fetch_related_artists(artist_id: ArtistID) -> Tuple[List[ArtistID], List[Dict]]:
+		res, _ = await related_artists_fetches.do((artist_id, transport.request_priority.get()), lambda _: request_related_artists(artist_id))
+		return res
+
+	# related artist IDs, and the related artists' dicts
+	async def request_related_artists(artist_id: ArtistID) -> Tuple[List[ArtistID], List[Dict]]:
+		related = await app.spotify.http.artist_related_artists(artist_id)
+		related_ids: List[ArtistID] = [a['id'] for a in related['artists']]
+		# the response carries full artist objects, so keep their metadata for paths and search
+		# (written to Redis with the rest of the level)
+		artist_dicts = [metadata.generate_artist_dict(spotify.Artist(app.spotify, a)) for a in related['artists']]
+		metadata.keep_artist_dicts(artist_dicts)
+		return related_ids, artist_dicts
+
+	# yield related artists for a level of the search as each lookup completes
+	# known artists come from the graph snapshot and one pipelined cache read, the rest are fetched
+	# from Spotify concurrently and written back to the cache together (with their related artists' dicts) once the
+	# level is done
+	# Spotify requests are limited to what is left of the search budget
+	# if the search stops before the level is done, the fetches it leaves in flight are still stored once they finish
+	async def expand_related_artists(artist_ids: List[ArtistID], budget: search.SearchBudget):
+		cached: Dict[ArtistID, List[ArtistID]] = {}
+		if clients.snapshot is not None:
+			cached = clients.snapshot.related_many(artist_ids)
+		if len(cached) < len(artist_ids):
+			cached.update(await cache.get_related_artists_many([i for i in artist_ids if i not in cached]))
+		fetched: Dict[ArtistID, List[ArtistID]] = {}
+		fetched_artist_dicts: Dict[ArtistID, Dict] = {}
+		abandoned: List[asyncio.Future] = []
+		try:
+			for artist_id, related_ids in cached.items():
+				yield artist_id, related_ids
+			missing = [i for i in artist_ids if i not in cached]
+			remaining_fetches = budget.remaining_fetches()
+			if remaining_fetches is not None:
+				missing = missing[:remaining_fetches]
+			results = search.expand_concurrently(missing, fetch_related_artists, settings.SEARCH_CONCURRENCY, abandoned.extend)
+			try:
+				async for artist_id, (related_ids, artist_dicts) in results:
+					budget.fetches += 1
+					fetched[artist_id] = related_ids
+					fetched_artist_dicts.update((d['id'], d) for d in artist_dicts)
+					yield artist_id, related_ids
+			finally:
+				await results.aclose()
+		finally:
+			if abandoned:
+				# the search is over, so it doesn't wait for them
+				asyncio.ensure_future(store_fetched(fetched, fetched_artist_dicts, abandoned))
+			elif fetched:
+				await cache.store_related_artists_many(fetched, fetched_artist_dicts)
+
+	# store a level's related artists once the fetches left in flight finish, in one batch with those already fetched
+	async def store_fetched(fetched: Dict[ArtistID, List[ArtistID]], fetched_artist_dicts: Dict[ArtistID, Dict], in_flight: List[asyncio.Future]):
+		for res in await asyncio.gather(*in_flight, return_exceptions=True):
+			# failed fetches are left for a later search to retry
+			if isinstance(res, BaseException):
+				continue
+			artist_id, (related_ids, artist_dicts) = res
+			fetched[artist_id] = related_ids
+			fetched_artist_dicts.update((d['id'], d) for d in artist_dicts)
+		if fetched:
+			await cache.store_related_artists_many(fetched, fetched_artist_dicts)
+
+	def landmark_path(artist1_id: ArtistID, artist2_id: ArtistID) -> List[ArtistID]:
+		if clients.landmarks is None:
+			return []
+		return clients.landmarks.path(artist1_id, artist2_id)
+
+	# the stored answer for a connection (counted in the stats), or None if it has to be searched
+	async def cached_result(artist1_id: ArtistID, artist2_id: ArtistID, budget: search.SearchBudget) -> Optional[search.SearchResult]:
+		cached_path, recorded = await cache.get_path(artist1_id, artist2_id)
+		metrics.cache_lookups.inc('connection_path', 'hit' if cached_path else 'miss')
 		if cached_path:
-			# if cache.store_longest_path(artist1.id, artist2.id, cached_path):
+			# if cache.store_longest_path(artist1_id, artist2_id, cached_path):
 			# 	print("New longest path")
-			if not cache.cached_connection_stats(artist1.id, artist2.id, cached_path):
-				print("Error storing cached connection stats")
-			return cached_path, 0
-
-		print_progress = False
-		parent1: Dict[ArtistID, ArtistID] = {}
-		parent2: Dict[ArtistID, ArtistID] = {}
-		found = False
-		intersect: ArtistID = ""
-		queue1: List[ArtistID] = [artist1.id]
-		queue2: List[ArtistID] = [artist2.id]
-		set1 = set()
-		set1.add(artist1.id)
-		set2 = set()
-		set2.add(artist2.id)
-		visited1: Set[ArtistID] = set()
-		visited2: Set[ArtistID] = set()
-		loop = asyncio.get_event_loop()
-
-		# edge case where artist1/2 or is in queue of opposite side when intersection is found
-		# so intersection should be ignored
-		one_way_edge_case = False
-
-		# settings for how often (BFS turns) to display count of artists searched
-		status_counter = 0
-		status_interval = 50
-		while queue1 and queue2 and not found:
-
-			# take turns from each side
-			current_artist1_id: ArtistID = queue1.pop(0)
-			set1.remove(current_artist1_id)
-			if current_artist1_id == artist2.id or current_artist1_id in visited2:
-				found = True
-				intersect = current_artist1_id
-				if artist1.id in queue2 or artist2.id in queue1:
-					one_way_edge_case = True
-				break
-			if current_artist1_id not in visited1:
-				promise = await loop.run_in_executor(None, lambda: get_related_artists(current_artist1_id))
-				related_artists_ids: List[ArtistID] = await promise
-				for i in related_artists_ids:
-					if i not in parent1:
-						parent1[i] = current_artist1_id
-					if i not in visited1 and i not in set1:
-						queue1.append(i)
-						set1.add(i)
-				visited1.add(current_artist1_id)
-
-			current_artist2_id: ArtistID = queue2.pop(0)
-			set2.remove(current_artist2_id)
-			if current_artist2_id == artist1.id or current_artist2_id in visited1:
-				found = True
-				intersect = current_artist2_id
-				if artist1.id in queue2 or artist2.id in queue1:
-					one_way_edge_case = True
-				break
-			if current_artist2_id not in visited2:
-				promise = await loop.run_in_executor(None, lambda: get_related_artists(current_artist2_id))
-				related_artists_ids: List[ArtistID] = await promise
-				for i in related_artists_ids:
-					if i not in parent2:
-						parent2[i] = current_artist2_id
-					if i not in visited2 and i not in set2:
-						queue2.append(i)
-						set2.add(i)
-				visited2.add(current_artist2_id)
-
-			# print progress
-			if print_progress:
-				if status_counter == 0:
-					all_artists = visited1.union(visited2)
-					print("Artists searched: {}".format(len(all_artists) - 2))
-				status_counter = (status_counter + 1) % status_interval
-
-		if found:
-			all_artists = visited1.union(visited2)
-			# print("Artists searched: {}".format(len(all_artists)-2))
-			path: List[ArtistID] = await trace_bi_path(artist1, artist2, parent1, parent2, intersect)
-			if one_way_edge_case:
-				path2: List[ArtistID] = await trace_path(artist1, artist2, parent1, parent2)
-				if len(path2) < len(path):
-					path = path2[:]
-
-			# store stats
-			# store length, and initialize count associated with this connection
-			# update count of artists included in searches
-			# if not cache.store_path(artist1.id, artist2.id, path):
-			# 	print("Error storing path. May have already been stored")
-			if not cache.new_connection_stats(artist1.id, artist2.id, path):
+			if recorded:
+				if not await cache.cached_connection_stats(artist1_id, artist2_id, cached_path):
+					print("Error storing cached connection stats")
+			# only stored as part of another connection's path, so this is its first search
+			elif not await cache.new_connection_stats(artist1_id, artist2_id, cached_path):
 				print("Error updating new connection stats")
-			return path, len(all_artists)
+			return search.SearchResult(cached_path, 0, search.FOUND)
 
-		else:
-			return [], 0
+		# walking a stored BFS tree of either artist (see /api/degrees) gives a shortest path without searching
+		tree_path = await cache.get_tree_path(artist1_id, artist2_id)
+		metrics.cache_lookups.inc('connection_tree', 'hit' if tree_path else 'miss')
+		if tree_path:
+			if not await cache.new_connection_stats(artist1_id, artist2_id, tree_path):
+				print("Error updating new connection stats")
+			return search.SearchResult(tree_path, 0, search.FOUND)
+
+		# a budget exhausted result only stands for searches with at most the budget it had
+		no_path = await cache.get_no_path(artist1_id, artist2_id)
+		metrics.cache_lookups.inc('connection_no_path', 'miss' if no_path is None else 'hit')
+		if no_path is not None:
+			if no_path['status'] == search.DISCONNECTED:
+				if not await cache.cached_connection_stats(artist1_id, artist2_id, []):
+					print("Error storing cached connection stats")
+				return search.SearchResult([], 0, search.DISCONNECTED)
+			if search.SearchBudget(*no_path['budget']).covers(budget):
+				approximate_path = landmark_path(artist1_id, artist2_id)
+				if approximate_path:
+					return search.SearchResult(approximate_path, 0, search.APPROXIMATE)
+				return search.SearchResult([], 0, search.BUDGET_EXHAUSTED)
+		return None
+
+	# store the result of a search and count it in the stats
+	async def record_result(artist1_id: ArtistID, artist2_id: ArtistID, result: search.SearchResult, budget: search.SearchBudget) -> search.SearchResult:
+		if result.status == search.BUDGET_EXHAUSTED:
+			await cache.store_no_path(artist1_id, artist2_id, result.status, budget.as_list(), settings.NO_PATH_TTL)
+			approximate_path = landmark_path(artist1_id, artist2_id)
+			if approximate_path:
+				return search.SearchResult(approximate_path, result.expanded, search.APPROXIMATE)
+			return result
+		# not proven shortest, so returned without being stored or counted
+		if result.status == search.APPROXIMATE:
+			await cache.store_no_path(artist1_id, artist2_id, search.BUDGET_EXHAUSTED, budget.as_list(), settings.NO_PATH_TTL)
+			return result
+		if not result.path:
+			await cache.store_no_path(artist1_id, artist2_id, result.status, budget.as_list(), settings.DISCONNECTED_TTL)
+			if not await cache.new_connection_stats(artist1_id, artist2_id, []):
+				print("Error updating nonexistent connection stats")
+			return result
+
+		# store stats
+		# store length, and initialize count associated with this connection
+		# update count of artists included in searches
+		if not await cache.new_connection_stats(artist1_id, artist2_id, result.path):
+			print("Error updating new connection stats")
+		return result
+
+	# find a shortest path through related artists, using bidirectional bfs to reduce search space
+	async def bi_bfs(artist1_id: ArtistID, artist2_id: ArtistID, budget: search.SearchBudget, progress: Optional[search.ProgressFunction]=None) -> search.SearchResult:
+		result = await cached_result(artist1_id, artist2_id, budget)
+		if result is not None:
+			return result
+
+		connection_key, _ = cache.get_connection_key(artist1_id, artist2_id)
+
+		# every request sharing the search is sent its progress from when it joined, with the search's source
+		# so that requests in the other direction can swap the depths
+		def listener(source: ArtistID, expanded: int, forward_depth: int, backward_depth: int):
+			if source == artist1_id:
+				progress(expanded, forward_depth, backward_depth)
+			else:
+				progress(expanded, backward_depth, forward_depth)
+
+		key = (connection_key, tuple(budget.as_list()), transport.request_priority.get())
+		result, joined = await searches.do(key, lambda notify: search_connection(artist1_id, artist2_id, budget, lambda *args: notify(artist1_id, *args)), listener if progress is not None else None)
+		if not joined:
+			return result
+		# the search (and its stats) came from a request for the same connection, so count this one like a cached
+		# result, in this request's direction
+		if result.path and result.path[0] != artist1_id:
+			result = result._replace(path=result.path[::-1])
+		if result.status in (search.FOUND, search.DISCONNECTED):
+			if not await cache.cached_connection_stats(artist1_id, artist2_id, result.path):
+				print("Error storing cached connection stats")
+		return result
+
+	# search the snapshot alone, off the event loop (see snapshot.SearchPool)
+	# returns the result, or how far the search got if the snapshot couldn't settle it within the budget
+	async def snapshot_search(artist1_id: ArtistID, artist2_id: ArtistID, budget: search.SearchBudget) -> Union[search.SearchResult, search.SearchState]:
+		# the deadline covers the snapshot search and whatever continues it
+		budget.start()
+		if clients.search_pool is not None:
+			return await clients.search_pool.search(artist1_id, artist2_id, budget)
+		return clients.snapshot.search(artist1_id, artist2_id, budget)
+
+	async def search_connection(artist1_id: ArtistID, artist2_id: ArtistID, budget: search.SearchBudget, progress: Optional[search.ProgressFunction]=None) -> search.SearchResult:
+		result = None
+		if clients.snapshot is not None:
+			with metrics.timer(metrics.snapshot_search_seconds):
+				result = await snapshot_search(artist1_id, artist2_id, budget)
+		# the snapshot couldn't settle it alone, so the search continues from where it stopped, with Spotify/Redis
+		# filling in missing artists
+		if not isinstance(result, search.SearchResult):
+			# a path through a landmark lets the search stop early, or stands in if it runs out of budget
+			known_path = landmark_path(artist1_id, artist2_id)
+			engine = search.BidirectionalSearch(expand_related_artists, budget, known_path, progress, settings.SEARCH_PROGRESS_INTERVAL)
+			if result is None:
+				result = await engine.run(artist1_id, artist2_id)
+			else:
+				result = await engine.resume(result)
+		metrics.searches.inc(result.status)
+		return await record_result(artist1_id, artist2_id, result, budget)
+
+	# resolve a group of pairs sharing the endpoint root with one multi-target search, putting
+	# (artist1 ID, artist2 ID, result) on results as each pair is resolved
+	# related artists are shared through memo by every search in the batch
+	async def bi_bfs_group(root: ArtistID, others: List[Tuple[ArtistID, bool]], memo: Dict[ArtistID, List[ArtistID]], results: asyncio.Queue):
+		multi = search.MultiTargetSearch(search.memoize_expand(expand_related_artists, memo), root)
+		for i, (other, reverse) in enumerate(others):
+			artist1_id, artist2_id = (other, root) if reverse else (root, other)
+			budget = search_budget()
+			try:
+				result = await cached_result(artist1_id, artist2_id, budget)
+				if result is None:
+					if clients.snapshot is not None:
+						result = await snapshot_search(artist1_id, artist2_id, budget)
+					# the root's side is shared by the group, so the multi-target search grows it itself (reading the
+					# snapshot's related artists where it has them)
+					if not isinstance(result, search.SearchResult):
+						result = await multi.run(other, budget)
+						if reverse:
+							result = result._replace(path=result.path[::-1])
+					metrics.searches.inc(result.status)
+					result = await record_result(artist1_id, artist2_id, result, budget)
+			except Exception as e:
+				print("Error searching {} to {}: {!r}".format(artist1_id, artist2_id, e))
+				for other, reverse in others[i:]:
+					await results.put(((other, root) if reverse else (root, other)) + (None,))
+				return
+			await results.put((artist1_id, artist2_id, result))
 
 	return app
 
 
-def get_image_dicts(images):
-	return [{ "url": i.url, "width":i.width, "height": i.height} for i in images]
-
-
-def generate_artist_dict(artist):
-	artist_dict: Dict = {}
-	artist_dict['name'] = artist.name
-	artist_dict['images'] = get_image_dicts(artist.images)
-	artist_dict['url'] = 'open.spotify.com/artist/' + artist.id
-	artist_dict['genres'] = artist.genres
-	artist_dict['followers'] = artist.followers
-	artist_dict['id'] = artist.id
-	return artist_dict
-
-
 if __name__ == '__main__':
 
 	app = create_app()
@@ -1,64 +1,180 @@
-from typing import List, Tuple
+import asyncio
+import copy
+import functools
+import json
+from time import time
+from typing import Dict, List, Optional, Tuple
 from src.custom_types import *
+from src.health import CircuitBreaker
+from src.lru import LRUCache
 import src.clients as clients
+import src.metrics as metrics
+import src.settings as settings
 
-from redis import RedisError
+from aioredis import RedisError
 
 """
 Cache contents:
 
 <ArtistID> 					-> List of related Artist IDs
-<ArtistID>:<ArtistID> 		-> List of Artist IDs in connection
+<ArtistID>:<ArtistID> 		-> List of Artist IDs in connection (also stored for every pair on a cached path)
+nopath:<ArtistID>:<ArtistID> -> JSON {"status", "budget"} of a search that found no path, with a TTL
+tree:<ArtistID>				-> HASH of <ArtistID> -> parent on a shortest path back to the root (root maps to itself), with a TTL
+artist:<ArtistID> 			-> JSON artist dict (as returned by the API), with a TTL
 stats:
 	longest_path			-> <ArtistID>:<ArtistID> of longest connection
 	connection_lengths		-> HASH of <ArtistID>:<ArtistID> -> length
 	connection_searches		-> HASH of <ArtistID>:<ArtistID> -> # of searches (unique by origin?)
 	artist_searches			-> HASH of <ArtistID> -> # of connections included in
+	connection_lengths_rank	-> ZSET of <ArtistID>:<ArtistID> by length (existing connections only)
+	connection_searches_rank	-> ZSET of <ArtistID>:<ArtistID> by # of searches
+	artist_searches_rank	-> ZSET of <ArtistID> by # of connections included in
+	nonexistent_connections	-> ZSET of <ArtistID>:<ArtistID> with no path, by time found
+	degrees_sum				-> sum of degrees of separation over existing connections
+	connections_count		-> number of existing connections
+	indexes_version			-> version of the rankings/aggregates above, set once they are built
 """
 
+ARTIST_DICT_KEY_PREFIX: str = "artist:"
+NO_PATH_KEY_PREFIX: str = "nopath:"
+TREE_KEY_PREFIX: str = "tree:"
 LONGEST_CONNECTION_KEY: str = "stats:longest_path"
 CONNECTION_LENGTHS_KEY: str = "stats:connection_lengths"
 CONNECTION_SEARCHES_KEY: str = "stats:connection_searches"
 ARTIST_SEARCHES_KEY: str = "stats:artist_searches"
-
-
-# test Redis connection
-def redis_connected():
-	try:
-		res = clients.redis.ping()
-		return True
-	except RedisError:
-		return False
+CONNECTION_LENGTHS_RANK_KEY: str = "stats:connection_lengths_rank"
+CONNECTION_SEARCHES_RANK_KEY: str = "stats:connection_searches_rank"
+ARTIST_SEARCHES_RANK_KEY: str = "stats:artist_searches_rank"
+NONEXISTENT_CONNECTIONS_KEY: str = "stats:nonexistent_connections"
+DEGREES_SUM_KEY: str = "stats:degrees_sum"
+CONNECTIONS_COUNT_KEY: str = "stats:connections_count"
+STATS_INDEXES_VERSION_KEY: str = "stats:indexes_version"
+STATS_INDEXES_VERSION: str = "1"
+
+
+async def ping():
+	# the worker started while Redis was down: connect now, and build the stats indexes once the circuit closes
+	if clients.redis is None:
+		await clients.connect_redis()
+		await clients.redis.ping()
+		# runs after the probe closes the circuit
+		asyncio.ensure_future(ensure_stats_indexes())
+		return
+	await clients.redis.ping()
+
+
+# Redis availability, tracked from the outcome of real commands instead of a PING before each one
+health = CircuitBreaker("Redis", ping, (RedisError, OSError, asyncio.TimeoutError), failure_threshold=settings.REDIS_FAILURE_THRESHOLD, probe_interval=settings.REDIS_PROBE_INTERVAL)
+
+
+# whether Redis commands should currently be attempted
+def redis_connected() -> bool:
+	return clients.redis is not None and health.available()
+
+
+# wraps a function issuing Redis commands: returns `default` without contacting Redis while the circuit is open
+# command errors and timeouts also return `default`, and count towards opening the circuit
+def redis_command(default):
+	def decorator(func):
+		span = 'redis ' + func.__name__
+
+		@functools.wraps(func)
+		async def wrapper(*args, **kwargs):
+			if not redis_connected():
+				return copy.copy(default)
+			try:
+				with metrics.timer(metrics.redis_command_seconds, func.__name__, span=span):
+					res = await asyncio.wait_for(func(*args, **kwargs), settings.REDIS_COMMAND_TIMEOUT)
+			except (RedisError, OSError, asyncio.TimeoutError) as e:
+				print("Redis error in {}: {!r}".format(func.__name__, e))
+				metrics.redis_errors.inc(func.__name__)
+				health.record_failure()
+				return copy.copy(default)
+			health.record_success()
+			return res
+		return wrapper
+	return decorator
+
+
+# in-process tier in front of Redis for related artists lists, so hub artists cost a dict lookup
+# entries are stored as tuples so callers can't modify them
+related_artists_tier = LRUCache(settings.ADJACENCY_CACHE_MAX_ENTRIES, settings.ADJACENCY_CACHE_MAX_BYTES, settings.ADJACENCY_CACHE_TTL)
+metrics.watch_cache('related_artists_memory', related_artists_tier)
 
 
 # cache related artists for a given artist
 # if in cache, return value
-# else, return False
-def get_related_artists(artist_id: ArtistID) -> List[ArtistID]:
-	if not redis_connected():
-		return []
-
-	val: List[bytes] = clients.redis.lrange(artist_id, 0, -1)
-	if not val:
-		return []
-	else:
-		res: List[ArtistID] = []
-		for id in val:
-			str_id: ArtistID = str(id, 'utf-8')
-			res.append(str_id)
-		return res
+# else, return empty list
+async def get_related_artists(artist_id: ArtistID) -> List[ArtistID]:
+	res = await get_related_artists_many([artist_id])
+	return res.get(artist_id, [])
+
+
+# get cached related artists for many artists
+# checks the in-process tier first, then reads the rest from Redis in one pipelined round trip
+# only artists found in the cache are included in the result
+async def get_related_artists_many(artist_ids: List[ArtistID]) -> Dict[ArtistID, List[ArtistID]]:
+	res: Dict[ArtistID, List[ArtistID]] = {}
+	missing: List[ArtistID] = []
+	for i in artist_ids:
+		val = related_artists_tier.get(i)
+		if val is None:
+			missing.append(i)
+		else:
+			res[i] = list(val)
+	metrics.cache_lookups.inc('related_artists_memory', 'hit', amount=len(res))
+	metrics.cache_lookups.inc('related_artists_memory', 'miss', amount=len(missing))
+	if missing:
+		from_redis = await read_related_artists_many(missing)
+		for artist_id, related_artists_ids in from_redis.items():
+			related_artists_tier.set(artist_id, tuple(related_artists_ids))
+		res.update(from_redis)
+		metrics.cache_lookups.inc('related_artists_redis', 'hit', amount=len(from_redis))
+		metrics.cache_lookups.inc('related_artists_redis', 'miss', amount=len(missing) - len(from_redis))
+	return res
+
+
+@redis_command({})
+async def read_related_artists_many(artist_ids: List[ArtistID]) -> Dict[ArtistID, List[ArtistID]]:
+	pipe = clients.redis.pipeline()
+	for i in artist_ids:
+		pipe.lrange(i, 0, -1)
+	vals: List[List[bytes]] = await pipe.execute()
+	res: Dict[ArtistID, List[ArtistID]] = {}
+	for artist_id, val in zip(artist_ids, vals):
+		if val:
+			res[artist_id] = [str(id, 'utf-8') for id in val]
+	return res
 
 
 # given an artist ID and list of related Artist objects, store in cache
-def store_related_artists(artist_id: ArtistID, related_artists_ids: List[ArtistID]) -> bool:
-	if not redis_connected():
-		return False
-	if not clients.redis.lrange(artist_id, 0, -1):
-		for i in related_artists_ids:
-			clients.redis.rpush(artist_id, i)
-		return True
-	else:
+async def store_related_artists(artist_id: ArtistID, related_artists_ids: List[ArtistID]) -> bool:
+	return await store_related_artists_many({artist_id: related_artists_ids})
+
+
+# store related artists for many artists in the in-process tier and in Redis, with the artist dicts of the related
+# artists (see src/metadata.py) in the same round trip
+async def store_related_artists_many(related: Dict[ArtistID, List[ArtistID]], artist_dicts: Optional[Dict[ArtistID, Dict]]=None) -> bool:
+	related = {k: v for k, v in related.items() if v}
+	if not related and not artist_dicts:
 		return False
+	for artist_id, related_artists_ids in related.items():
+		related_artists_tier.set(artist_id, tuple(related_artists_ids))
+	return await write_related_artists_many(related, artist_dicts or {})
+
+
+# one MULTI/EXEC transaction for all lists (and artist dicts)
+# each list is replaced as a whole, so readers never see a partially written list
+@redis_command(False)
+async def write_related_artists_many(related: Dict[ArtistID, List[ArtistID]], artist_dicts: Dict[ArtistID, Dict]) -> bool:
+	tr = clients.redis.multi_exec()
+	for artist_id, related_artists_ids in related.items():
+		tr.delete(artist_id)
+		tr.rpush(artist_id, *related_artists_ids)
+	for artist_id, artist_dict in artist_dicts.items():
+		tr.setex(ARTIST_DICT_KEY_PREFIX + artist_id, int(settings.METADATA_CACHE_TTL), json.dumps(artist_dict))
+	await tr.execute()
+	return True
 
 
 # get string for connection id/key, as well as boolean of whether order is reversed from input order
@@ -71,195 +187,350 @@ def get_connection_key(artistA_id: ArtistID, artistB_id: ArtistID) -> Tuple[str,
 
 
 # cache paths given two artists (key is "artist1:artist2"
-# if in cache, return values
-# else, return False
-def get_path(artistA_id: ArtistID, artistB_id: ArtistID) -> List[ArtistID]:
-	if not redis_connected():
-		return []
+# returns the path (empty if not cached) and whether the connection has been recorded in the stats, which
+# it hasn't if the path was only stored as part of a longer one
+@redis_command(([], False))
+async def get_path(artistA_id: ArtistID, artistB_id: ArtistID) -> Tuple[List[ArtistID], bool]:
 	# sort to store paths symmetrically (A->B equals B->A)
 	path_key, reverse = get_connection_key(artistA_id, artistB_id)
-	val: List[bytes] = clients.redis.lrange(path_key, 0, -1)
+	pipe = clients.redis.pipeline()
+	pipe.lrange(path_key, 0, -1)
+	pipe.hexists(CONNECTION_LENGTHS_KEY, path_key)
+	val, recorded = await pipe.execute()
 	if not val:
-		return []
+		return [], bool(recorded)
 	else:
 		result: List[ArtistID] = [str(id, 'utf-8') for id in val]
 		if reverse:
-			return result[::-1]
+			return result[::-1], bool(recorded)
 		else:
-			return result
+			return result, bool(recorded)
+
+
+# replace the endpoints' path, and add every other sub-path not already stored
+# (each space separated in ARGV, in the same order as KEYS, endpoints first)
+STORE_PATH_SCRIPT: str = """
+for i, key in ipairs(KEYS) do
+	if i == 1 or redis.call('EXISTS', key) == 0 then
+		redis.call('DEL', key)
+		for id in string.gmatch(ARGV[i], '%S+') do
+			redis.call('RPUSH', key, id)
+		end
+	end
+end
+return 1
+"""
 
 
-# TODO: what about non-existent paths, how to store
-def store_path(artistA_id: ArtistID, artistB_id: ArtistID, path: List[ArtistID]) -> bool:
-	if not redis_connected():
-		return False
-	path_key, reverse = get_connection_key(artistA_id, artistB_id)
-	if reverse:
-		path = path[::-1]
-	if not clients.redis.lrange(path_key, 0, -1):
-		for ai in path:
-			clients.redis.rpush(path_key, ai)
-		return True
-	else:
+# every contiguous sub-path of a shortest path is also a shortest path (taking related artists as mutual, see
+# src/search.py), so store them all: a path of n artists answers n(n-1)/2 connections
+# connections without a path are stored separately (see store_no_path)
+@redis_command(False)
+async def store_path(artistA_id: ArtistID, artistB_id: ArtistID, path: List[ArtistID]) -> bool:
+	if not path:
 		return False
+	path_keys: List[str] = []
+	paths: List[str] = []
+	pairs = [(0, len(path) - 1)] + [(i, j) for i in range(len(path)) for j in range(i + 1, len(path)) if (i, j) != (0, len(path) - 1)]
+	for i, j in pairs:
+		path_key, reverse = get_connection_key(path[i], path[j])
+		sub_path = path[i:j + 1]
+		if reverse:
+			sub_path = sub_path[::-1]
+		path_keys.append(path_key)
+		paths.append(' '.join(sub_path))
+	await clients.redis.eval(STORE_PATH_SCRIPT, keys=path_keys, args=paths)
+	return True
+
+
+# the outcome of a search that found no path between two artists, if one is cached
+# {"status": search status, "budget": [max expanded, max fetches, deadline] of the search}
+@redis_command(None)
+async def get_no_path(artistA_id: ArtistID, artistB_id: ArtistID) -> Optional[Dict]:
+	connection_key, _ = get_connection_key(artistA_id, artistB_id)
+	val = await clients.redis.get(NO_PATH_KEY_PREFIX + connection_key)
+	if val is None:
+		return None
+	return json.loads(str(val, 'utf-8'))
+
+
+# expires after ttl seconds, since the graph changes and a bigger budget may later be affordable
+@redis_command(False)
+async def store_no_path(artistA_id: ArtistID, artistB_id: ArtistID, status: str, budget: List[float], ttl: float) -> bool:
+	connection_key, _ = get_connection_key(artistA_id, artistB_id)
+	await clients.redis.setex(NO_PATH_KEY_PREFIX + connection_key, int(ttl), json.dumps({"status": status, "budget": budget}))
+	return True
+
+
+# store a BFS tree from root as a whole, replacing any older one
+@redis_command(False)
+async def store_tree(root: ArtistID, parents: Dict[ArtistID, ArtistID], ttl: float) -> bool:
+	key = TREE_KEY_PREFIX + root
+	tr = clients.redis.multi_exec()
+	tr.delete(key)
+	tr.hmset_dict(key, parents)
+	tr.expire(key, int(ttl))
+	await tr.execute()
+	return True
+
+
+# walk the tree in KEYS[1] from ARGV[1] back to its root, or if it isn't there, the tree in KEYS[2] from ARGV[2]
+# returns the number of the tree walked followed by the path (empty if neither tree has the artist)
+WALK_TREES_SCRIPT: str = """
+for t = 1, 2 do
+	local current = ARGV[t]
+	local parent = redis.call('HGET', KEYS[t], current)
+	if parent then
+		local path = {t, current}
+		while parent ~= current do
+			current = parent
+			table.insert(path, current)
+			parent = redis.call('HGET', KEYS[t], current)
+		end
+		return path
+	end
+end
+return {}
+"""
 
 
-def get_longest_path() -> List[ArtistID]:
-	if not redis_connected():
+# a shortest path from artistA to artistB read off a stored BFS tree of either artist, or empty if neither
+# tree reaches the other
+@redis_command([])
+async def get_tree_path(artistA_id: ArtistID, artistB_id: ArtistID) -> List[ArtistID]:
+	keys = [TREE_KEY_PREFIX + artistA_id, TREE_KEY_PREFIX + artistB_id]
+	res = await clients.redis.eval(WALK_TREES_SCRIPT, keys=keys, args=[artistB_id, artistA_id])
+	if not res:
 		return []
+	path: List[ArtistID] = [str(i, 'utf-8') for i in res[1:]]
+	# artistA's tree gives the path from artistB back to artistA
+	if res[0] == 1:
+		return path[::-1]
+	return path
+
+
+# get cached artist dicts for many artists in one MGET
+# only artists found in the cache are included in the result
+@redis_command({})
+async def get_artist_dicts_many(artist_ids: List[ArtistID]) -> Dict[ArtistID, Dict]:
+	vals: List[bytes] = await clients.redis.mget(*[ARTIST_DICT_KEY_PREFIX + i for i in artist_ids])
+	res: Dict[ArtistID, Dict] = {}
+	for artist_id, val in zip(artist_ids, vals):
+		if val:
+			res[artist_id] = json.loads(str(val, 'utf-8'))
+	return res
+
+
+@redis_command(False)
+async def store_artist_dicts_many(artist_dicts: Dict[ArtistID, Dict], ttl: float) -> bool:
+	if not artist_dicts:
+		return False
+	pipe = clients.redis.pipeline()
+	for artist_id, artist_dict in artist_dicts.items():
+		pipe.setex(ARTIST_DICT_KEY_PREFIX + artist_id, int(ttl), json.dumps(artist_dict))
+	await pipe.execute()
+	return True
+
+
+@redis_command([])
+async def get_longest_path() -> List[ArtistID]:
 	key = LONGEST_CONNECTION_KEY
-	longest_path_key = str(clients.redis.get(key), 'utf-8')
+	longest_path_key = await clients.redis.get(key)
 	if not longest_path_key:
 		return []
 	else:
-		val = clients.redis.lrange(longest_path_key, 0, -1)
+		val = await clients.redis.lrange(str(longest_path_key, 'utf-8'), 0, -1)
 		result: List[ArtistID] = [str(id, 'utf-8') for id in val]
 		return result
 
 
-# stores key of longest path
-def store_longest_path(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
-	if not redis_connected():
-		return False
+# stores key of longest path (run after store_connection_length, which ranks connections by length)
+@redis_command(False)
+async def store_longest_path(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
 	key = LONGEST_CONNECTION_KEY
-	longest_path = get_longest_path()
-
-	if len(path) >= len(longest_path):
-		new_longest_path_key, reverse = get_connection_key(artist1_id, artist2_id)
-		if reverse:
-			path = path[::-1]
-		previous_val = str(clients.redis.get(key), 'utf-8')
-		if previous_val != new_longest_path_key:
-			clients.redis.set(key, new_longest_path_key)
-			return True
+	connection_key, _ = get_connection_key(artist1_id, artist2_id)
+	longest: List[bytes] = await clients.redis.zrevrange(CONNECTION_LENGTHS_RANK_KEY, 0, 0)
+	if longest and str(longest[0], 'utf-8') == connection_key:
+		previous_val = await clients.redis.getset(key, connection_key)
+		return previous_val is None or str(previous_val, 'utf-8') != connection_key
 	return False
 
 
-def get_artist_search_count(artist_id: ArtistID) -> int:
+async def get_artist_search_count(artist_id: ArtistID) -> int:
 	pass
 
 
-def get_top_artists(max_results: int=5) -> List[ArtistID]:
-	if not redis_connected():
-		return []
-	artist_data = clients.redis.hgetall(ARTIST_SEARCHES_KEY)
-	artist_pairs = []
-	for k, v in artist_data.items():
-		artist_pairs.append([v,k]) # create pairs [value, key] so value can be sorted
-	artist_pairs.sort(reverse=True)
-	top_artist_ids = [str(p[1],'utf-8') for p in artist_pairs[:max_results]]
-	return top_artist_ids
+@redis_command([])
+async def get_top_artists(max_results: int=5) -> List[ArtistID]:
+	top: List[bytes] = await clients.redis.zrevrange(ARTIST_SEARCHES_RANK_KEY, 0, max_results - 1)
+	return [str(i, 'utf-8') for i in top]
 
 
 # only do this for unique/new paths
-def increase_artist_search_count(artist_id: ArtistID) -> bool:
-	if not redis_connected():
-		return False
-	stat_key = ARTIST_SEARCHES_KEY
-	if clients.redis.hincrby(stat_key, artist_id, 1):
-		return True
-	return False
+@redis_command(False)
+async def increase_artist_search_count(artist_id: ArtistID) -> bool:
+	tr = clients.redis.multi_exec()
+	tr.hincrby(ARTIST_SEARCHES_KEY, artist_id, 1)
+	tr.zincrby(ARTIST_SEARCHES_RANK_KEY, 1, artist_id)
+	count, _ = await tr.execute()
+	return bool(count)
 
 
-def get_top_connections(max_results: int=5) -> List[str]:
-	if not redis_connected():
-		return []
-	connection_data = clients.redis.hgetall(CONNECTION_SEARCHES_KEY)
-	connection_pairs = []
-	for k, v in connection_data.items():
-		connection_pairs.append([v, k])  # create pairs [value, key] so value can be sorted
-	connection_pairs.sort(reverse=True)
-	top_connection_keys = [str(p[1], 'utf-8') for p in connection_pairs[:max_results]]
-	return top_connection_keys
+@redis_command([])
+async def get_top_connections(max_results: int=5) -> List[str]:
+	top: List[bytes] = await clients.redis.zrevrange(CONNECTION_SEARCHES_RANK_KEY, 0, max_results - 1)
+	return [str(i, 'utf-8') for i in top]
 
 
-def get_nonexistent_connections(max_results: int=5) -> List[str]:
-	if not redis_connected():
-		return []
-	connection_data = clients.redis.hgetall(CONNECTION_LENGTHS_KEY)
-	connection_pairs = []
-	for k, v in connection_data.items():
-		if v == 0:
-			connection_pairs.append(k)  # create pairs [value, key] so value can be sorted
-	nonexistent_connection_keys = [str(i, 'utf-8') for i in connection_pairs[:max_results]]
-	return nonexistent_connection_keys
+# most recently searched connections with no path
+@redis_command([])
+async def get_nonexistent_connections(max_results: int=5) -> List[str]:
+	recent: List[bytes] = await clients.redis.zrevrange(NONEXISTENT_CONNECTIONS_KEY, 0, max_results - 1)
+	return [str(i, 'utf-8') for i in recent]
 
 
-def get_number_connections_searched() -> int:
-	if not redis_connected():
-		return -1
-	return clients.redis.hlen(CONNECTION_LENGTHS_KEY)
+@redis_command(-1)
+async def get_number_connections_searched() -> int:
+	return await clients.redis.hlen(CONNECTION_LENGTHS_KEY)
 
 
-def get_average_degrees_of_separation() -> float:
-	if not redis_connected():
-		return 0
-	connection_lengths = list(map(lambda x: int(x)-1, clients.redis.hvals(CONNECTION_LENGTHS_KEY)))
-	if len(connection_lengths) == 0:
+@redis_command(0)
+async def get_average_degrees_of_separation() -> float:
+	degrees_sum, connections_count = await clients.redis.mget(DEGREES_SUM_KEY, CONNECTIONS_COUNT_KEY)
+	if not connections_count or int(connections_count) == 0:
 		return 0
-	return sum(connection_lengths)/len(connection_lengths)
+	return int(degrees_sum or 0)/int(connections_count)
 
 
-def get_connection_search_count(artist1_id: ArtistID, artist2_id: ArtistID) -> int:
+async def get_connection_search_count(artist1_id: ArtistID, artist2_id: ArtistID) -> int:
 	pass
 
 
-def increase_connection_search_count(artist1_id: ArtistID, artist2_id: ArtistID) -> bool:
-	if not redis_connected():
-		return False
-	stat_key = CONNECTION_SEARCHES_KEY
+@redis_command(False)
+async def increase_connection_search_count(artist1_id: ArtistID, artist2_id: ArtistID) -> bool:
 	connection_key, _ = get_connection_key(artist1_id, artist2_id)
-	if clients.redis.hincrby(stat_key, connection_key, 1):
-		return True
-	return False
+	tr = clients.redis.multi_exec()
+	tr.hincrby(CONNECTION_SEARCHES_KEY, connection_key, 1)
+	tr.zincrby(CONNECTION_SEARCHES_RANK_KEY, 1, connection_key)
+	count, _ = await tr.execute()
+	return bool(count)
 
 
-def get_connection_length(artist1_id: ArtistID, artist2_id: ArtistID) -> int:
+async def get_connection_length(artist1_id: ArtistID, artist2_id: ArtistID) -> int:
 	pass
 
 
-def store_connection_length(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
-	if not redis_connected():
-		return False
-	stat_key = CONNECTION_LENGTHS_KEY
+# record a connection's length (number of artists in the path, 0 if there is none) and update the aggregates
+# atomically: the degrees sum/count and length ranking for connections that exist, the nonexistent set otherwise
+# a connection is only counted once, except that a nonexistent one may later be found
+STORE_CONNECTION_LENGTH_SCRIPT: str = """
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+local length = tonumber(ARGV[2])
+if previous and (tonumber(previous) ~= 0 or length == 0) then
+	return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], length)
+if length == 0 then
+	redis.call('ZADD', KEYS[5], ARGV[3], ARGV[1])
+else
+	redis.call('ZREM', KEYS[5], ARGV[1])
+	redis.call('INCRBY', KEYS[2], length - 1)
+	redis.call('INCR', KEYS[3])
+	redis.call('ZADD', KEYS[4], length, ARGV[1])
+end
+return 1
+"""
+
+
+@redis_command(False)
+async def store_connection_length(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
 	connection_key, _ = get_connection_key(artist1_id, artist2_id)
-	if clients.redis.hset(stat_key, connection_key, len(path)):
+	keys = [CONNECTION_LENGTHS_KEY, DEGREES_SUM_KEY, CONNECTIONS_COUNT_KEY, CONNECTION_LENGTHS_RANK_KEY, NONEXISTENT_CONNECTIONS_KEY]
+	if await clients.redis.eval(STORE_CONNECTION_LENGTH_SCRIPT, keys=keys, args=[connection_key, len(path), time()]):
 		return True
 	else:
 		print("Value already existed in hash")
 		return False
 
-# all stats to run when new unique connection is found
-def new_connection_stats(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
+
+# all stats to run when new unique connection is found (path is empty if there is no connection)
+async def new_connection_stats(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
 	if not redis_connected():
 		return False
 	good = True
-	if not store_path(artist1_id, artist2_id, path):
+	if path and not await store_path(artist1_id, artist2_id, path):
 		print("Error storing path. May have already been stored")
 		good = False
-	if store_longest_path(artist1_id, artist2_id, path):
-		print("New longest path")
-		good = False
-	if not store_connection_length(artist1_id, artist2_id, path):
+	if not await store_connection_length(artist1_id, artist2_id, path):
 		print("Error storing connection length")
 		good = False
-	if not increase_connection_search_count(artist1_id, artist2_id):
+	if path and await store_longest_path(artist1_id, artist2_id, path):
+		print("New longest path")
+		good = False
+	if not await increase_connection_search_count(artist1_id, artist2_id):
 		print("Error increasing connection search count")
 		good = False
-	if not increase_artist_search_count(artist1_id):
+	if not await increase_artist_search_count(artist1_id):
 		print("Error increasing artist {} search count".format(artist1_id))
 		good = False
-	if not increase_artist_search_count(artist2_id):
+	if not await increase_artist_search_count(artist2_id):
 		print("Error increasing artist {} search count".format(artist2_id))
 		good = False
 	return good
 
 
-def cached_connection_stats(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
+async def cached_connection_stats(artist1_id: ArtistID, artist2_id: ArtistID, path: List[ArtistID]) -> bool:
 	if not redis_connected():
 		return False
 	good = True
-	if not increase_connection_search_count(artist1_id, artist2_id):
+	if not await increase_connection_search_count(artist1_id, artist2_id):
 		print("Error increasing connection search count")
 		good = False
-	return good
\ No newline at end of file
+	return good
+
+
+# build the rankings and aggregates from the stats hashes, for data recorded before they were maintained
+# runs once per STATS_INDEXES_VERSION; rebuilding is idempotent, so workers starting together may both do it
+# (not wrapped in redis_command, since the one-off rebuild may take longer than the command timeout)
+async def ensure_stats_indexes() -> bool:
+	if not redis_connected():
+		return False
+	try:
+		version = await clients.redis.get(STATS_INDEXES_VERSION_KEY)
+		if version is not None and str(version, 'utf-8') == STATS_INDEXES_VERSION:
+			return False
+		await rebuild_stats_indexes()
+		await clients.redis.set(STATS_INDEXES_VERSION_KEY, STATS_INDEXES_VERSION)
+	except (RedisError, OSError) as e:
+		print("Error building stats indexes: {!r}".format(e))
+		health.record_failure()
+		return False
+	return True
+
+
+async def rebuild_stats_indexes():
+	pipe = clients.redis.pipeline()
+	pipe.hgetall(ARTIST_SEARCHES_KEY)
+	pipe.hgetall(CONNECTION_SEARCHES_KEY)
+	pipe.hgetall(CONNECTION_LENGTHS_KEY)
+	artist_searches, connection_searches, connection_lengths = await pipe.execute()
+
+	degrees_sum = 0
+	connections_count = 0
+	tr = clients.redis.multi_exec()
+	tr.delete(ARTIST_SEARCHES_RANK_KEY, CONNECTION_SEARCHES_RANK_KEY, CONNECTION_LENGTHS_RANK_KEY, NONEXISTENT_CONNECTIONS_KEY)
+	for k, v in artist_searches.items():
+		tr.zadd(ARTIST_SEARCHES_RANK_KEY, int(v), k)
+	for k, v in connection_searches.items():
+		tr.zadd(CONNECTION_SEARCHES_RANK_KEY, int(v), k)
+	for k, v in connection_lengths.items():
+		if int(v) == 0:
+			tr.zadd(NONEXISTENT_CONNECTIONS_KEY, 0, k)
+		else:
+			tr.zadd(CONNECTION_LENGTHS_RANK_KEY, int(v), k)
+			degrees_sum += int(v) - 1
+			connections_count += 1
+	tr.set(DEGREES_SUM_KEY, degrees_sum)
+	tr.set(CONNECTIONS_COUNT_KEY, connections_count)
+	await tr.execute()
+	print("Built stats indexes for {} connections".format(len(connection_lengths)))
@@ -1,2 +1,53 @@
+import os
+import urllib.parse as urlparse
+
+import aioredis
+
+import src.settings as settings
+
 redis = None
 spotify = None
+# memory-mapped graph snapshot (src.snapshot.GraphSnapshot), if one is configured
+snapshot = None
+# landmark distance oracle for the snapshot (src.landmarks.LandmarkOracle), if its landmarks have been built
+landmarks = None
+# runs snapshot searches off the event loop (src.snapshot.SearchPool) while a snapshot is loaded
+search_pool = None
+
+
+# create the asyncio Redis connection pool (must run inside the event loop), raising if Redis can't be reached
+async def connect_redis():
+	global redis
+	redis_url = None
+	try:
+		redis_url = os.environ['REDISCLOUD_URL']
+	except KeyError as e:
+		pass
+
+	address = ('localhost', 6379)
+	password = None
+	if redis_url:
+		url = urlparse.urlparse(redis_url)
+		address = (url.hostname, url.port)
+		password = url.password
+
+	redis = await aioredis.create_redis_pool(address, password=password, minsize=settings.REDIS_POOL_MIN_SIZE, maxsize=settings.REDIS_POOL_MAX_SIZE, timeout=settings.REDIS_COMMAND_TIMEOUT)
+
+
+# connect at startup, leaving redis as None if Redis is down (src/cache.py's health probe connects once it is back)
+async def init_redis():
+	# already connected, e.g. to the fake Redis the benchmarks install
+	if redis is not None:
+		return
+	try:
+		await connect_redis()
+	except (aioredis.RedisError, OSError) as e:
+		print("Could not connect to Redis server: {}".format(e))
+
+
+async def close_redis():
+	global redis
+	if redis is not None:
+		redis.close()
+		await redis.wait_closed()
+		redis = None
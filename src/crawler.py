@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import spotify
+from spotify.errors import SpotifyException
+
+from src.custom_types import *
+import src.cache as cache
+import src.clients as clients
+import src.metadata as metadata
+import src.settings as settings
+import src.snapshot as snapshot
+import src.transport as transport
+
+"""
+Offline crawler that fills the related artists cache (and a graph snapshot) ahead of user searches.
+
+Crawls breadth-first outward from seed artists with a bounded number of requests in flight. Rate limiting is
+handled by the transport: a 429 pauses every request until Retry-After has passed. Progress is checkpointed to
+a JSON file, so an interrupted crawl resumes where it left off.
+
+python -m src.crawler --preset 2010s --max-depth 3 --checkpoint crawl.json --snapshot graph/
+"""
+
+# seeds from the decade lists in src/main.py
+PRESETS: Dict[str, List[str]] = {
+	'1960s': ['Beatles', 'Rolling Stones', 'Bob Dylan', 'Led Zeppelin', 'Johnny Hallyday', 'Bee Gees', 'Pink Floyd', 'Cher', 'Fleetwood Mac', 'Jackson 5'],
+	'1980s': ['Michael Jackson', 'Madonna', 'u2', 'queen', 'ac/dc', 'bruce springsteen', 'bon jovi', 'george michael', 'billy joel', 'Guns n Roses'],
+	'1990s': ['celine dion', 'mariah carey', 'whitney houston', 'nirvana', 'michael jackson', 'backstreet boys', 'metallica', 'madonna', 'shania twain', 'guns n roses'],
+	'2000s': ['eminem', 'linkin park', 'britney spears', 'coldplay', 'p!nk', 'norah jones', 'nickelback', 'beyonce', 'black eyed peas', 'alicia keys'],
+	'2010s': ['adele', 'drake', 'rihanna', 'bruno mars', 'ed sheeran', 'one direction', 'justin bieber', 'taylor swift', 'eminem', 'katy perry'],
+}
+
+
+class Crawler:
+	def __init__(self, client: transport.SpotifyClient, max_depth: int=3, max_artists: int=0, concurrency: int=8, checkpoint_path: str="", checkpoint_every: int=500, use_redis: bool=True):
+		self.client = client
+		self.max_depth = max_depth
+		# stop discovering new artists after this many (0 for no limit)
+		self.max_artists = max_artists
+		self.concurrency = concurrency
+		self.checkpoint_path = checkpoint_path
+		self.checkpoint_every = checkpoint_every
+		self.use_redis = use_redis
+
+		# depth of every artist discovered so far
+		self.depths: Dict[ArtistID, int] = {}
+		# related artists of every artist crawled so far
+		self.related: Dict[ArtistID, List[ArtistID]] = {}
+		self.queue: Optional[asyncio.Queue] = None
+		self.since_checkpoint = 0
+		self.errors = 0
+
+	def add(self, artist_id: ArtistID, depth: int):
+		if artist_id in self.depths:
+			return
+		if self.max_artists and len(self.depths) >= self.max_artists:
+			return
+		self.depths[artist_id] = depth
+		self.queue.put_nowait(artist_id)
+
+	# artists discovered but not crawled yet
+	def pending(self) -> List[ArtistID]:
+		return [i for i in self.depths if i not in self.related]
+
+	def load_checkpoint(self) -> bool:
+		if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+			return False
+		with open(self.checkpoint_path) as f:
+			state = json.load(f)
+		self.depths = state['depths']
+		self.related = state['related']
+		print("Resuming crawl: {} artists crawled, {} pending".format(len(self.related), len(self.pending())))
+		return True
+
+	def save_checkpoint(self):
+		if not self.checkpoint_path:
+			return
+		tmp_path = self.checkpoint_path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({'depths': self.depths, 'related': self.related}, f)
+		os.replace(tmp_path, self.checkpoint_path)
+		self.since_checkpoint = 0
+
+	async def resolve_seed(self, seed: str) -> Optional[ArtistID]:
+		# treat anything that looks like a Spotify ID as one
+		if len(seed) == snapshot.ARTIST_ID_LENGTH and seed.isalnum():
+			return seed
+		res = await self.client.search(seed, types=['artist'], limit=1)
+		if not res['artists']:
+			print("No artist found named " + seed)
+			return None
+		return res['artists'][0].id
+
+	async def fetch(self, artist_id: ArtistID) -> Optional[List[ArtistID]]:
+		# left pending on failure, so a resumed crawl retries it
+		try:
+			related = await self.client.http.artist_related_artists(artist_id)
+		except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+			print("Error getting related artists of {}: {!r}".format(artist_id, e))
+			self.errors += 1
+			return None
+		# read before building Artist objects, which take the IDs out of the dicts
+		related_ids: List[ArtistID] = [a['id'] for a in related['artists']]
+		await metadata.remember_artist_dicts([metadata.generate_artist_dict(spotify.Artist(self.client, a)) for a in related['artists']])
+		return related_ids
+
+	async def worker(self):
+		while True:
+			artist_id = await self.queue.get()
+			try:
+				await self.crawl(artist_id)
+			except Exception as e:
+				# a dead worker would leave the queue never finishing
+				print("Error crawling {}: {!r}".format(artist_id, e))
+				self.errors += 1
+			finally:
+				self.queue.task_done()
+
+	async def crawl(self, artist_id: ArtistID):
+		related_ids = await self.fetch(artist_id)
+		if related_ids is None:
+			return
+		self.related[artist_id] = related_ids
+		if self.use_redis:
+			await cache.store_related_artists(artist_id, related_ids)
+		depth = self.depths[artist_id]
+		if depth < self.max_depth:
+			for i in related_ids:
+				self.add(i, depth + 1)
+		self.since_checkpoint += 1
+		if self.since_checkpoint >= self.checkpoint_every:
+			self.save_checkpoint()
+			print("Crawled {} artists, {} pending".format(len(self.related), self.queue.qsize()))
+
+	async def run(self, seeds: List[str]) -> Dict[ArtistID, List[ArtistID]]:
+		self.queue = asyncio.Queue()
+		if self.load_checkpoint():
+			for i in self.pending():
+				self.queue.put_nowait(i)
+		else:
+			for seed in seeds:
+				artist_id = await self.resolve_seed(seed)
+				if artist_id:
+					self.add(artist_id, 0)
+
+		workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+		try:
+			await self.queue.join()
+		finally:
+			for w in workers:
+				w.cancel()
+			await asyncio.gather(*workers, return_exceptions=True)
+			self.save_checkpoint()
+		print("Crawl finished: {} artists crawled, {} errors".format(len(self.related), self.errors))
+		return self.related
+
+
+async def main(args):
+	seeds: List[str] = list(args.seed)
+	for preset in args.preset:
+		seeds += PRESETS[preset]
+
+	use_redis = not args.no_redis
+	if use_redis:
+		await clients.init_redis()
+		use_redis = clients.redis is not None
+
+	client = transport.create_client(os.environ.get("SIX_DEGREES_CLIENT_ID"), os.environ.get("SIX_DEGREES_CLIENT_SECRET"))
+	crawler = Crawler(client, max_depth=args.max_depth, max_artists=args.max_artists, concurrency=args.concurrency, checkpoint_path=args.checkpoint, checkpoint_every=args.checkpoint_every, use_redis=use_redis)
+	try:
+		related = await crawler.run(seeds)
+	finally:
+		await client.close()
+		if use_redis:
+			await clients.close_redis()
+
+	if args.snapshot:
+		snapshot.write(args.snapshot, related)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Crawl the related artists graph outward from seed artists")
+	parser.add_argument('--seed', action='append', default=[], help="artist name or Spotify ID (repeatable)")
+	parser.add_argument('--preset', action='append', default=[], choices=sorted(PRESETS), help="decade seed list (repeatable)")
+	parser.add_argument('--max-depth', type=int, default=3, help="hops from the seeds to crawl")
+	parser.add_argument('--max-artists', type=int, default=0, help="stop discovering artists after this many (0 for no limit)")
+	parser.add_argument('--concurrency', type=int, default=settings.SEARCH_CONCURRENCY, help="requests in flight")
+	parser.add_argument('--checkpoint', default="", help="JSON file to save progress to and resume from")
+	parser.add_argument('--checkpoint-every', type=int, default=500, help="artists crawled between checkpoints")
+	parser.add_argument('--snapshot', default="", help="graph snapshot directory to write when done")
+	parser.add_argument('--no-redis', action='store_true', help="don't write related artists to Redis")
+	args = parser.parse_args()
+
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(main(args))
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+from aiohttp import web
+
+from src.transport import recording_key
+
+"""
+Local fake of the parts of the Spotify Web API this project uses, for testing the crawler and app offline.
+
+It serves a graph from a JSON file:
+
+{
+	"artists": {<ArtistID>: {"name": ..., "followers": ..., "popularity": ..., "genres": [...]}},
+	"related": {<ArtistID>: [<ArtistID>, ...]}
+}
+
+Point the app or crawler at it with
+SIX_DEGREES_SPOTIFY_API_URL=http://localhost:<port>/v1 and SIX_DEGREES_SPOTIFY_TOKEN_URL=http://localhost:<port>/api/token
+
+Responses recorded from the real API (see SIX_DEGREES_SPOTIFY_RECORD_PATH in src/transport.py) can be replayed
+with --recorded; requests without a recorded response are answered from the graph.
+
+It can also throttle like Spotify does, answering 429 with a Retry-After header for a random fraction of API
+requests (--throttle-rate) and for any request beyond a number already in flight (--max-concurrency). Tokens put in
+`revoked` are answered with 401, as Spotify does once a token expires.
+"""
+
+
+class FakeSpotify:
+	def __init__(self, graph: Dict, latency: float=0, throttle_rate: float=0, max_concurrency: int=0, retry_after: float=1, seed: int=None):
+		self.artists: Dict[str, Dict] = graph.get('artists', {})
+		self.related: Dict[str, List[str]] = graph.get('related', {})
+		# seconds added to every API response
+		self.latency = latency
+		# fraction of API requests answered with 429, and requests in flight above which every request is (0 for none)
+		self.throttle_rate = throttle_rate
+		self.max_concurrency = max_concurrency
+		# Retry-After seconds sent with a 429
+		self.retry_after = retry_after
+		self.random = random.Random(seed)
+		self.in_flight = 0
+		# recorded response bodies by recording key
+		self.recorded: Dict[str, Dict] = {}
+		# access tokens handed out so far, and those no longer accepted
+		self.tokens_issued = 0
+		self.revoked: Set[str] = set()
+		# requests served, by endpoint (429s are counted under "throttled", 401s under "unauthorized", replays under
+		# "recorded")
+		self.requests = Counter()
+
+	def artist_object(self, artist_id: str) -> Optional[Dict]:
+		if artist_id not in self.artists and artist_id not in self.related:
+			return None
+		info = self.artists.get(artist_id, {})
+		return {
+			'id': artist_id,
+			'type': 'artist',
+			'uri': 'spotify:artist:' + artist_id,
+			'href': 'https://api.spotify.com/v1/artists/' + artist_id,
+			'external_urls': {'spotify': 'https://open.spotify.com/artist/' + artist_id},
+			'name': info.get('name', artist_id),
+			'genres': info.get('genres', []),
+			'followers': {'href': None, 'total': info.get('followers', 0)},
+			'popularity': info.get('popularity', 0),
+			'images': info.get('images', []),
+		}
+
+	async def respond(self, endpoint: str, body: Dict, status: int=200) -> web.Response:
+		throttled = self.random.random() < self.throttle_rate or 0 < self.max_concurrency <= self.in_flight
+		if throttled:
+			self.requests['throttled'] += 1
+			body = {'error': {'status': 429, 'message': 'API rate limit exceeded'}}
+			return web.json_response(body, status=429, headers={'Retry-After': str(self.retry_after)})
+		self.requests[endpoint] += 1
+		self.in_flight += 1
+		try:
+			if self.latency:
+				await asyncio.sleep(self.latency)
+		finally:
+			self.in_flight -= 1
+		return web.json_response(body, status=status)
+
+	async def token(self, request: web.Request) -> web.Response:
+		self.requests['token'] += 1
+		self.tokens_issued += 1
+		return web.json_response({'access_token': 'fake-token-{}'.format(self.tokens_issued), 'token_type': 'Bearer', 'expires_in': 3600})
+
+	async def artist(self, request: web.Request) -> web.Response:
+		artist = self.artist_object(request.match_info['artist_id'])
+		if artist is None:
+			return await self.respond('artist', {'error': {'status': 404, 'message': 'non existing id'}}, 404)
+		return await self.respond('artist', artist)
+
+	async def several_artists(self, request: web.Request) -> web.Response:
+		ids = [i for i in request.query.get('ids', '').split(',') if i]
+		if len(ids) > 50:
+			return await self.respond('artists', {'error': {'status': 400, 'message': 'Too many ids requested'}}, 400)
+		return await self.respond('artists', {'artists': [self.artist_object(i) for i in ids]})
+
+	async def related_artists(self, request: web.Request) -> web.Response:
+		artist_id = request.match_info['artist_id']
+		if self.artist_object(artist_id) is None:
+			return await self.respond('related-artists', {'error': {'status': 404, 'message': 'non existing id'}}, 404)
+		related = [self.artist_object(i) for i in self.related.get(artist_id, [])]
+		return await self.respond('related-artists', {'artists': related})
+
+	async def search(self, request: web.Request) -> web.Response:
+		query = request.query.get('q', '').replace('+', ' ').lower()
+		limit = int(request.query.get('limit', 20))
+		offset = int(request.query.get('offset', 0))
+		matches = [self.artist_object(i) for i, info in self.artists.items() if query in info.get('name', i).lower()]
+		matches.sort(key=lambda a: -a['followers']['total'])
+		items = matches[offset:offset + limit]
+		return await self.respond('search', {'artists': {'items': items, 'total': len(matches), 'limit': limit, 'offset': offset}})
+
+	async def stats(self, request: web.Request) -> web.Response:
+		return web.json_response(dict(self.requests))
+
+	@web.middleware
+	async def authorize(self, request: web.Request, handler) -> web.Response:
+		if self.revoked and request.path.startswith('/v1/'):
+			if request.headers.get('Authorization', '')[len('Bearer '):] in self.revoked:
+				self.requests['unauthorized'] += 1
+				return web.json_response({'error': {'status': 401, 'message': 'The access token expired'}}, status=401)
+		return await handler(request)
+
+	@web.middleware
+	async def replay(self, request: web.Request, handler) -> web.Response:
+		if self.recorded and request.path.startswith('/v1/'):
+			body = self.recorded.get(recording_key(request.path[len('/v1'):], dict(request.query)))
+			if body is not None:
+				return await self.respond('recorded', body)
+		return await handler(request)
+
+	def create_app(self) -> web.Application:
+		app = web.Application(middlewares=[self.authorize, self.replay])
+		app.add_routes([
+			web.post('/api/token', self.token),
+			web.get('/v1/artists', self.several_artists),
+			web.get('/v1/artists/{artist_id}', self.artist),
+			web.get('/v1/artists/{artist_id}/related-artists', self.related_artists),
+			web.get('/v1/search', self.search),
+			web.get('/stats', self.stats),
+		])
+		return app
+
+
+def load_graph(path: str) -> Dict:
+	with open(path) as f:
+		return json.load(f)
+
+
+# recorded response bodies by recording key, from a file of JSON lines (later recordings of a request win)
+def load_recording(path: str) -> Dict[str, Dict]:
+	recorded: Dict[str, Dict] = {}
+	with open(path) as f:
+		for line in f:
+			if line.strip():
+				entry = json.loads(line)
+				recorded[entry['key']] = entry['body']
+	return recorded
+
+
+# start serving in the running event loop; returns the runner so the caller can clean it up
+async def start(fake: FakeSpotify, host: str='localhost', port: int=8081) -> web.AppRunner:
+	runner = web.AppRunner(fake.create_app())
+	await runner.setup()
+	site = web.TCPSite(runner, host, port)
+	await site.start()
+	return runner
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Serve a fake Spotify Web API from a graph file")
+	parser.add_argument('graph', nargs='?', default="", help="JSON graph file")
+	parser.add_argument('--recorded', default="", help="JSON lines file of recorded responses to replay")
+	parser.add_argument('--host', default='localhost')
+	parser.add_argument('--port', type=int, default=8081)
+	parser.add_argument('--latency', type=float, default=0, help="seconds added to every API response")
+	parser.add_argument('--throttle-rate', type=float, default=0, help="fraction of API requests answered with 429")
+	parser.add_argument('--max-concurrency', type=int, default=0, help="answer 429 beyond this many requests in flight (0 for no limit)")
+	parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with a 429")
+	args = parser.parse_args()
+
+	fake = FakeSpotify(load_graph(args.graph) if args.graph else {}, latency=args.latency, throttle_rate=args.throttle_rate, max_concurrency=args.max_concurrency, retry_after=args.retry_after)
+	if args.recorded:
+		fake.recorded = load_recording(args.recorded)
+	web.run_app(fake.create_app(), host=args.host, port=args.port)
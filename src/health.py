@@ -0,0 +1,60 @@
+import asyncio
+from typing import Awaitable, Callable, Optional, Tuple, Type
+
+
+# tracks availability of a backing service from the outcome of real commands
+# after `failure_threshold` consecutive failures the circuit opens: callers should fail fast,
+# and a background task probes the service every `probe_interval` seconds until it responds again
+class CircuitBreaker:
+	def __init__(self, name: str, probe: Callable[[], Awaitable], errors: Tuple[Type[BaseException], ...], failure_threshold: int=3, probe_interval: float=5.0):
+		self.name = name
+		self.probe = probe
+		self.errors = errors
+		self.failure_threshold = failure_threshold
+		self.probe_interval = probe_interval
+		self.consecutive_failures = 0
+		self.is_open = False
+		self.probe_task: Optional[asyncio.Task] = None
+
+	def available(self) -> bool:
+		return not self.is_open
+
+	def record_success(self):
+		self.consecutive_failures = 0
+
+	def record_failure(self):
+		self.consecutive_failures += 1
+		if not self.is_open and self.consecutive_failures >= self.failure_threshold:
+			self.trip()
+
+	# open the circuit and start probing in the background
+	def trip(self):
+		if not self.is_open:
+			print("{} unavailable, failing fast until it recovers".format(self.name))
+		self.is_open = True
+		if self.probe_task is None or self.probe_task.done():
+			self.probe_task = asyncio.ensure_future(self.probe_until_available())
+
+	def reset(self):
+		if self.is_open:
+			print("{} available again".format(self.name))
+		self.is_open = False
+		self.consecutive_failures = 0
+
+	async def probe_until_available(self):
+		while self.is_open:
+			await asyncio.sleep(self.probe_interval)
+			try:
+				await self.probe()
+			except self.errors:
+				continue
+			self.reset()
+
+	async def close(self):
+		if self.probe_task is not None and not self.probe_task.done():
+			self.probe_task.cancel()
+			try:
+				await self.probe_task
+			except asyncio.CancelledError:
+				pass
+		self.probe_task = None
@@ -0,0 +1,181 @@
+import argparse
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from src.custom_types import *
+import src.snapshot as snapshot
+
+"""
+Landmark distance oracle over a graph snapshot.
+
+A precomputation job runs a full BFS from each of K landmark artists (well connected hubs, kept apart from each
+other) over the snapshot's graph, with related-artist links followed both ways as if they were all mutual (see
+src/search.py), and stores the distance and parent arrays next to the snapshot:
+
+landmarks.npy 				-> int32[K] indices of the landmark artists
+landmark_distances.npy 		-> uint8[K, N] hops from each landmark (255 if unreachable)
+landmark_parents.npy 		-> int32[K, N] next artist on a shortest path back to each landmark (-1 if unreachable)
+
+For any two artists the landmarks give, without searching, an upper bound on their degrees of separation (through
+the best landmark, along with that path) and a lower bound by the triangle inequality. The lower bound only holds
+within the snapshot's graph, since artists that were never crawled may add shortcuts; the upper bound is a real path.
+
+Rerun this after rebuilding the snapshot, which replaces the whole directory:
+python -m src.landmarks graph/ --count 16
+"""
+
+LANDMARKS_FILE: str = "landmarks.npy"
+DISTANCES_FILE: str = "landmark_distances.npy"
+PARENTS_FILE: str = "landmark_parents.npy"
+
+UNREACHABLE: int = 255
+
+
+class LandmarkOracle:
+	def __init__(self, graph: snapshot.GraphSnapshot):
+		self.graph = graph
+		self.landmarks: np.ndarray = np.load(os.path.join(graph.path, LANDMARKS_FILE), mmap_mode='r')
+		self.distances: np.ndarray = np.load(os.path.join(graph.path, DISTANCES_FILE), mmap_mode='r')
+		self.parents: np.ndarray = np.load(os.path.join(graph.path, PARENTS_FILE), mmap_mode='r')
+		if self.distances.shape != (len(self.landmarks), len(graph)):
+			raise ValueError("landmark arrays don't match the snapshot")
+
+	def __len__(self) -> int:
+		return len(self.landmarks)
+
+	# distances from every landmark to both artists, for landmarks that reach both; None if either is unknown
+	def pair_distances(self, source: ArtistID, target: ArtistID) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+		source_index = self.graph.index(source)
+		target_index = self.graph.index(target)
+		if source_index < 0 or target_index < 0:
+			return None
+		source_distances = self.distances[:, source_index].astype(np.int32)
+		target_distances = self.distances[:, target_index].astype(np.int32)
+		reached = (source_distances != UNREACHABLE) & (target_distances != UNREACHABLE)
+		if not reached.any():
+			return None
+		return np.flatnonzero(reached), source_distances[reached], target_distances[reached]
+
+	# (lower, upper) bounds on the degrees of separation of two artists, or None if no landmark reaches both
+	def bounds(self, source: ArtistID, target: ArtistID) -> Optional[Tuple[int, int]]:
+		distances = self.pair_distances(source, target)
+		if distances is None:
+			return None
+		_, source_distances, target_distances = distances
+		return int(np.abs(source_distances - target_distances).max()), int((source_distances + target_distances).min())
+
+	# a path between two artists through the landmark giving the upper bound, or an empty path if there is none
+	def path(self, source: ArtistID, target: ArtistID) -> List[ArtistID]:
+		distances = self.pair_distances(source, target)
+		if distances is None:
+			return []
+		landmarks, source_distances, target_distances = distances
+		k = int(landmarks[np.argmin(source_distances + target_distances)])
+		to_source = self.trace(k, self.graph.index(source))
+		to_target = self.trace(k, self.graph.index(target))
+		# both halves start at the landmark; join them where they split, which cuts out any shared detour
+		shared = 0
+		while shared + 1 < min(len(to_source), len(to_target)) and to_source[shared + 1] == to_target[shared + 1]:
+			shared += 1
+		path = to_source[shared:][::-1] + to_target[shared + 1:]
+		return [self.graph.artist_id(i) for i in path]
+
+	# path from landmark k to an artist index
+	def trace(self, k: int, index: int) -> List[int]:
+		parents = self.parents[k]
+		path: List[int] = [index]
+		while parents[path[-1]] != path[-1]:
+			path.append(int(parents[path[-1]]))
+		path.reverse()
+		return path
+
+
+# the snapshot's graph with every edge in both directions, as CSR (offsets, neighbors)
+def undirected(graph: snapshot.GraphSnapshot) -> Tuple[np.ndarray, np.ndarray]:
+	counts = np.diff(graph.offsets)
+	sources = np.repeat(np.arange(len(graph), dtype=np.int32), counts)
+	targets = np.asarray(graph.neighbors, dtype=np.int32)
+	all_sources = np.concatenate([sources, targets])
+	all_targets = np.concatenate([targets, sources])
+	order = np.argsort(all_sources, kind='stable')
+	offsets = np.zeros(len(graph) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum(np.bincount(all_sources, minlength=len(graph)))
+	return offsets, all_targets[order]
+
+
+# level-synchronous BFS from root over a CSR graph, returning (distances, parents)
+def bfs(offsets: np.ndarray, neighbors: np.ndarray, root: int) -> Tuple[np.ndarray, np.ndarray]:
+	n = len(offsets) - 1
+	distances = np.full(n, UNREACHABLE, dtype=np.uint8)
+	parents = np.full(n, -1, dtype=np.int32)
+	distances[root] = 0
+	parents[root] = root
+	frontier = np.array([root], dtype=np.int32)
+	depth = 0
+	while len(frontier):
+		depth += 1
+		found, reached_from = snapshot.expand_rows(offsets, neighbors, frontier)
+		new = distances[found] == UNREACHABLE
+		found, first = np.unique(found[new], return_index=True)
+		# paths longer than the marker can't be told apart from unreachable; they don't occur in practice
+		distances[found] = min(depth, UNREACHABLE - 1)
+		parents[found] = reached_from[new][first]
+		frontier = found.astype(np.int32)
+	return distances, parents
+
+
+# pick `count` landmarks by degree, skipping artists right next to one already picked, and BFS from each
+# files are written next to the snapshot's arrays, each replaced atomically
+def build(path: str, count: int):
+	graph = snapshot.GraphSnapshot(path)
+	offsets, neighbors = undirected(graph)
+	candidates = np.argsort(-np.diff(offsets), kind='stable')
+
+	landmarks: List[int] = []
+	distances: List[np.ndarray] = []
+	parents: List[np.ndarray] = []
+	for candidate in candidates:
+		if len(landmarks) >= count:
+			break
+		if any(d[candidate] < 2 for d in distances):
+			continue
+		landmark_distances, landmark_parents = bfs(offsets, neighbors, int(candidate))
+		landmarks.append(int(candidate))
+		distances.append(landmark_distances)
+		parents.append(landmark_parents)
+
+	arrays = {
+		LANDMARKS_FILE: np.array(landmarks, dtype=np.int32),
+		DISTANCES_FILE: np.array(distances, dtype=np.uint8).reshape(len(landmarks), len(graph)),
+		PARENTS_FILE: np.array(parents, dtype=np.int32).reshape(len(landmarks), len(graph)),
+	}
+	for file_name, array in arrays.items():
+		tmp_path = os.path.join(path, file_name + ".tmp")
+		with open(tmp_path, 'wb') as f:
+			np.save(f, array)
+		os.replace(tmp_path, os.path.join(path, file_name))
+	print("Wrote {} landmarks for graph snapshot of {} artists to {}".format(len(landmarks), len(graph), path))
+
+
+# load the landmarks for a snapshot, or None if they haven't been built for it
+def load(graph: Optional[snapshot.GraphSnapshot]) -> Optional[LandmarkOracle]:
+	if graph is None or not os.path.exists(os.path.join(graph.path, LANDMARKS_FILE)):
+		return None
+	try:
+		oracle = LandmarkOracle(graph)
+	except (OSError, ValueError) as e:
+		print("Could not load landmarks from {}: {}".format(graph.path, e))
+		return None
+	print("Loaded {} landmarks from {}".format(len(oracle), graph.path))
+	return oracle
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Precompute landmark distances for a graph snapshot")
+	parser.add_argument('path', help="snapshot directory")
+	parser.add_argument('--count', type=int, default=16, help="number of landmarks")
+	args = parser.parse_args()
+
+	build(args.path, args.count)
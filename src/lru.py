@@ -0,0 +1,84 @@
+import sys
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+def default_sizeof(value: Any) -> int:
+	if isinstance(value, (list, tuple)):
+		return sys.getsizeof(value) + sum(sys.getsizeof(i) for i in value)
+	return sys.getsizeof(value)
+
+
+# in-process LRU cache bounded by entry count and (estimated) bytes, with an optional TTL per entry
+# a bound of 0 disables it
+class LRUCache:
+	def __init__(self, max_entries: int=0, max_bytes: int=0, ttl: float=0, sizeof: Callable[[Any], int]=default_sizeof):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.sizeof = sizeof
+		# key -> (value, size, expiry time)
+		self.entries: 'OrderedDict[Hashable, Tuple[Any, int, float]]' = OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return self.get(key, count=False) is not None
+
+	def get(self, key: Hashable, default: Any=None, count: bool=True) -> Any:
+		entry = self.entries.get(key)
+		if entry is None:
+			if count:
+				self.misses += 1
+			return default
+		value, size, expires = entry
+		if expires and expires <= monotonic():
+			self.remove(key)
+			self.expirations += 1
+			if count:
+				self.misses += 1
+			return default
+		self.entries.move_to_end(key)
+		if count:
+			self.hits += 1
+		return value
+
+	def set(self, key: Hashable, value: Any, ttl: Optional[float]=None):
+		size = self.sizeof(value)
+		if self.max_bytes and size > self.max_bytes:
+			return
+		self.remove(key)
+		ttl = self.ttl if ttl is None else ttl
+		expires = monotonic() + ttl if ttl else 0
+		self.entries[key] = (value, size, expires)
+		self.bytes += size
+		while (self.max_entries and len(self.entries) > self.max_entries) or (self.max_bytes and self.bytes > self.max_bytes):
+			_, (_, evicted_size, _) = self.entries.popitem(last=False)
+			self.bytes -= evicted_size
+			self.evictions += 1
+
+	def remove(self, key: Hashable):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.bytes -= entry[1]
+
+	def clear(self):
+		self.entries.clear()
+		self.bytes = 0
+
+	def stats(self) -> Dict[str, int]:
+		return {
+			"entries": len(self.entries),
+			"bytes": self.bytes,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"expirations": self.expirations,
+		}
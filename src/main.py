@@ -56,37 +56,6 @@ def timeit(func):
 # 		return cache.get_related_artists(artist_id)
 
 
-# for edge case where artist1/2 or is in queue of opposite side when intersection is found
-async def trace_path(artist1: Artist, artist2: Artist, parents1: Dict[ArtistID, ArtistID], parents2: Dict[ArtistID, ArtistID]) -> List[ArtistID]:
-	# artist1 is the one found from the opposite side
-	path = []
-	if artist1.id in parents2:
-		path = [artist1.id]
-		while path[-1] != artist2.id:
-			path.append(parents2[path[-1]])
-	elif artist2.id in parents1:
-		path = [artist2.id]
-		while path[-1] != artist1.id:
-			path.append(parents1[path[-1]])
-		path.reverse()
-	return path
-
-
-async def trace_bi_path(artist1: Artist, artist2: Artist, parents1: Dict[ArtistID, ArtistID], parents2: Dict[ArtistID, ArtistID], intersection) ->  List[ArtistID]:
-	path1: List[ArtistID] = [intersection]
-	while path1[-1] != artist1.id:
-		path1.append(parents1[path1[-1]])
-	path1.reverse()
-
-	path2: List[ArtistID] = [intersection]
-	while path2[-1] != artist2.id:
-		path2.append(parents2[path2[-1]])
-
-	# all names should already be cached at this point
-	id_path: List[ArtistID] = path1 + path2[1:]
-	return id_path
-
-
 # async def get_name_path(id_path: List[ArtistID]) -> List[str]:
 # 	name_path: List[str] = ["" for i in id_path]
 # 	for i in range(len(id_path)):
@@ -0,0 +1,111 @@
+import asyncio
+import re
+from typing import Dict, Iterable, List
+
+import aiohttp
+import spotify
+from spotify.errors import SpotifyException
+
+from src.custom_types import *
+from src.lru import LRUCache
+import src.cache as cache
+import src.metrics as metrics
+import src.settings as settings
+import src.typeahead as typeahead
+
+"""
+Artist metadata, resolved in batches and cached as the pre-rendered dicts the API returns.
+
+Lookups go through three tiers: an in-process TTL cache, Redis (artist:<ArtistID> keys with a TTL), then the
+Spotify several-artists endpoint, 50 IDs per request with the requests running concurrently. IDs that aren't
+Spotify IDs are never requested, and a request that fails leaves its IDs out, so one bad ID or failed request doesn't
+fail a whole lookup.
+"""
+
+# max IDs the several-artists endpoint accepts per request
+SPOTIFY_ARTISTS_BATCH_SIZE: int = 50
+# Spotify IDs are 22 base62 characters; the endpoint rejects the whole request if any ID isn't one
+SPOTIFY_ID_PATTERN = re.compile(r'[0-9A-Za-z]{22}')
+
+artist_dict_tier = LRUCache(settings.METADATA_CACHE_MAX_ENTRIES, 0, settings.METADATA_CACHE_TTL)
+metrics.watch_cache('artist_memory', artist_dict_tier)
+
+
+def get_image_dicts(images):
+	return [{ "url": i.url, "width":i.width, "height": i.height} for i in images]
+
+
+def generate_artist_dict(artist):
+	artist_dict: Dict = {}
+	artist_dict['name'] = artist.name
+	artist_dict['images'] = get_image_dicts(artist.images)
+	artist_dict['url'] = 'open.spotify.com/artist/' + artist.id
+	artist_dict['genres'] = artist.genres
+	artist_dict['followers'] = artist.followers
+	artist_dict['id'] = artist.id
+	return artist_dict
+
+
+# keep artist dicts already rendered elsewhere (e.g. from search results or related artists responses) in process
+# searches write them to Redis with each level's related artists (see cache.store_related_artists_many)
+def keep_artist_dicts(artist_dicts: List[Dict]):
+	for d in artist_dicts:
+		artist_dict_tier.set(d['id'], d)
+	typeahead.index.add_many(artist_dicts)
+
+
+# keep artist dicts in process and in Redis
+async def remember_artist_dicts(artist_dicts: List[Dict]):
+	keep_artist_dicts(artist_dicts)
+	await cache.store_artist_dicts_many({d['id']: d for d in artist_dicts}, settings.METADATA_CACHE_TTL)
+
+
+async def fetch_artist_dicts(client: spotify.Client, artist_ids: List[ArtistID]) -> Dict[ArtistID, Dict]:
+	async def fetch_batch(batch: List[ArtistID]) -> List[Dict]:
+		try:
+			data = await client.http.artists(','.join(batch))
+		except (SpotifyException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+			print("Error fetching artists {}: {!r}".format(','.join(batch), e))
+			return []
+		# unknown IDs come back as null
+		return [generate_artist_dict(spotify.Artist(client, a)) for a in data['artists'] if a]
+
+	artist_ids = [i for i in artist_ids if SPOTIFY_ID_PATTERN.fullmatch(i)]
+	batches = [artist_ids[i:i + SPOTIFY_ARTISTS_BATCH_SIZE] for i in range(0, len(artist_ids), SPOTIFY_ARTISTS_BATCH_SIZE)]
+	results = await asyncio.gather(*[fetch_batch(b) for b in batches])
+	return {d['id']: d for batch in results for d in batch}
+
+
+# artist dicts for many artist IDs; IDs Spotify doesn't know, or couldn't be fetched, are left out of the result
+async def get_artist_dicts(client: spotify.Client, artist_ids: Iterable[ArtistID]) -> Dict[ArtistID, Dict]:
+	res: Dict[ArtistID, Dict] = {}
+	missing: List[ArtistID] = []
+	for i in dict.fromkeys(artist_ids):
+		artist_dict = artist_dict_tier.get(i)
+		if artist_dict is None:
+			missing.append(i)
+		else:
+			res[i] = artist_dict
+
+	metrics.cache_lookups.inc('artist_memory', 'hit', amount=len(res))
+	metrics.cache_lookups.inc('artist_memory', 'miss', amount=len(missing))
+	if missing:
+		from_redis = await cache.get_artist_dicts_many(missing)
+		for artist_id, artist_dict in from_redis.items():
+			artist_dict_tier.set(artist_id, artist_dict)
+		typeahead.index.add_many(from_redis.values())
+		res.update(from_redis)
+		missing = [i for i in missing if i not in from_redis]
+		metrics.cache_lookups.inc('artist_redis', 'hit', amount=len(from_redis))
+		metrics.cache_lookups.inc('artist_redis', 'miss', amount=len(missing))
+
+	if missing:
+		fetched = await fetch_artist_dicts(client, missing)
+		await remember_artist_dicts(list(fetched.values()))
+		res.update(fetched)
+	return res
+
+
+async def get_artist_dict(client: spotify.Client, artist_id: ArtistID) -> Dict:
+	res = await get_artist_dicts(client, [artist_id])
+	return res.get(artist_id)
@@ -0,0 +1,241 @@
+import bisect
+from collections import defaultdict
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import src.settings as settings
+
+"""
+In-process metrics: counters, gauges and histograms, rendered in the Prometheus text format on /metrics.
+
+Disabled unless SIX_DEGREES_METRICS is set; every update then returns after checking one flag. With
+SIX_DEGREES_METRICS_TRACE also set, a request sent with an X-Debug-Trace header gets back a breakdown of where
+its time went (count and total time per timed operation), e.g.
+X-Debug-Trace: redis get_path=1x0.9ms; spotify /artists/{spotify_id}/related-artists=63x2984.0ms; search level=4x790.2ms; route=1x812.4ms
+
+Each worker process keeps its own metrics, so scrape every worker (or run one per instance).
+"""
+
+enabled: bool = settings.METRICS_ENABLED
+tracing: bool = settings.METRICS_ENABLED and settings.METRICS_TRACE
+
+# seconds; Spotify requests and searches take up to tens of seconds, Redis commands well under a millisecond
+LATENCY_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry: List['Metric'] = []
+
+
+def escape(value: str) -> str:
+	return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def label_text(names: Sequence[str], values: Sequence[str], extra: str="") -> str:
+	pairs = ['{}="{}"'.format(n, escape(str(v))) for n, v in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+	kind = ""
+
+	def __init__(self, name: str, description: str, labels: Sequence[str]=()):
+		self.name = name
+		self.description = description
+		self.labels = tuple(labels)
+		registry.append(self)
+
+	def samples(self) -> List[str]:
+		return []
+
+	def render(self) -> List[str]:
+		return ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)] + self.samples()
+
+
+class Counter(Metric):
+	kind = "counter"
+
+	def __init__(self, name: str, description: str, labels: Sequence[str]=()):
+		super().__init__(name, description, labels)
+		self.values: Dict[Tuple, float] = defaultdict(float)
+
+	def inc(self, *labels, amount: float=1):
+		if enabled:
+			self.values[labels] += amount
+
+	# for counts kept elsewhere (e.g. by a cache), copied in when rendering
+	def set_total(self, value: float, *labels):
+		if enabled:
+			self.values[labels] = value
+
+	def samples(self) -> List[str]:
+		return ['{}{} {}'.format(self.name, label_text(self.labels, k), v) for k, v in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+	kind = "gauge"
+
+	def __init__(self, name: str, description: str, labels: Sequence[str]=()):
+		super().__init__(name, description, labels)
+		self.values: Dict[Tuple, float] = {}
+
+	def set(self, value: float, *labels):
+		if enabled:
+			self.values[labels] = value
+
+	def samples(self) -> List[str]:
+		return ['{}{} {}'.format(self.name, label_text(self.labels, k), v) for k, v in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self, name: str, description: str, labels: Sequence[str]=(), buckets: Sequence[float]=LATENCY_BUCKETS):
+		super().__init__(name, description, labels)
+		self.buckets = tuple(buckets)
+		# per label values: observations in each bucket (the last for those above every bound), and their sum
+		self.counts: Dict[Tuple, List[int]] = {}
+		self.sums: Dict[Tuple, float] = defaultdict(float)
+
+	def observe(self, value: float, *labels):
+		if not enabled:
+			return
+		counts = self.counts.get(labels)
+		if counts is None:
+			counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+		counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sums[labels] += value
+
+	def samples(self) -> List[str]:
+		lines = []
+		for k, counts in sorted(self.counts.items()):
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				le = '+Inf' if bound == float('inf') else repr(bound)
+				lines.append('{}_bucket{} {}'.format(self.name, label_text(self.labels, k, 'le="{}"'.format(le)), cumulative))
+			lines.append('{}_sum{} {}'.format(self.name, label_text(self.labels, k), self.sums[k]))
+			lines.append('{}_count{} {}'.format(self.name, label_text(self.labels, k), cumulative))
+		return lines
+
+
+# time spent per operation name in one request: name -> [count, seconds]
+class Trace:
+	def __init__(self):
+		self.spans: Dict[str, List[float]] = {}
+
+	def add(self, name: str, seconds: float):
+		span = self.spans.get(name)
+		if span is None:
+			self.spans[name] = [1, seconds]
+		else:
+			span[0] += 1
+			span[1] += seconds
+
+	def header(self) -> str:
+		return '; '.join('{}={}x{:.1f}ms'.format(name, int(count), seconds * 1000) for name, (count, seconds) in self.spans.items())
+
+
+# the trace of the request being handled, if it asked for one (tasks started while handling it share it)
+current_trace: ContextVar = ContextVar('current_trace', default=None)
+
+
+def start_trace() -> Trace:
+	trace = Trace()
+	current_trace.set(trace)
+	return trace
+
+
+# records the time spent in a block in a histogram, and in the request's trace under `span` if it has one
+class Timer:
+	__slots__ = ('histogram', 'labels', 'span', 'start')
+
+	def __init__(self, histogram: Histogram, labels: Tuple, span: str):
+		self.histogram = histogram
+		self.labels = labels
+		self.span = span
+		self.start = 0.0
+
+	def __enter__(self):
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		record(self.histogram, perf_counter() - self.start, *self.labels, span=self.span)
+		return False
+
+
+class NullTimer:
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+
+NULL_TIMER = NullTimer()
+
+
+# observe a duration the caller measured, also adding it to the request's trace
+def record(histogram: Histogram, seconds: float, *labels, span: str=""):
+	if not enabled:
+		return
+	histogram.observe(seconds, *labels)
+	trace: Optional[Trace] = current_trace.get()
+	if trace is not None:
+		trace.add(span or histogram.name, seconds)
+
+
+# with metrics.timer(histogram, *labels, span="name"): ... (span defaults to the histogram's name)
+def timer(histogram: Histogram, *labels, span: str="") -> Timer:
+	if not enabled:
+		return NULL_TIMER
+	return Timer(histogram, labels, span or histogram.name)
+
+
+# in-process caches (src.lru.LRUCache) whose size and turnover are published, by name
+caches: Dict[str, Any] = {}
+
+
+def watch_cache(name: str, lru):
+	caches[name] = lru
+
+
+# read the watched caches' counts into their metrics
+def collect_caches():
+	for name, lru in caches.items():
+		stats = lru.stats()
+		memory_cache_entries.set(stats['entries'], name)
+		memory_cache_bytes.set(stats['bytes'], name)
+		memory_cache_evictions.set_total(stats['evictions'], name)
+		memory_cache_expirations.set_total(stats['expirations'], name)
+
+
+# every metric in the Prometheus text format
+def render() -> str:
+	collect_caches()
+	lines: List[str] = []
+	for metric in registry:
+		lines += metric.render()
+	return '\n'.join(lines) + '\n'
+
+
+# the app's metrics
+http_request_seconds = Histogram('six_degrees_http_request_seconds', "Time to handle a request, by route and status", ('route', 'method', 'status'))
+spotify_request_seconds = Histogram('six_degrees_spotify_request_seconds', "Spotify API requests, by endpoint and response status", ('endpoint', 'status'))
+spotify_concurrency_limit = Gauge('six_degrees_spotify_concurrency_limit', "Spotify requests allowed in flight by the adaptive limiter")
+redis_command_seconds = Histogram('six_degrees_redis_command_seconds', "Redis commands (or pipelines), by cache function", ('command',))
+redis_errors = Counter('six_degrees_redis_errors_total', "Redis commands that failed or timed out, by cache function", ('command',))
+cache_lookups = Counter('six_degrees_cache_lookups_total', "Cache lookups, by cache and result (hit or miss)", ('cache', 'result'))
+memory_cache_entries = Gauge('six_degrees_memory_cache_entries', "Entries in an in-process cache", ('cache',))
+memory_cache_bytes = Gauge('six_degrees_memory_cache_bytes', "Estimated size of an in-process cache's entries", ('cache',))
+memory_cache_evictions = Counter('six_degrees_memory_cache_evictions_total', "Entries evicted from an in-process cache to stay within its bounds", ('cache',))
+memory_cache_expirations = Counter('six_degrees_memory_cache_expirations_total', "Entries of an in-process cache found expired", ('cache',))
+snapshot_search_seconds = Histogram('six_degrees_snapshot_search_seconds', "Searches over the graph snapshot, including those it couldn't settle alone")
+search_level_seconds = Histogram('six_degrees_search_level_seconds', "Time to expand one level of a search")
+search_artists_expanded = Counter('six_degrees_search_artists_expanded_total', "Artists whose related artists were looked up by searches")
+search_artists_discovered = Counter('six_degrees_search_artists_discovered_total', "Artists reached by searches")
+searches = Counter('six_degrees_searches_total', "Connection searches run (not answered from a cache), by status", ('status',))
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import json
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from quart import Response
+
+from src.lru import LRUCache
+import src.metrics as metrics
+import src.settings as settings
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+"""
+Serialized JSON responses with validators and compressed variants, and an in-process cache of them.
+
+/api/artist and /api/connect answers don't change for hours, so they are serialized (and compressed, if large
+enough) once, kept in `cache` by route and arguments, and served with a strong ETag and a Cache-Control max-age.
+A request repeating one is answered without looking anything up or serializing, and a client revalidating it
+with If-None-Match gets 304 Not Modified.
+
+Compressed variants are separate representations, so each has its own ETag (the body's with the encoding appended).
+"""
+
+GZIP_LEVEL: int = 6
+BROTLI_QUALITY: int = 5
+
+
+def entry_size(response: 'JSONResponse') -> int:
+	return response.size
+
+
+class JSONResponse:
+	def __init__(self, document: Any, headers: Optional[Dict[str, str]]=None, max_age: int=0, context: Any=None):
+		self.body: bytes = json.dumps(document).encode('utf-8')
+		self.etag: str = '"{}"'.format(hashlib.sha1(self.body).hexdigest())
+		# headers sent with every response (e.g. X-Search-Status)
+		self.headers: Dict[str, str] = headers or {}
+		# 0 for responses clients should revalidate every time
+		self.max_age = max_age
+		# whatever the route needs to handle a request answered from the cache
+		self.context = context
+		# encoding -> (body, ETag), most preferred first
+		self.encoded: Dict[str, Tuple[bytes, str]] = {}
+		if len(self.body) >= settings.RESPONSE_COMPRESS_MIN_BYTES:
+			if brotli is not None:
+				self.encoded['br'] = (brotli.compress(self.body, quality=BROTLI_QUALITY), self.variant_etag('br'))
+			self.encoded['gzip'] = (gzip.compress(self.body, GZIP_LEVEL), self.variant_etag('gzip'))
+		self.size: int = len(self.body) + sum(len(body) for body, _ in self.encoded.values())
+
+	def variant_etag(self, encoding: str) -> str:
+		return '{}-{}"'.format(self.etag[:-1], encoding)
+
+	def etags(self) -> List[str]:
+		return [self.etag] + [etag for _, etag in self.encoded.values()]
+
+	# whether a request with this If-None-Match header can be answered with 304 Not Modified
+	def not_modified(self, if_none_match: Optional[str]) -> bool:
+		if not if_none_match:
+			return False
+		if if_none_match.strip() == '*':
+			return True
+		# weak comparison, as If-None-Match calls for
+		tags = [t.strip() for t in if_none_match.split(',')]
+		tags = [t[2:] if t.startswith('W/') else t for t in tags]
+		return any(etag in tags for etag in self.etags())
+
+	# the response to a request with these headers, plus `headers`
+	def response(self, request_headers, headers: Optional[Dict[str, str]]=None) -> Response:
+		encoding = None
+		if self.encoded:
+			encoding = choose_encoding(request_headers.get('Accept-Encoding', ''), list(self.encoded))
+		body, etag = self.encoded[encoding] if encoding else (self.body, self.etag)
+
+		response_headers = dict(self.headers)
+		if headers:
+			response_headers.update(headers)
+		response_headers['ETag'] = etag
+		response_headers['Cache-Control'] = 'public, max-age={}'.format(self.max_age) if self.max_age else 'no-cache'
+		if self.encoded:
+			response_headers['Vary'] = 'Accept-Encoding'
+		if self.not_modified(request_headers.get('If-None-Match')):
+			return Response('', status=304, headers=response_headers)
+		if encoding:
+			response_headers['Content-Encoding'] = encoding
+		return Response(body, mimetype='text/json', headers=response_headers)
+
+
+# the first of `encodings` the Accept-Encoding header allows, or None for the identity encoding
+def choose_encoding(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+	accepted: Dict[str, float] = {}
+	for part in accept_encoding.split(','):
+		name, _, params = part.partition(';')
+		quality = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				quality = float(params[2:])
+			except ValueError:
+				quality = 0.0
+		accepted[name.strip().lower()] = quality
+	for encoding in encodings:
+		if accepted.get(encoding, accepted.get('*', 0)) > 0:
+			return encoding
+	return None
+
+
+cache = LRUCache(settings.RESPONSE_CACHE_MAX_ENTRIES, settings.RESPONSE_CACHE_MAX_BYTES, settings.RESPONSE_CACHE_TTL, sizeof=entry_size)
+metrics.watch_cache('response', cache)
+
+
+def get(key: Hashable) -> Optional[JSONResponse]:
+	return cache.get(key)
+
+
+def store(key: Hashable, response: JSONResponse, ttl: Optional[float]=None) -> JSONResponse:
+	cache.set(key, response, ttl)
+	return response
@@ -0,0 +1,419 @@
+import asyncio
+from collections import deque
+from time import monotonic, perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from src.custom_types import *
+import src.metrics as metrics
+
+"""
+Bidirectional BFS over the related artists graph.
+
+The engine is independent of where adjacency comes from: it is given an expand function that takes a level of
+artist IDs and the search's budget, and yields (artist ID, related artist IDs) pairs as each lookup resolves.
+
+Like the original search, each side follows the related artists listed by the artists it reaches, and the search
+stops at the first artist both sides reach. So a path runs along links listed by the artists on the source's side up
+to where the sides meet, then along links listed by the artists on the target's side. It is a shortest path if
+related artists are mutual (each listed by the other), which Spotify's mostly but not always are, and the rest of
+the app assumes they are: paths are cached for both directions and for every sub-path, and landmark paths follow
+links both ways. Between artists linked only one way, a path may be longer than the shortest one, or may not be
+found at all.
+
+A search can be given a budget (artists expanded, Spotify requests, seconds). Running out of it gives a
+BUDGET_EXHAUSTED result, which only means no path was found yet; DISCONNECTED means one side's whole component was
+explored without meeting the other. If a path is already known (e.g. through a landmark, see src/landmarks.py),
+the search stops as soon as it proves nothing shorter exists, and returns that path as an APPROXIMATE result if the
+budget runs out first.
+"""
+
+# called with a level and the budget of the search expanding it, which it counts Spotify requests in
+ExpandFunction = Callable[[List[ArtistID], 'SearchBudget'], AsyncIterator[Tuple[ArtistID, List[ArtistID]]]]
+# called with (artists expanded, forward depth, backward depth) as a search progresses
+ProgressFunction = Callable[[int, int, int], None]
+
+
+# search outcomes
+FOUND: str = "found"
+BUDGET_EXHAUSTED: str = "budget_exhausted"
+DISCONNECTED: str = "disconnected"
+APPROXIMATE: str = "approximate"
+
+
+class SearchResult(NamedTuple):
+	path: List[ArtistID]
+	# number of artists whose related artists were looked up
+	expanded: int
+	status: str
+
+
+# limits for one search (0 for no limit); the expand function counts its Spotify requests in `fetches`
+class SearchBudget:
+	def __init__(self, max_expanded: int=0, max_fetches: int=0, deadline: float=0):
+		self.max_expanded = max_expanded
+		self.max_fetches = max_fetches
+		# seconds the search may run for
+		self.deadline = deadline
+		self.expires: Optional[float] = None
+		self.fetches = 0
+
+	# the deadline counts from the first call, so a search continuing another (e.g. over the graph snapshot) keeps it
+	# time.monotonic() is the event loop's clock, and readable from the threads and processes searching the snapshot
+	def start(self):
+		if self.deadline and self.expires is None:
+			self.expires = monotonic() + self.deadline
+
+	def scaled(self, factor: float) -> 'SearchBudget':
+		return SearchBudget(int(self.max_expanded * factor), int(self.max_fetches * factor), self.deadline * factor)
+
+	# whether this budget allows at least as much work as another
+	def covers(self, other: 'SearchBudget') -> bool:
+		def at_least(a, b) -> bool:
+			return not a or (b and a >= b)
+		return at_least(self.max_expanded, other.max_expanded) and at_least(self.max_fetches, other.max_fetches) and at_least(self.deadline, other.deadline)
+
+	def as_list(self) -> List[float]:
+		return [self.max_expanded, self.max_fetches, self.deadline]
+
+	# Spotify requests that may still be made, or None for no limit
+	def remaining_fetches(self) -> Optional[int]:
+		if not self.max_fetches:
+			return None
+		return max(self.max_fetches - self.fetches, 0)
+
+	# seconds left before the deadline, or None for no limit
+	def remaining_time(self) -> Optional[float]:
+		if self.expires is None:
+			return None
+		return max(self.expires - monotonic(), 0)
+
+	def exhausted(self, expanded: int) -> bool:
+		if self.max_expanded and expanded >= self.max_expanded:
+			return True
+		if self.max_fetches and self.fetches >= self.max_fetches:
+			return True
+		return self.expires is not None and self.remaining_time() <= 0
+
+
+# count a level of a search in the metrics
+def record_level(started: float, expanded: int, discovered: int):
+	if metrics.enabled:
+		metrics.record(metrics.search_level_seconds, perf_counter() - started, span='search level')
+		metrics.search_artists_expanded.inc(amount=expanded)
+		metrics.search_artists_discovered.inc(amount=discovered)
+
+
+# run fetch for every artist ID concurrently, yielding (artist ID, fetch result) pairs as they complete
+# at most `limit` fetches are started ahead of the results the consumer has taken, so one that stops early (e.g. as
+# soon as the search meets the other side) leaves at most `limit` behind: those not started are cancelled, and those
+# started are passed to `abandoned` if given (e.g. to keep their results), or else cancelled
+async def expand_concurrently(artist_ids: List[ArtistID], fetch: Callable[[ArtistID], Awaitable[Any]], limit: int, abandoned: Optional[Callable[[List[asyncio.Future]], None]]=None) -> AsyncIterator[Tuple[ArtistID, Any]]:
+	semaphore = asyncio.Semaphore(limit)
+	started: Set[ArtistID] = set()
+	taken: Set[ArtistID] = set()
+
+	async def run(artist_id: ArtistID) -> Tuple[ArtistID, Any]:
+		# released once the consumer has taken the result, not when the fetch completes
+		await semaphore.acquire()
+		started.add(artist_id)
+		return artist_id, await fetch(artist_id)
+
+	tasks = [(i, asyncio.ensure_future(run(i))) for i in artist_ids]
+	try:
+		for next_done in asyncio.as_completed([t for _, t in tasks]):
+			artist_id, result = await next_done
+			taken.add(artist_id)
+			yield artist_id, result
+			semaphore.release()
+	finally:
+		left: List[asyncio.Future] = []
+		for artist_id, t in tasks:
+			if artist_id in taken:
+				continue
+			if artist_id in started and abandoned is not None:
+				left.append(t)
+			elif not t.done():
+				t.cancel()
+		if left:
+			abandoned(left)
+
+
+class SearchSide:
+	def __init__(self, root: ArtistID):
+		self.root = root
+		# parent of every artist discovered from this side (root maps to itself)
+		self.parents: Dict[ArtistID, ArtistID] = {root: root}
+		# hops from the root to every artist discovered
+		self.depths: Dict[ArtistID, int] = {root: 0}
+		# artists at the current depth, not yet expanded
+		self.queue: Deque[ArtistID] = deque([root])
+		self.depth = 0
+
+	# path from the root to artist_id
+	def trace(self, artist_id: ArtistID) -> List[ArtistID]:
+		path: List[ArtistID] = [artist_id]
+		while path[-1] != self.root:
+			path.append(self.parents[path[-1]])
+		path.reverse()
+		return path
+
+
+# how far a search got before it stopped partway (e.g. over the graph snapshot, see src/snapshot.py), for
+# BidirectionalSearch.resume to continue from
+class SearchState(NamedTuple):
+	forward: SearchSide
+	backward: SearchSide
+	expanded: int
+
+
+class BidirectionalSearch:
+	def __init__(self, expand: ExpandFunction, budget: Optional[SearchBudget]=None, known_path: Optional[List[ArtistID]]=None, progress: Optional[ProgressFunction]=None, progress_interval: int=50):
+		self.expand = expand
+		self.budget = budget or SearchBudget()
+		# a path from source to target found some other way (empty if none), not necessarily a shortest one
+		self.known_path: List[ArtistID] = known_path or []
+		# reported after every level and every progress_interval artists expanded
+		self.progress = progress
+		self.progress_interval = progress_interval
+		self.forward: Optional[SearchSide] = None
+		self.backward: Optional[SearchSide] = None
+		self.expanded = 0
+		# set when the budget ran out before a level was fully expanded
+		self.truncated = False
+
+	# find a shortest path from source to target, or an empty path if they are not connected
+	async def run(self, source: ArtistID, target: ArtistID) -> SearchResult:
+		if source == target:
+			return SearchResult([source], 0, FOUND)
+		return await self.resume(SearchState(SearchSide(source), SearchSide(target), 0))
+
+	# continue a search from sides already grown by another one, which hasn't found where they meet
+	async def resume(self, state: SearchState) -> SearchResult:
+		self.budget.start()
+		forward = self.forward = state.forward
+		backward = self.backward = state.backward
+		self.expanded = state.expanded
+		while forward.queue and backward.queue:
+			# any path not found yet is longer than both depths together, so the known path is a shortest one
+			if self.known_path and forward.depth + backward.depth + 1 >= len(self.known_path) - 1:
+				return SearchResult(self.known_path, self.expanded, FOUND)
+			if self.budget.exhausted(self.expanded):
+				return self.out_of_budget()
+			# always grow the cheaper side
+			if len(forward.queue) <= len(backward.queue):
+				side, other = forward, backward
+			else:
+				side, other = backward, forward
+			intersect = await self.expand_level(side, other)
+			self.report()
+			if intersect is not None:
+				path = forward.trace(intersect) + backward.trace(intersect)[-2::-1]
+				return SearchResult(path, self.expanded, FOUND)
+			if self.truncated:
+				return self.out_of_budget()
+		# only possible if the known path uses an edge against its direction
+		if self.known_path:
+			return SearchResult(self.known_path, self.expanded, APPROXIMATE)
+		return SearchResult([], self.expanded, DISCONNECTED)
+
+	def report(self):
+		if self.progress is not None:
+			self.progress(self.expanded, self.forward.depth, self.backward.depth)
+
+	def out_of_budget(self) -> SearchResult:
+		if self.known_path:
+			return SearchResult(self.known_path, self.expanded, APPROXIMATE)
+		return SearchResult([], self.expanded, BUDGET_EXHAUSTED)
+
+	# expand every artist at side's current depth
+	# returns the first artist reached that the other side has already discovered, if any
+	#
+	# while no intersection exists the discovered sets are disjoint, so any path is longer than the
+	# depths already explored on both sides combined; the first artist reached by both sides meets
+	# that bound, which means the search can stop as soon as it is discovered
+	async def expand_level(self, side: SearchSide, other: SearchSide) -> Optional[ArtistID]:
+		started, expanded_before, discovered_before = perf_counter(), self.expanded, len(side.parents)
+		level: List[ArtistID] = [side.queue.popleft() for _ in range(len(side.queue))]
+		side.depth += 1
+		results = self.expand(level, self.budget)
+		remaining = len(level)
+		try:
+			while remaining:
+				try:
+					timeout = self.budget.remaining_time()
+					if timeout is None:
+						artist_id, related_artists_ids = await results.__anext__()
+					else:
+						artist_id, related_artists_ids = await asyncio.wait_for(results.__anext__(), timeout)
+				except StopAsyncIteration:
+					# the expand function skipped artists it had no budget left to fetch
+					self.truncated = True
+					break
+				except asyncio.TimeoutError:
+					self.truncated = True
+					break
+				remaining -= 1
+				self.expanded += 1
+				if self.expanded % self.progress_interval == 0:
+					self.report()
+				for i in related_artists_ids:
+					if i in side.parents:
+						continue
+					side.parents[i] = artist_id
+					side.depths[i] = side.depth
+					if i in other.parents:
+						return i
+					side.queue.append(i)
+				if remaining and self.budget.exhausted(self.expanded):
+					self.truncated = True
+					break
+		finally:
+			await results.aclose()
+			record_level(started, self.expanded - expanded_before, len(side.parents) - discovered_before)
+		return None
+
+
+# expand function that remembers every artist's related artists, so searches sharing `memo` don't look an
+# artist up twice
+def memoize_expand(expand: ExpandFunction, memo: Dict[ArtistID, List[ArtistID]]) -> ExpandFunction:
+	async def memoized(artist_ids: List[ArtistID], budget: SearchBudget) -> AsyncIterator[Tuple[ArtistID, List[ArtistID]]]:
+		missing: List[ArtistID] = []
+		for artist_id in artist_ids:
+			if artist_id in memo:
+				yield artist_id, memo[artist_id]
+			else:
+				missing.append(artist_id)
+		if missing:
+			results = expand(missing, budget)
+			try:
+				async for artist_id, related_artists_ids in results:
+					memo[artist_id] = related_artists_ids
+					yield artist_id, related_artists_ids
+			finally:
+				await results.aclose()
+	return memoized
+
+
+# shortest paths from one source to many targets
+# the source's side of the search is kept between targets, so each one only has to grow it as far as it needs
+# to and search from the target's end; levels are always expanded whole to keep the shared side consistent
+class MultiTargetSearch:
+	def __init__(self, expand: ExpandFunction, source: ArtistID):
+		self.expand = expand
+		self.source = source
+		self.forward = SearchSide(source)
+		self.expanded = 0
+		# set when a level of the source's side was only partly expanded, so it has to be started over
+		self.truncated = False
+
+	async def run(self, target: ArtistID, budget: Optional[SearchBudget]=None) -> SearchResult:
+		if target == self.source:
+			return SearchResult([target], 0, FOUND)
+
+		if self.truncated:
+			self.forward = SearchSide(self.source)
+			self.truncated = False
+		budget = budget or SearchBudget()
+		budget.start()
+		expanded_before = self.expanded
+		forward = self.forward
+		backward = SearchSide(target)
+		# the artist both sides meet at on the shortest path seen so far
+		meet: Optional[ArtistID] = target if target in forward.parents else None
+		while True:
+			# any path not seen yet is longer than both depths together
+			if meet is not None and forward.depths[meet] + backward.depths[meet] <= forward.depth + backward.depth + 1:
+				break
+			if not forward.queue or not backward.queue:
+				break
+			if budget.exhausted(self.expanded - expanded_before):
+				return SearchResult([], self.expanded - expanded_before, BUDGET_EXHAUSTED)
+			if len(forward.queue) <= len(backward.queue):
+				side, other = forward, backward
+			else:
+				side, other = backward, forward
+			meets, complete = await self.expand_level(side, other, budget, expanded_before)
+			if not complete:
+				# a partly expanded level can't be shared with later targets
+				if side is forward:
+					self.truncated = True
+				return SearchResult([], self.expanded - expanded_before, BUDGET_EXHAUSTED)
+			for i in meets:
+				if meet is None or forward.depths[i] + backward.depths[i] < forward.depths[meet] + backward.depths[meet]:
+					meet = i
+
+		if meet is None:
+			return SearchResult([], self.expanded - expanded_before, DISCONNECTED)
+		path = forward.trace(meet) + backward.trace(meet)[-2::-1]
+		return SearchResult(path, self.expanded - expanded_before, FOUND)
+
+	# grow the source's side level by level up to max_depth hops, yielding each layer of newly reached artists
+	# once it is complete (the source alone is layer 0); stops early if the budget runs out, leaving `truncated` set
+	# every artist reached, even in an unfinished layer, has its shortest path back to the source in forward.parents
+	async def layers(self, max_depth: int, budget: Optional[SearchBudget]=None) -> AsyncIterator[Tuple[int, List[ArtistID]]]:
+		if self.truncated:
+			self.forward = SearchSide(self.source)
+			self.truncated = False
+		budget = budget or SearchBudget()
+		budget.start()
+		expanded_before = self.expanded
+		forward = self.forward
+		depth = 0
+		yield 0, [self.source]
+		while depth < max_depth:
+			depth += 1
+			# levels already expanded for earlier targets
+			if forward.depth >= depth:
+				layer = [i for i, d in forward.depths.items() if d == depth]
+				if not layer:
+					return
+				yield depth, layer
+				continue
+			if not forward.queue:
+				return
+			if budget.exhausted(self.expanded - expanded_before):
+				self.truncated = True
+				return
+			_, complete = await self.expand_level(forward, None, budget, expanded_before)
+			if not complete:
+				self.truncated = True
+				return
+			if not forward.queue:
+				return
+			yield depth, list(forward.queue)
+
+	# expand every artist at side's current depth, returning the artists reached that the other side (if any) has
+	# already discovered, and whether the level was expanded before the budget ran out
+	async def expand_level(self, side: SearchSide, other: Optional[SearchSide], budget: SearchBudget, expanded_before: int) -> Tuple[List[ArtistID], bool]:
+		started, level_expanded_before, discovered_before = perf_counter(), self.expanded, len(side.parents)
+		level: List[ArtistID] = [side.queue.popleft() for _ in range(len(side.queue))]
+		side.depth += 1
+		meets: List[ArtistID] = []
+		results = self.expand(level, budget)
+		remaining = len(level)
+		try:
+			while remaining:
+				try:
+					timeout = budget.remaining_time()
+					if timeout is None:
+						artist_id, related_artists_ids = await results.__anext__()
+					else:
+						artist_id, related_artists_ids = await asyncio.wait_for(results.__anext__(), timeout)
+				except (StopAsyncIteration, asyncio.TimeoutError):
+					return meets, False
+				remaining -= 1
+				self.expanded += 1
+				for i in related_artists_ids:
+					if i in side.parents:
+						continue
+					side.parents[i] = artist_id
+					side.depths[i] = side.depth
+					if other is not None and i in other.parents:
+						meets.append(i)
+					side.queue.append(i)
+				if remaining and budget.exhausted(self.expanded - expanded_before):
+					return meets, False
+		finally:
+			await results.aclose()
+			record_level(started, self.expanded - level_expanded_before, len(side.parents) - discovered_before)
+		return meets, True
@@ -0,0 +1,122 @@
+import os
+
+"""
+Tunable settings, read from environment variables (same SIX_DEGREES_ prefix as the Spotify credentials)
+"""
+
+
+def env_int(name: str, default: int) -> int:
+	try:
+		return int(os.environ.get(name, default))
+	except ValueError:
+		print("Invalid value for {}, using default {}".format(name, default))
+		return default
+
+
+def env_float(name: str, default: float) -> float:
+	try:
+		return float(os.environ.get(name, default))
+	except ValueError:
+		print("Invalid value for {}, using default {}".format(name, default))
+		return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+	val = os.environ.get(name)
+	if val is None:
+		return default
+	return val.lower() in ("1", "true", "yes", "on")
+
+
+# max related-artists lookups in flight at once while expanding a level
+SEARCH_CONCURRENCY: int = env_int("SIX_DEGREES_SEARCH_CONCURRENCY", 10)
+
+# processes (per worker) running graph snapshot searches off the event loop; with 0, or where processes can't be
+# started (hypercorn workers are daemonic when it runs more than one), they run on a thread of the worker instead
+SEARCH_PROCESSES: int = env_int("SIX_DEGREES_SEARCH_PROCESSES", 2)
+
+# asyncio Redis connection pool bounds (per worker)
+REDIS_POOL_MIN_SIZE: int = env_int("SIX_DEGREES_REDIS_POOL_MIN_SIZE", 1)
+REDIS_POOL_MAX_SIZE: int = env_int("SIX_DEGREES_REDIS_POOL_MAX_SIZE", 10)
+
+# consecutive failed Redis commands before cache calls fail fast, and seconds between recovery probes
+REDIS_FAILURE_THRESHOLD: int = env_int("SIX_DEGREES_REDIS_FAILURE_THRESHOLD", 3)
+REDIS_PROBE_INTERVAL: float = env_float("SIX_DEGREES_REDIS_PROBE_INTERVAL", 5.0)
+
+# seconds before a Redis command (or pipeline) counts as failed
+REDIS_COMMAND_TIMEOUT: float = env_float("SIX_DEGREES_REDIS_COMMAND_TIMEOUT", 2.0)
+
+# in-process LRU tier for related artists lists (entries, estimated bytes, seconds before an entry is re-read from Redis)
+ADJACENCY_CACHE_MAX_ENTRIES: int = env_int("SIX_DEGREES_ADJACENCY_CACHE_MAX_ENTRIES", 50000)
+ADJACENCY_CACHE_MAX_BYTES: int = env_int("SIX_DEGREES_ADJACENCY_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+ADJACENCY_CACHE_TTL: float = env_float("SIX_DEGREES_ADJACENCY_CACHE_TTL", 3600.0)
+
+# directory of a graph snapshot (see src/snapshot.py) to memory-map at startup; empty to disable
+SNAPSHOT_PATH: str = os.environ.get("SIX_DEGREES_SNAPSHOT_PATH", "")
+
+# Spotify Web API and token endpoints (point these at src/fake_spotify.py for offline testing)
+SPOTIFY_API_URL: str = os.environ.get("SIX_DEGREES_SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_TOKEN_URL: str = os.environ.get("SIX_DEGREES_SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+# file to append successful Spotify responses to, for replaying with src/fake_spotify.py --recorded (empty for none)
+SPOTIFY_RECORD_PATH: str = os.environ.get("SIX_DEGREES_SPOTIFY_RECORD_PATH", "")
+
+# cached artist metadata (entries kept in process, seconds before an artist is re-fetched from Spotify)
+METADATA_CACHE_MAX_ENTRIES: int = env_int("SIX_DEGREES_METADATA_CACHE_MAX_ENTRIES", 20000)
+METADATA_CACHE_TTL: float = env_float("SIX_DEGREES_METADATA_CACHE_TTL", 24 * 60 * 60.0)
+
+# /api/search result cache (entries, seconds), and how many local matches answer a query without Spotify
+TYPEAHEAD_CACHE_MAX_ENTRIES: int = env_int("SIX_DEGREES_TYPEAHEAD_CACHE_MAX_ENTRIES", 10000)
+TYPEAHEAD_CACHE_TTL: float = env_float("SIX_DEGREES_TYPEAHEAD_CACHE_TTL", 600.0)
+TYPEAHEAD_MIN_LOCAL_RESULTS: int = env_int("SIX_DEGREES_TYPEAHEAD_MIN_LOCAL_RESULTS", 5)
+
+# seconds between rebuilds of the /api/stats document, and new connections that trigger an earlier rebuild
+STATS_REFRESH_INTERVAL: float = env_float("SIX_DEGREES_STATS_REFRESH_INTERVAL", 60.0)
+STATS_REFRESH_AFTER_CONNECTIONS: int = env_int("SIX_DEGREES_STATS_REFRESH_AFTER_CONNECTIONS", 20)
+
+# default limits for one /api/connect search: artists expanded, Spotify requests, seconds (0 for no limit)
+# requests may scale them up to SEARCH_MAX_BUDGET_SCALE times with ?budget=<factor>
+SEARCH_MAX_EXPANDED: int = env_int("SIX_DEGREES_SEARCH_MAX_EXPANDED", 20000)
+SEARCH_MAX_FETCHES: int = env_int("SIX_DEGREES_SEARCH_MAX_FETCHES", 2000)
+SEARCH_DEADLINE: float = env_float("SIX_DEGREES_SEARCH_DEADLINE", 20.0)
+SEARCH_MAX_BUDGET_SCALE: float = env_float("SIX_DEGREES_SEARCH_MAX_BUDGET_SCALE", 4.0)
+
+# seconds to cache searches that ran out of budget, and searches that proved two artists are not connected
+NO_PATH_TTL: float = env_float("SIX_DEGREES_NO_PATH_TTL", 60 * 60.0)
+DISCONNECTED_TTL: float = env_float("SIX_DEGREES_DISCONNECTED_TTL", 7 * 24 * 60 * 60.0)
+
+# most connections one POST /api/connect/batch request may ask for
+BATCH_MAX_PAIRS: int = env_int("SIX_DEGREES_BATCH_MAX_PAIRS", 400)
+
+# default and maximum hops for /api/degrees, and seconds its stored BFS trees are kept
+DEGREES_DEFAULT_DEPTH: int = env_int("SIX_DEGREES_DEGREES_DEFAULT_DEPTH", 2)
+DEGREES_MAX_DEPTH: int = env_int("SIX_DEGREES_DEGREES_MAX_DEPTH", 3)
+TREE_TTL: float = env_float("SIX_DEGREES_TREE_TTL", 24 * 60 * 60.0)
+
+# artists expanded between progress events on /api/connect/<a>/<b>/stream
+SEARCH_PROGRESS_INTERVAL: int = env_int("SIX_DEGREES_SEARCH_PROGRESS_INTERVAL", 50)
+
+# Spotify connection pool (connections, seconds an idle connection is kept open), and seconds before a bearer
+# token expires that it is replaced
+SPOTIFY_POOL_SIZE: int = env_int("SIX_DEGREES_SPOTIFY_POOL_SIZE", 32)
+SPOTIFY_KEEPALIVE_TIMEOUT: float = env_float("SIX_DEGREES_SPOTIFY_KEEPALIVE_TIMEOUT", 60.0)
+SPOTIFY_TOKEN_EXPIRY_MARGIN: float = env_float("SIX_DEGREES_SPOTIFY_TOKEN_EXPIRY_MARGIN", 60.0)
+
+# adaptive limit on Spotify requests in flight (starting, minimum, maximum), and the response time in seconds
+# above which it backs off
+SPOTIFY_CONCURRENCY_INITIAL: int = env_int("SIX_DEGREES_SPOTIFY_CONCURRENCY_INITIAL", 8)
+SPOTIFY_CONCURRENCY_MIN: int = env_int("SIX_DEGREES_SPOTIFY_CONCURRENCY_MIN", 1)
+SPOTIFY_CONCURRENCY_MAX: int = env_int("SIX_DEGREES_SPOTIFY_CONCURRENCY_MAX", 32)
+SPOTIFY_LATENCY_TARGET: float = env_float("SIX_DEGREES_SPOTIFY_LATENCY_TARGET", 1.0)
+
+# collect metrics and serve them on /metrics (Prometheus text format), and allow per-request trace breakdowns
+# (X-Debug-Trace request header) when they are collected
+METRICS_ENABLED: bool = env_bool("SIX_DEGREES_METRICS", False)
+METRICS_TRACE: bool = env_bool("SIX_DEGREES_METRICS_TRACE", False)
+
+# in-process cache of serialized /api/connect and /api/artist responses (entries, bytes, seconds), the max-age
+# clients and proxies may cache them for, and the size from which they are compressed (gzip, or brotli if installed)
+RESPONSE_CACHE_MAX_ENTRIES: int = env_int("SIX_DEGREES_RESPONSE_CACHE_MAX_ENTRIES", 10000)
+RESPONSE_CACHE_MAX_BYTES: int = env_int("SIX_DEGREES_RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+RESPONSE_CACHE_TTL: float = env_float("SIX_DEGREES_RESPONSE_CACHE_TTL", 60 * 60.0)
+RESPONSE_MAX_AGE: int = env_int("SIX_DEGREES_RESPONSE_MAX_AGE", 60 * 60)
+RESPONSE_COMPRESS_MIN_BYTES: int = env_int("SIX_DEGREES_RESPONSE_COMPRESS_MIN_BYTES", 1024)
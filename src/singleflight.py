@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+"""
+Single-flight coalescing: concurrent calls for the same key share one in-flight task instead of each doing
+the work (e.g. many requests for the same connection arriving before the first one has cached its path).
+
+The shared task is shielded from any one caller being cancelled, and only cancelled once every caller waiting
+on it has gone away. It can report as it goes (e.g. a search's progress) to every caller waiting on it, including
+those that joined after it started.
+"""
+
+
+class Flight:
+	def __init__(self):
+		self.task: Optional[asyncio.Future] = None
+		self.waiters = 0
+		# called with whatever the task reports, one per waiting caller that passed a listener
+		self.listeners: List[Callable[..., None]] = []
+
+	def notify(self, *args):
+		for listener in list(self.listeners):
+			listener(*args)
+
+
+class SingleFlight:
+	def __init__(self):
+		self.flights: Dict[Hashable, Flight] = {}
+
+	def __len__(self) -> int:
+		return len(self.flights)
+
+	# the result of func(notify), run once for all concurrent callers with the same key
+	# what func reports through notify is passed on to the listener of every caller waiting at the time
+	# returns (result, whether this call joined a flight another caller started)
+	async def do(self, key: Hashable, func: Callable[[Callable[..., None]], Awaitable[Any]], listener: Optional[Callable[..., None]]=None) -> Tuple[Any, bool]:
+		flight = self.flights.get(key)
+		joined = flight is not None
+		if flight is None:
+			flight = Flight()
+			flight.task = asyncio.ensure_future(func(flight.notify))
+			self.flights[key] = flight
+			flight.task.add_done_callback(lambda _: self.forget(key, flight))
+		flight.waiters += 1
+		if listener is not None:
+			flight.listeners.append(listener)
+		try:
+			return await asyncio.shield(flight.task), joined
+		finally:
+			if listener is not None:
+				flight.listeners.remove(listener)
+			flight.waiters -= 1
+			if flight.waiters == 0 and not flight.task.done():
+				flight.task.cancel()
+				# the task only finishes cancelling later, and callers arriving before then need a new flight
+				self.forget(key, flight)
+
+	def forget(self, key: Hashable, flight: Flight):
+		if self.flights.get(key) is flight:
+			del self.flights[key]
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+from src.custom_types import *
+from src.search import DISCONNECTED, FOUND, SearchBudget, SearchResult, SearchSide, SearchState
+
+"""
+On-disk snapshot of the related artists graph, in CSR (compressed sparse row) form.
+
+A snapshot is a directory of .npy arrays:
+
+ids.npy 			-> sorted artist IDs (fixed width bytes); an artist's position is its int32 index
+offsets.npy 		-> int64[N+1], related artists of artist i are neighbors[offsets[i]:offsets[i+1]]
+neighbors.npy 		-> int32 indices of related artists
+expanded.npy 		-> bool[N], whether the artist's related artists are known (not just referenced)
+
+The arrays are memory-mapped read-only, so every worker process on a host shares the same pages.
+
+Searches over the snapshot are CPU-bound, so a SearchPool runs them off the event loop: in separate processes
+(SIX_DEGREES_SEARCH_PROCESSES), each mapping the same files, or on a thread where processes can't be used, which
+only keeps the loop running while the search is inside numpy or waiting for the GIL. Only the snapshot's part of a
+search runs there; a search the snapshot can't settle is continued on the loop, where it mostly waits on Spotify and
+Redis.
+"""
+
+IDS_FILE: str = "ids.npy"
+OFFSETS_FILE: str = "offsets.npy"
+NEIGHBORS_FILE: str = "neighbors.npy"
+EXPANDED_FILE: str = "expanded.npy"
+
+# Spotify IDs are base62, 22 characters
+ARTIST_ID_LENGTH: int = 22
+
+
+class GraphSnapshot:
+	def __init__(self, path: str):
+		self.path = path
+		self.ids: np.ndarray = np.load(os.path.join(path, IDS_FILE), mmap_mode='r')
+		self.offsets: np.ndarray = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+		self.neighbors: np.ndarray = np.load(os.path.join(path, NEIGHBORS_FILE), mmap_mode='r')
+		self.expanded: np.ndarray = np.load(os.path.join(path, EXPANDED_FILE), mmap_mode='r')
+
+	def __len__(self) -> int:
+		return len(self.ids)
+
+	# int index of an artist, or -1 if the snapshot has never seen it
+	def index(self, artist_id: ArtistID) -> int:
+		key = artist_id.encode('utf-8')
+		i = int(np.searchsorted(self.ids, key))
+		if i < len(self.ids) and self.ids[i] == key:
+			return i
+		return -1
+
+	def artist_id(self, index: int) -> ArtistID:
+		return str(self.ids[index], 'utf-8')
+
+	def artist_ids(self, indices: np.ndarray) -> List[ArtistID]:
+		return [str(i, 'utf-8') for i in self.ids[indices]]
+
+	# related artists of an artist, or None if the snapshot doesn't know them
+	def related(self, artist_id: ArtistID) -> Optional[List[ArtistID]]:
+		i = self.index(artist_id)
+		if i < 0 or not self.expanded[i]:
+			return None
+		return [self.artist_id(j) for j in self.neighbors[self.offsets[i]:self.offsets[i + 1]]]
+
+	def related_many(self, artist_ids: Iterable[ArtistID]) -> Dict[ArtistID, List[ArtistID]]:
+		res: Dict[ArtistID, List[ArtistID]] = {}
+		for artist_id in artist_ids:
+			related = self.related(artist_id)
+			if related is not None:
+				res[artist_id] = related
+		return res
+
+	# all related artists of a frontier of indices at once
+	# returns (neighbor indices, index of the frontier artist each one was reached from)
+	def expand(self, frontier: np.ndarray):
+		return expand_rows(self.offsets, self.neighbors, frontier)
+
+	# bidirectional BFS over the arrays, expanding a whole frontier per step with vectorized operations
+	# stops before a level with artists whose related artists aren't in the snapshot, or one that would take it over
+	# the budget, and returns how far it got for search.BidirectionalSearch.resume to continue with other sources of
+	# related artists (from scratch if the snapshot doesn't have an endpoint)
+	def search(self, source: ArtistID, target: ArtistID, budget: Optional[SearchBudget]=None) -> Union[SearchResult, SearchState]:
+		if source == target:
+			return SearchResult([source], 0, FOUND)
+		source_index = self.index(source)
+		target_index = self.index(target)
+		if source_index < 0 or target_index < 0:
+			return SearchState(SearchSide(source), SearchSide(target), 0)
+
+		# parents per side, -1 if undiscovered; roots are their own parents
+		parents = [np.full(len(self.ids), -1, dtype=np.int32), np.full(len(self.ids), -1, dtype=np.int32)]
+		parents[0][source_index] = source_index
+		parents[1][target_index] = target_index
+		# artists discovered at each depth, per side; the last level is the frontier
+		levels = [[np.array([source_index], dtype=np.int32)], [np.array([target_index], dtype=np.int32)]]
+		expanded = 0
+
+		# same level-synchronous scheme as search.BidirectionalSearch: grow the smaller side,
+		# and the first artist discovered by both sides completes a shortest path
+		while True:
+			if not len(levels[0][-1]) or not len(levels[1][-1]):
+				return SearchResult([], expanded, DISCONNECTED)
+			side = 0 if len(levels[0][-1]) <= len(levels[1][-1]) else 1
+			frontier = levels[side][-1]
+			if not self.expanded[frontier].all():
+				return self.search_state(parents, levels, expanded)
+			# the fallback expands as much of the level as the budget allows
+			if budget is not None and budget.exhausted(expanded + len(frontier) - 1):
+				return self.search_state(parents, levels, expanded)
+			found, reached_from = self.expand(frontier)
+			new = parents[side][found] == -1
+			meets = new & (parents[1 - side][found] != -1)
+			if meets.any():
+				first_meet = int(np.argmax(meets))
+				meet = int(found[first_meet])
+				parents[side][meet] = reached_from[first_meet]
+				# counted up to the artist the meet was reached from, as search.BidirectionalSearch counts
+				row_ends = np.cumsum(self.offsets[frontier + 1] - self.offsets[frontier])
+				expanded += int(np.searchsorted(row_ends, first_meet, side='right')) + 1
+				return SearchResult(self.trace(parents, meet), expanded, FOUND)
+			expanded += len(frontier)
+			found, first = np.unique(found[new], return_index=True)
+			parents[side][found] = reached_from[new][first]
+			levels[side].append(found.astype(np.int32))
+
+	# the sides of a search over the arrays as search.SearchSide objects
+	def search_state(self, parents: List[np.ndarray], levels: List[List[np.ndarray]], expanded: int) -> SearchState:
+		sides: List[SearchSide] = []
+		for side_parents, side_levels in zip(parents, levels):
+			side = SearchSide(self.artist_id(int(side_levels[0][0])))
+			for depth, level in enumerate(side_levels[1:], 1):
+				for artist_id, parent_id in zip(self.artist_ids(level), self.artist_ids(side_parents[level])):
+					side.parents[artist_id] = parent_id
+					side.depths[artist_id] = depth
+			side.queue = deque(self.artist_ids(side_levels[-1]))
+			side.depth = len(side_levels) - 1
+			sides.append(side)
+		return SearchState(sides[0], sides[1], expanded)
+
+	def trace(self, parents: List[np.ndarray], intersect: int) -> List[ArtistID]:
+		halves: List[List[int]] = []
+		for side_parents in parents:
+			half = [intersect]
+			while side_parents[half[-1]] != half[-1]:
+				half.append(int(side_parents[half[-1]]))
+			halves.append(half)
+		path = halves[0][::-1] + halves[1][1:]
+		return [self.artist_id(i) for i in path]
+
+
+# the rows of a CSR graph for a frontier of indices, concatenated
+# returns (neighbor indices, index of the frontier artist each one was reached from)
+def expand_rows(offsets: np.ndarray, neighbors: np.ndarray, frontier: np.ndarray):
+	starts = offsets[frontier]
+	counts = offsets[frontier + 1] - starts
+	total = int(counts.sum())
+	# positions into neighbors: each artist's start offset repeated over its row, plus a running index
+	row_starts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+	positions = row_starts + np.arange(total)
+	return neighbors[positions], np.repeat(frontier, counts)
+
+
+# load the snapshot at path, or None if there isn't a usable one
+def load(path: str) -> Optional[GraphSnapshot]:
+	if not path:
+		return None
+	try:
+		graph = GraphSnapshot(path)
+	except (OSError, ValueError) as e:
+		print("Could not load graph snapshot from {}: {}".format(path, e))
+		return None
+	print("Loaded graph snapshot of {} artists from {}".format(len(graph), path))
+	return graph
+
+
+# the snapshot of a search process, loaded by init_search_process
+process_graph: Optional[GraphSnapshot] = None
+
+
+def init_search_process(path: str):
+	global process_graph
+	process_graph = GraphSnapshot(path)
+
+
+def search_in_process(source: ArtistID, target: ArtistID, budget: Optional[SearchBudget]) -> Union[SearchResult, SearchState]:
+	return process_graph.search(source, target, budget)
+
+
+# runs snapshot searches in a pool of processes so they don't block the event loop, or on a thread without one
+# only the endpoint IDs and budget, and the result (or how far the search got) cross between processes; the graph
+# is mapped by each of them
+class SearchPool:
+	def __init__(self, graph: GraphSnapshot, processes: int):
+		self.graph = graph
+		self.processes = processes
+		self.executor: Optional[ProcessPoolExecutor] = None
+
+	async def start(self):
+		if self.processes <= 0:
+			return
+		# processes can't be started from hypercorn's (daemonic) workers when it runs more than one
+		if multiprocessing.current_process().daemon:
+			print("Search processes need a single hypercorn worker; searching the snapshot on a thread")
+			return
+		# spawned, so they don't inherit the event loop and its connections
+		self.executor = ProcessPoolExecutor(self.processes, multiprocessing.get_context('spawn'), init_search_process, (self.graph.path,))
+		# start them now instead of on the first searches
+		loop = asyncio.get_event_loop()
+		await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.processes)])
+		print("Started {} search processes".format(self.processes))
+
+	# same as GraphSnapshot.search, in a search process if they are running, otherwise on a thread
+	async def search(self, source: ArtistID, target: ArtistID, budget: Optional[SearchBudget]=None) -> Union[SearchResult, SearchState]:
+		loop = asyncio.get_event_loop()
+		if self.executor is not None:
+			try:
+				return await loop.run_in_executor(self.executor, search_in_process, source, target, budget)
+			except BrokenProcessPool as e:
+				print("Search processes failed, searching the snapshot on a thread: {!r}".format(e))
+				self.executor = None
+		return await loop.run_in_executor(None, self.graph.search, source, target, budget)
+
+	def stop(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+
+# write a snapshot of the given related artists lists to path, replacing any snapshot already there
+# files are written to a temporary directory first so readers never see a partial snapshot
+def write(path: str, related: Dict[ArtistID, List[ArtistID]]):
+	all_ids = set(related.keys())
+	for related_artists_ids in related.values():
+		all_ids.update(related_artists_ids)
+	sorted_ids = sorted(all_ids)
+	index = {artist_id: i for i, artist_id in enumerate(sorted_ids)}
+	width = max([ARTIST_ID_LENGTH] + [len(i) for i in sorted_ids])
+
+	ids = np.array([i.encode('utf-8') for i in sorted_ids], dtype='S{}'.format(width))
+	offsets = np.zeros(len(sorted_ids) + 1, dtype=np.int64)
+	expanded = np.zeros(len(sorted_ids), dtype=np.bool_)
+	rows: List[List[int]] = []
+	for i, artist_id in enumerate(sorted_ids):
+		row = [index[j] for j in related.get(artist_id, [])]
+		rows.append(row)
+		offsets[i + 1] = offsets[i] + len(row)
+		expanded[i] = artist_id in related
+	neighbors = np.fromiter((j for row in rows for j in row), dtype=np.int32, count=int(offsets[-1]))
+
+	tmp_path = path.rstrip(os.sep) + ".tmp"
+	shutil.rmtree(tmp_path, ignore_errors=True)
+	os.makedirs(tmp_path)
+	np.save(os.path.join(tmp_path, IDS_FILE), ids)
+	np.save(os.path.join(tmp_path, OFFSETS_FILE), offsets)
+	np.save(os.path.join(tmp_path, NEIGHBORS_FILE), neighbors)
+	np.save(os.path.join(tmp_path, EXPANDED_FILE), expanded)
+
+	# swap directories; processes that already mapped the old files keep reading them until they reload
+	old_path = path.rstrip(os.sep) + ".old"
+	shutil.rmtree(old_path, ignore_errors=True)
+	if os.path.exists(path):
+		os.rename(path, old_path)
+	os.rename(tmp_path, path)
+	shutil.rmtree(old_path, ignore_errors=True)
+	print("Wrote graph snapshot of {} artists ({} expanded) to {}".format(len(sorted_ids), len(related), path))
+
+
+# read every cached related artists list from Redis
+async def read_related_from_redis(batch_size: int=1000) -> Dict[ArtistID, List[ArtistID]]:
+	import src.cache as cache
+	import src.clients as clients
+
+	related: Dict[ArtistID, List[ArtistID]] = {}
+	batch: List[ArtistID] = []
+	async for key in clients.redis.iscan(match='*', count=batch_size):
+		# related artists lists are keyed by bare artist IDs; everything else has a prefix or separator
+		if len(key) != ARTIST_ID_LENGTH or b':' in key:
+			continue
+		batch.append(str(key, 'utf-8'))
+		if len(batch) >= batch_size:
+			related.update(await cache.read_related_artists_many(batch))
+			batch = []
+	if batch:
+		related.update(await cache.read_related_artists_many(batch))
+	return related
+
+
+async def build_from_redis(path: str):
+	import src.clients as clients
+
+	await clients.init_redis()
+	if clients.redis is None:
+		return
+	try:
+		related = await read_related_from_redis()
+	finally:
+		await clients.close_redis()
+	write(path, related)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Build a graph snapshot from the related artists cached in Redis")
+	parser.add_argument('path', help="snapshot directory to write")
+	args = parser.parse_args()
+
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(build_from_redis(args.path))
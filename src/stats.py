@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import json
+from email.utils import formatdate, parsedate_to_datetime
+from time import time
+from typing import Awaitable, Callable, Dict, Optional
+
+"""
+Materialized /api/stats document.
+
+Building the stats takes several Redis reads and a batch of artist metadata lookups, so it is done by a
+background task instead of per request: every `interval` seconds, or sooner once `refresh_after` new connections
+have been recorded. Requests are served the last built document, with an ETag and Last-Modified for
+conditional requests.
+"""
+
+
+class StatsDocument:
+	def __init__(self, stats: Dict):
+		self.body: bytes = json.dumps(stats).encode('utf-8')
+		self.etag: str = '"{}"'.format(hashlib.sha1(self.body).hexdigest())
+		# HTTP dates have second precision
+		self.last_modified: float = float(int(time()))
+		self.last_modified_header: str = formatdate(self.last_modified, usegmt=True)
+
+	# whether a request with these conditional headers can be answered with 304 Not Modified
+	def not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+		if if_none_match:
+			return self.etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+		if if_modified_since:
+			try:
+				return parsedate_to_datetime(if_modified_since).timestamp() >= self.last_modified
+			except (TypeError, ValueError):
+				return False
+		return False
+
+
+class StatsSnapshot:
+	def __init__(self, build: Callable[[], Awaitable[Optional[Dict]]], interval: float, refresh_after: int):
+		# returns the stats, or None if they can't be built right now
+		self.build = build
+		self.interval = interval
+		self.refresh_after = refresh_after
+		self.document: Optional[StatsDocument] = None
+		self.connections_since_refresh = 0
+		self.refresh_needed: Optional[asyncio.Event] = None
+		self.lock: Optional[asyncio.Lock] = None
+		self.task: Optional[asyncio.Task] = None
+
+	async def refresh(self) -> Optional[StatsDocument]:
+		async with self.lock:
+			self.connections_since_refresh = 0
+			self.refresh_needed.clear()
+			stats = await self.build()
+			if stats is not None:
+				document = StatsDocument(stats)
+				# keep the old validators if nothing changed, so clients keep getting 304s
+				if self.document is None or document.etag != self.document.etag:
+					self.document = document
+		return self.document
+
+	# the current document, building it first if there isn't one yet
+	async def get(self) -> Optional[StatsDocument]:
+		if self.document is None:
+			return await self.refresh()
+		return self.document
+
+	def connection_recorded(self):
+		self.connections_since_refresh += 1
+		if self.refresh_needed is not None and self.connections_since_refresh >= self.refresh_after:
+			self.refresh_needed.set()
+
+	async def run(self):
+		while True:
+			try:
+				await asyncio.wait_for(self.refresh_needed.wait(), self.interval)
+			except asyncio.TimeoutError:
+				pass
+			try:
+				await self.refresh()
+			except Exception as e:
+				# keep serving the previous document
+				print("Error refreshing stats: {!r}".format(e))
+
+	def start(self):
+		self.refresh_needed = asyncio.Event()
+		self.lock = asyncio.Lock()
+		self.task = asyncio.ensure_future(self.run())
+
+	async def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
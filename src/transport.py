@@ -0,0 +1,268 @@
+import asyncio
+import heapq
+import itertools
+import json
+import urllib.parse
+from base64 import b64encode
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import spotify
+from spotify.errors import Forbidden, HTTPException, NotFound, SpotifyException
+from spotify.http import HTTPClient, Route
+
+import src.metrics as metrics
+import src.settings as settings
+
+"""
+HTTP transport for the Spotify API.
+
+SpotifyHTTPClient can point at any API/token host (e.g. the local fake in src/fake_spotify.py), and handles
+429 responses for every request sharing the client: once Spotify asks us to back off, no request is sent
+until Retry-After has passed, instead of each request retrying on its own.
+
+Requests go through one keep-alive connection pool per client, reuse a bearer token shared by every client in the
+process until shortly before it expires, and are admitted by an AIMD limiter: the number of requests in flight
+grows by one per round of fast successful requests, and halves on a 429 or a slow response. Requests waiting for
+a slot are admitted by priority, so interactive requests go ahead of background work (see `priority`).
+
+With SIX_DEGREES_SPOTIFY_RECORD_PATH set, every successful response is appended to that file as a JSON line
+{"key": recording_key(...), "body": ...}, which src/fake_spotify.py can replay (--recorded).
+"""
+
+INTERACTIVE: int = 0
+BACKGROUND: int = 1
+
+# priority of Spotify requests made in the current context
+request_priority: ContextVar = ContextVar('request_priority', default=INTERACTIVE)
+
+
+# make Spotify requests (including in tasks started inside the block) at the given priority
+@contextmanager
+def priority(level: int):
+	token = request_priority.set(level)
+	try:
+		yield
+	finally:
+		request_priority.reset(token)
+
+
+class AdaptiveLimiter:
+	def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float):
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		# responses slower than this count as congestion
+		self.latency_target = latency_target
+		# requests sent before the limit was last cut were sent under the old limit, so their failures don't cut it again
+		self.last_decrease = 0.0
+		self.in_flight = 0
+		# (priority, arrival order, future) of requests waiting for a slot
+		self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+		self.arrivals = itertools.count()
+
+	async def acquire(self, level: int):
+		if self.in_flight < int(self.limit) and not self.waiters:
+			self.in_flight += 1
+			return
+		waiter = asyncio.get_event_loop().create_future()
+		heapq.heappush(self.waiters, (level, next(self.arrivals), waiter))
+		try:
+			await waiter
+		except asyncio.CancelledError:
+			# admitted just as the request was cancelled
+			if waiter.done() and not waiter.cancelled():
+				self.release()
+			else:
+				waiter.cancel()
+			raise
+
+	def release(self):
+		self.in_flight -= 1
+		self.admit()
+
+	def admit(self):
+		while self.waiters and self.in_flight < int(self.limit):
+			_, _, waiter = heapq.heappop(self.waiters)
+			if waiter.cancelled():
+				continue
+			self.in_flight += 1
+			waiter.set_result(None)
+
+	# a request sent at `sent` (time.monotonic()) succeeded after `latency` seconds
+	def succeeded(self, sent: float, latency: float):
+		if latency > self.latency_target:
+			self.decrease(sent)
+			return
+		# additive increase: about one more slot per limit's worth of successful requests
+		self.limit = min(self.maximum, self.limit + 1 / self.limit)
+		self.admit()
+
+	def throttled(self, sent: float):
+		self.decrease(sent)
+
+	def decrease(self, sent: float):
+		if sent < self.last_decrease:
+			return
+		self.limit = max(self.minimum, self.limit / 2)
+		self.last_decrease = monotonic()
+
+
+# identifies a request in recordings: its path below the API root and its sorted query
+def recording_key(path: str, params: Optional[Dict]=None) -> str:
+	query = urllib.parse.urlencode(sorted((str(k), str(v)) for k, v in (params or {}).items()))
+	return path + ('?' + query if query else '')
+
+
+def record_response(record_path: str, key: str, body: Dict):
+	# one write per line, so workers appending to the same file don't interleave
+	with open(record_path, 'a') as f:
+		f.write(json.dumps({'key': key, 'body': body}) + '\n')
+
+
+# bearer tokens by (token URL, client ID): (access token, time.monotonic() it expires), shared by every client
+tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+
+
+class SpotifyHTTPClient(HTTPClient):
+	RETRY_AMOUNT = 10
+
+	# not calling HTTPClient.__init__, which opens a session with default connection settings
+	def __init__(self, client_id, client_secret, loop=None, api_url: str=None, token_url: str=None):
+		self.loop = loop or asyncio.get_event_loop()
+		connector = aiohttp.TCPConnector(limit=settings.SPOTIFY_POOL_SIZE, keepalive_timeout=settings.SPOTIFY_KEEPALIVE_TIMEOUT, ttl_dns_cache=300, loop=self.loop)
+		self._session = aiohttp.ClientSession(connector=connector, loop=self.loop)
+		self.client_id = client_id
+		self.client_secret = client_secret
+		self.bearer_info = None
+
+		self.api_url = (api_url or settings.SPOTIFY_API_URL).rstrip('/')
+		self.token_url = token_url or settings.SPOTIFY_TOKEN_URL
+		# no requests are sent before this time (time.monotonic() seconds)
+		self.retry_after_until = 0.0
+		self.limiter = AdaptiveLimiter(settings.SPOTIFY_CONCURRENCY_INITIAL, settings.SPOTIFY_CONCURRENCY_MIN, settings.SPOTIFY_CONCURRENCY_MAX, settings.SPOTIFY_LATENCY_TARGET)
+		# held while fetching a token, so concurrent requests wait for one fetch instead of each making their own
+		self.token_lock = asyncio.Lock()
+
+	async def get_bearer_info(self):
+		if self.client_id is None:
+			raise SpotifyException('client_id was `None` when getting a bearer token.')
+		elif self.client_secret is None:
+			raise SpotifyException('client_secret was `None` when getting a bearer token.')
+
+		token = b64encode(':'.join((self.client_id, self.client_secret)).encode())
+		kwargs = {
+			'url': self.token_url,
+			'data': {'grant_type': 'client_credentials'},
+			'headers': {'Authorization': 'Basic ' + token.decode()}
+		}
+		async with self._session.post(**kwargs) as resp:
+			return json.loads(await resp.text(encoding='utf-8'))
+
+	# a bearer token valid for a while yet, fetched if there isn't one
+	# `rejected` is a token the API refused, which is replaced unless another request already replaced it
+	async def access_token(self, rejected: str=None) -> str:
+		key = (self.token_url, self.client_id)
+		token = tokens.get(key)
+		if token is not None and token[0] != rejected and token[1] > monotonic() + settings.SPOTIFY_TOKEN_EXPIRY_MARGIN:
+			return token[0]
+		async with self.token_lock:
+			token = tokens.get(key)
+			if token is not None and token[0] != rejected and token[1] > monotonic() + settings.SPOTIFY_TOKEN_EXPIRY_MARGIN:
+				return token[0]
+			self.bearer_info = await self.get_bearer_info()
+			tokens[key] = (self.bearer_info['access_token'], monotonic() + float(self.bearer_info.get('expires_in', 3600)))
+			return self.bearer_info['access_token']
+
+	def url_for(self, route) -> tuple:
+		if isinstance(route, tuple):
+			return route
+		url = route.url
+		if url.startswith(Route.BASE):
+			url = self.api_url + url[len(Route.BASE):]
+		return route.method, url
+
+	# wait out any Retry-After another request was given
+	async def wait_for_rate_limit(self):
+		delay = self.retry_after_until - monotonic()
+		while delay > 0:
+			await asyncio.sleep(delay)
+			delay = self.retry_after_until - monotonic()
+
+	def rate_limited(self, retry_after: float):
+		self.retry_after_until = max(self.retry_after_until, monotonic() + retry_after)
+
+	async def request(self, route, **kwargs):
+		method, url = self.url_for(route)
+
+		headers = {
+			'Content-Type': kwargs.pop('content_type', 'application/json'),
+			'User-Agent': self.user_agent,
+			**kwargs.pop('headers', {})
+		}
+
+		r = None
+		data = {}
+		level = request_priority.get()
+		# the route's path template, e.g. /artists/{spotify_id}/related-artists
+		endpoint = getattr(route, 'path', 'other')
+		for attempt in range(self.RETRY_AMOUNT):
+			await self.wait_for_rate_limit()
+			access_token = await self.access_token()
+			headers['Authorization'] = 'Bearer ' + access_token
+			await self.limiter.acquire(level)
+			try:
+				sent = monotonic()
+				r = await self._session.request(method, url, headers=headers, **kwargs)
+				try:
+					status = r.status
+					try:
+						data = json.loads(await r.text(encoding='utf-8'))
+					except json.decoder.JSONDecodeError:
+						data = {}
+				finally:
+					await r.release()
+				latency = monotonic() - sent
+			finally:
+				self.limiter.release()
+			metrics.record(metrics.spotify_request_seconds, latency, endpoint, status, span='spotify ' + endpoint)
+
+			if 300 > status >= 200:
+				self.limiter.succeeded(sent, latency)
+				metrics.spotify_concurrency_limit.set(self.limiter.limit)
+				if settings.SPOTIFY_RECORD_PATH and url.startswith(self.api_url):
+					record_response(settings.SPOTIFY_RECORD_PATH, recording_key(url[len(self.api_url):], kwargs.get('params')), data)
+				return data
+
+			if status == 401:
+				await self.access_token(rejected=access_token)
+				continue
+
+			if status == 429:
+				# we're being rate limited; every request on this client waits, and fewer are sent at once
+				self.limiter.throttled(sent)
+				metrics.spotify_concurrency_limit.set(self.limiter.limit)
+				self.rate_limited(float(r.headers.get('Retry-After', 1)))
+				continue
+
+			if status in (500, 502, 503, 504):
+				await asyncio.sleep(min(2 ** attempt * 0.1, 5))
+				continue
+
+			if status == 403:
+				raise Forbidden(r, data)
+			elif status == 404:
+				raise NotFound(r, data)
+			raise HTTPException(r, data)
+		raise HTTPException(r, data)
+
+
+class SpotifyClient(spotify.Client):
+	_default_http_client = SpotifyHTTPClient
+
+
+def create_client(client_id: str, client_secret: str) -> SpotifyClient:
+	return SpotifyClient(client_id, client_secret)
@@ -0,0 +1,142 @@
+import heapq
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+from sortedcontainers import SortedList
+
+from src.custom_types import *
+from src.lru import LRUCache
+import src.settings as settings
+
+"""
+Local typeahead for /api/search.
+
+A prefix index over the names of artists the system already knows about (from the metadata cache, search
+results and crawled related artists), ranked by followers, plus a TTL cache of results by normalized query.
+Spotify only needs to be searched when neither can answer a query.
+"""
+
+
+def normalize(query: str) -> str:
+	decomposed = unicodedata.normalize('NFKD', query)
+	stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+	return ' '.join(stripped.casefold().split())
+
+
+# the name and every word-suffix of it, so "swi" finds "Taylor Swift"
+def name_terms(name: str) -> List[str]:
+	words = normalize(name).split(' ')
+	return [' '.join(words[i:]) for i in range(len(words)) if words[i]]
+
+
+class PrefixIndex:
+	def __init__(self, memo_threshold: int=200, memo_size: int=20):
+		# (term, artist ID), sorted so all terms with a prefix form one contiguous range
+		self.terms: SortedList = SortedList()
+		self.artists: Dict[ArtistID, Dict] = {}
+		# top artists for prefixes matching more than memo_threshold artists, which are too many to rank on
+		# every keystroke; kept up to date as artists are added
+		self.memo_threshold = memo_threshold
+		self.memo_size = memo_size
+		self.memo: Dict[str, List[ArtistID]] = {}
+
+	def __len__(self) -> int:
+		return len(self.artists)
+
+	def rank(self, artist_id: ArtistID) -> int:
+		return self.artists[artist_id].get('followers') or 0
+
+	def add(self, artist_dict: Dict):
+		artist_id = artist_dict['id']
+		previous = self.artists.get(artist_id)
+		if previous is not None:
+			if previous.get('name') == artist_dict.get('name') and previous.get('followers') == artist_dict.get('followers'):
+				self.artists[artist_id] = artist_dict
+				return
+			self.remove(artist_id)
+		self.artists[artist_id] = artist_dict
+		for term in name_terms(artist_dict.get('name', '')):
+			self.terms.add((term, artist_id))
+			for length in range(1, len(term) + 1):
+				memo = self.memo.get(term[:length])
+				if memo is not None and artist_id not in memo:
+					memo.append(artist_id)
+					memo.sort(key=self.rank, reverse=True)
+					del memo[self.memo_size:]
+
+	def add_many(self, artist_dicts: Iterable[Dict]):
+		for d in artist_dicts:
+			self.add(d)
+
+	def remove(self, artist_id: ArtistID):
+		artist_dict = self.artists.pop(artist_id, None)
+		if artist_dict is None:
+			return
+		for term in name_terms(artist_dict.get('name', '')):
+			self.terms.discard((term, artist_id))
+			# its memoized prefixes may now be missing a lower ranked artist, so recompute them when next used
+			for length in range(1, len(term) + 1):
+				memo = self.memo.get(term[:length])
+				if memo is not None and artist_id in memo:
+					del self.memo[term[:length]]
+
+	# all artists with a term starting with prefix
+	def matches(self, prefix: str) -> List[ArtistID]:
+		terms = self.terms.irange((prefix,), (prefix + '\U0010ffff',))
+		return list(dict.fromkeys(artist_id for _, artist_id in terms))
+
+	# known artists with a name (or word of it) starting with query, most followed first
+	def search(self, query: str, limit: int) -> List[Dict]:
+		prefix = normalize(query)
+		if not prefix:
+			return []
+		if prefix in self.memo and limit <= self.memo_size:
+			ids = self.memo[prefix][:limit]
+		else:
+			matches = self.matches(prefix)
+			ids = heapq.nlargest(max(limit, self.memo_size), matches, key=self.rank)
+			if len(matches) > self.memo_threshold:
+				self.memo[prefix] = ids[:self.memo_size]
+			ids = ids[:limit]
+		return [self.artists[i] for i in ids]
+
+
+index = PrefixIndex()
+
+# search results by normalized query
+result_cache = LRUCache(settings.TYPEAHEAD_CACHE_MAX_ENTRIES, 0, settings.TYPEAHEAD_CACHE_TTL)
+
+
+# results for a query from the result cache or the local index, or None if Spotify has to be asked
+def lookup(query: str, limit: int) -> Optional[List[Dict]]:
+	key = normalize(query)
+	res = result_cache.get(key)
+	if res is not None:
+		return res
+	res = index.search(key, limit)
+	if len(res) >= min(limit, settings.TYPEAHEAD_MIN_LOCAL_RESULTS):
+		result_cache.set(key, res)
+		return res
+	return None
+
+
+def cache_results(query: str, artist_dicts: List[Dict]):
+	result_cache.set(normalize(query), artist_dicts)
+
+
+# index every artist dict cached in Redis (run in the background at startup)
+async def load_from_redis(batch_size: int=1000):
+	import src.cache as cache
+	import src.clients as clients
+
+	if not cache.redis_connected():
+		return
+	batch: List[ArtistID] = []
+	async for key in clients.redis.iscan(match=cache.ARTIST_DICT_KEY_PREFIX + '*', count=batch_size):
+		batch.append(str(key, 'utf-8')[len(cache.ARTIST_DICT_KEY_PREFIX):])
+		if len(batch) >= batch_size:
+			index.add_many((await cache.get_artist_dicts_many(batch)).values())
+			batch = []
+	if batch:
+		index.add_many((await cache.get_artist_dicts_many(batch)).values())
+	print("Typeahead index loaded with {} artists".format(len(index)))
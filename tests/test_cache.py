@@ -0,0 +1,141 @@
+import asyncio
+import unittest
+from typing import Dict, List
+
+try:
+	import fakeredis.aioredis
+except ImportError:
+	fakeredis = None
+
+from src.custom_types import *
+import src.cache as cache
+import src.clients as clients
+
+"""
+Redis scripts and stats indexes in src/cache.py, run against fakeredis (pip install -r benchmarks/requirements.txt).
+
+python -m unittest discover tests
+"""
+
+
+def run(coroutine):
+	return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class RedisTestCase(unittest.TestCase):
+	def setUp(self):
+		self.redis = run(fakeredis.aioredis.create_redis_pool())
+		run(self.redis.flushall())
+		clients.redis = self.redis
+		cache.related_artists_tier.clear()
+
+	def tearDown(self):
+		clients.redis = None
+		self.redis.close()
+		run(self.redis.wait_closed())
+
+	def hash(self, key: str) -> Dict[str, int]:
+		return {str(k, 'utf-8'): int(v) for k, v in run(self.redis.hgetall(key)).items()}
+
+	def zset(self, key: str) -> Dict[str, float]:
+		return {str(k, 'utf-8'): v for k, v in run(self.redis.zrange(key, 0, -1, withscores=True))}
+
+	def number(self, key: str) -> int:
+		return int(run(self.redis.get(key)) or 0)
+
+
+class ConnectionStatsTest(RedisTestCase):
+	def test_connection_counted_once(self):
+		path = ['a', 'x', 'y', 'b']
+		self.assertTrue(run(cache.store_connection_length('a', 'b', path)))
+		# either direction is the same connection
+		self.assertFalse(run(cache.store_connection_length('b', 'a', path[::-1])))
+		self.assertFalse(run(cache.store_connection_length('a', 'b', [])))
+		self.assertEqual(self.hash(cache.CONNECTION_LENGTHS_KEY), {'a:b': 4})
+		self.assertEqual(self.number(cache.DEGREES_SUM_KEY), 3)
+		self.assertEqual(self.number(cache.CONNECTIONS_COUNT_KEY), 1)
+		self.assertEqual(self.zset(cache.CONNECTION_LENGTHS_RANK_KEY), {'a:b': 4})
+		self.assertEqual(self.zset(cache.NONEXISTENT_CONNECTIONS_KEY), {})
+
+	def test_no_path_upgraded_once_found(self):
+		self.assertTrue(run(cache.store_connection_length('a', 'b', [])))
+		self.assertFalse(run(cache.store_connection_length('a', 'b', [])))
+		self.assertEqual(list(self.zset(cache.NONEXISTENT_CONNECTIONS_KEY)), ['a:b'])
+		self.assertEqual(self.number(cache.CONNECTIONS_COUNT_KEY), 0)
+
+		self.assertTrue(run(cache.store_connection_length('a', 'b', ['a', 'x', 'b'])))
+		self.assertEqual(self.zset(cache.NONEXISTENT_CONNECTIONS_KEY), {})
+		self.assertEqual(self.zset(cache.CONNECTION_LENGTHS_RANK_KEY), {'a:b': 3})
+		self.assertEqual(self.number(cache.DEGREES_SUM_KEY), 2)
+		self.assertEqual(self.number(cache.CONNECTIONS_COUNT_KEY), 1)
+
+		# a found connection isn't downgraded, or counted again
+		self.assertFalse(run(cache.store_connection_length('a', 'b', [])))
+		self.assertFalse(run(cache.store_connection_length('a', 'b', ['a', 'y', 'b'])))
+		self.assertEqual(self.hash(cache.CONNECTION_LENGTHS_KEY), {'a:b': 3})
+		self.assertEqual(self.number(cache.DEGREES_SUM_KEY), 2)
+		self.assertEqual(self.number(cache.CONNECTIONS_COUNT_KEY), 1)
+
+	# the indexes rebuilt from the stats hashes are the ones maintained as connections are recorded
+	def test_rebuild_matches_incremental(self):
+		connections: List[List[ArtistID]] = [
+			['a', 'x', 'b'],
+			['b', 'y', 'z', 'c'],
+			['a', 'x', 'b', 'y', 'z', 'c'],
+			['d', 'e'],
+		]
+		for path in connections:
+			run(cache.new_connection_stats(path[0], path[-1], path))
+		run(cache.new_connection_stats('a', 'q', []))
+		run(cache.new_connection_stats('c', 'r', []))
+		run(cache.new_connection_stats('d', 'r', []))
+		# one of them found later, and some connections viewed again
+		run(cache.new_connection_stats('d', 'r', ['d', 'e', 'r']))
+		for a, b in [('a', 'b'), ('c', 'b'), ('a', 'b'), ('a', 'q')]:
+			run(cache.cached_connection_stats(a, b, []))
+
+		index_keys = [cache.ARTIST_SEARCHES_RANK_KEY, cache.CONNECTION_SEARCHES_RANK_KEY, cache.CONNECTION_LENGTHS_RANK_KEY]
+		incremental = [self.zset(k) for k in index_keys]
+		nonexistent = set(self.zset(cache.NONEXISTENT_CONNECTIONS_KEY))
+		degrees_sum, connections_count = self.number(cache.DEGREES_SUM_KEY), self.number(cache.CONNECTIONS_COUNT_KEY)
+		self.assertEqual(nonexistent, {'a:q', 'c:r'})
+		self.assertEqual((degrees_sum, connections_count), (2 + 3 + 5 + 1 + 2, 5))
+
+		# as if the connections had been recorded before the indexes existed
+		run(self.redis.delete(*index_keys, cache.NONEXISTENT_CONNECTIONS_KEY, cache.DEGREES_SUM_KEY, cache.CONNECTIONS_COUNT_KEY))
+		self.assertTrue(run(cache.ensure_stats_indexes()))
+		self.assertEqual([self.zset(k) for k in index_keys], incremental)
+		# ranked by when they were found only as they are recorded
+		self.assertEqual(set(self.zset(cache.NONEXISTENT_CONNECTIONS_KEY)), nonexistent)
+		self.assertEqual((self.number(cache.DEGREES_SUM_KEY), self.number(cache.CONNECTIONS_COUNT_KEY)), (degrees_sum, connections_count))
+
+		# built once per version
+		self.assertFalse(run(cache.ensure_stats_indexes()))
+
+
+class StorePathTest(RedisTestCase):
+	def test_every_pair_on_the_path_is_stored(self):
+		path = ['d', 'b', 'a', 'c']
+		self.assertTrue(run(cache.store_path('d', 'c', path)))
+		for i in range(len(path)):
+			for j in range(i + 1, len(path)):
+				# read in either direction
+				self.assertEqual(run(cache.get_path(path[i], path[j]))[0], path[i:j + 1])
+				self.assertEqual(run(cache.get_path(path[j], path[i]))[0], path[i:j + 1][::-1])
+		self.assertEqual(len(run(self.redis.keys('*:*'))), 6)
+
+	def test_cached_inner_pairs_are_left_alone(self):
+		# equally short, stored earlier
+		self.assertTrue(run(cache.store_path('b', 'c', ['b', 'x', 'c'])))
+		self.assertTrue(run(cache.store_path('a', 'd', ['a', 'y', 'd'])))
+		self.assertTrue(run(cache.store_path('a', 'd', ['a', 'b', 'z', 'c', 'd'])))
+		self.assertEqual(run(cache.get_path('b', 'c'))[0], ['b', 'x', 'c'])
+		self.assertEqual(run(cache.get_path('a', 'c'))[0], ['a', 'b', 'z', 'c'])
+		# the endpoints' own path is replaced
+		self.assertEqual(run(cache.get_path('a', 'd'))[0], ['a', 'b', 'z', 'c', 'd'])
+		self.assertEqual(run(cache.get_path('d', 'a'))[0], ['d', 'c', 'z', 'b', 'a'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+
+import src.cache as cache
+import src.metrics as metrics
+from src.lru import LRUCache
+
+"""
+Bounds of the in-process LRU caches (entries, bytes, TTL), and their counts as published on /metrics.
+
+python -m unittest discover tests
+"""
+
+
+def sizeof(value: str) -> int:
+	return len(value)
+
+
+class LRUCacheTest(unittest.TestCase):
+	def test_entry_bound_evicts_least_recently_used(self):
+		lru = LRUCache(max_entries=3, sizeof=sizeof)
+		for key in 'abc':
+			lru.set(key, key * 2)
+		# reading a makes b the least recently used
+		self.assertEqual(lru.get('a'), 'aa')
+		lru.set('d', 'dd')
+		self.assertEqual(len(lru), 3)
+		self.assertIsNone(lru.get('b'))
+		self.assertEqual([lru.get(k) for k in 'acd'], ['aa', 'cc', 'dd'])
+		self.assertEqual(lru.stats()['evictions'], 1)
+
+	def test_byte_bound(self):
+		lru = LRUCache(max_bytes=10, sizeof=sizeof)
+		lru.set('a', 'x' * 4)
+		lru.set('b', 'x' * 4)
+		self.assertEqual(lru.bytes, 8)
+		# evicts a to make room
+		lru.set('c', 'x' * 4)
+		self.assertEqual(lru.bytes, 8)
+		self.assertNotIn('a', lru)
+		# replacing an entry counts its new size only
+		lru.set('b', 'x' * 2)
+		self.assertEqual(lru.bytes, 6)
+		# bigger than the whole cache: not stored, and nothing evicted for it
+		lru.set('d', 'x' * 11)
+		self.assertNotIn('d', lru)
+		self.assertEqual(lru.stats()['entries'], 2)
+		self.assertEqual(lru.stats()['evictions'], 1)
+
+	def test_ttl(self):
+		now = [1000.0]
+		with mock.patch('src.lru.monotonic', lambda: now[0]):
+			lru = LRUCache(ttl=10, sizeof=sizeof)
+			lru.set('a', 'aa')
+			lru.set('b', 'bb', ttl=30)
+			lru.set('c', 'cc', ttl=0)
+			now[0] += 15
+			self.assertIsNone(lru.get('a'))
+			self.assertEqual(lru.get('b'), 'bb')
+			# a TTL of 0 never expires
+			self.assertEqual(lru.get('c'), 'cc')
+			now[0] += 20
+			self.assertIsNone(lru.get('b'))
+		stats = lru.stats()
+		self.assertEqual((stats['entries'], stats['bytes'], stats['expirations']), (1, 2, 2))
+		self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+
+class CacheMetricsTest(unittest.TestCase):
+	def setUp(self):
+		self.enabled = metrics.enabled
+		metrics.enabled = True
+		cache.related_artists_tier.clear()
+
+	def tearDown(self):
+		metrics.enabled = self.enabled
+		cache.related_artists_tier.clear()
+
+	def test_related_artists_tier_is_published(self):
+		cache.related_artists_tier.set('a', ('b', 'c'))
+		lines = metrics.render().splitlines()
+		self.assertIn('six_degrees_memory_cache_entries{cache="related_artists_memory"} 1', lines)
+		self.assertIn('six_degrees_memory_cache_bytes{{cache="related_artists_memory"}} {}'.format(cache.related_artists_tier.bytes), lines)
+		self.assertTrue(any(line.startswith('six_degrees_memory_cache_evictions_total{cache="related_artists_memory"} ') for line in lines))
+		self.assertTrue(any(line.startswith('six_degrees_memory_cache_expirations_total{cache="related_artists_memory"} ') for line in lines))
+
+
+if __name__ == '__main__':
+	unittest.main()
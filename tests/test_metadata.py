@@ -0,0 +1,52 @@
+import asyncio
+import random
+import unittest
+
+from benchmarks.fakes import InMemorySpotifyClient
+from benchmarks.graph import artist_id
+import src.metadata as metadata
+from src.fake_spotify import FakeSpotify
+
+"""
+Artist metadata fetched from the several-artists endpoint, against the in-process fake Spotify in benchmarks/fakes.py.
+
+python -m unittest discover tests
+"""
+
+
+def run(coroutine):
+	return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class FetchArtistDictsTest(unittest.TestCase):
+	def setUp(self):
+		rnd = random.Random(0)
+		self.ids = [artist_id(rnd) for _ in range(120)]
+		self.client = InMemorySpotifyClient(FakeSpotify({'artists': {i: {'name': i} for i in self.ids}}))
+		self.requested = []
+		respond = self.client.http.respond
+
+		# the request for the batch holding the first artist fails
+		def failing_respond(route, params):
+			ids = str(params.get('ids', '')).split(',')
+			self.requested.extend(ids)
+			if self.ids[0] in ids:
+				return 'artists', 500, {'error': {'status': 500, 'message': 'server error'}}
+			return respond(route, params)
+		self.client.http.respond = failing_respond
+
+	def test_failed_batch_is_left_out(self):
+		unknown = artist_id(random.Random(1))
+		res = run(metadata.fetch_artist_dicts(self.client, self.ids + [unknown]))
+		self.assertEqual(sorted(res), sorted(self.ids[metadata.SPOTIFY_ARTISTS_BATCH_SIZE:]))
+		self.assertEqual(len(self.requested), len(self.ids) + 1)
+
+	def test_malformed_ids_are_not_requested(self):
+		malformed = ['', 'not an id', self.ids[1][:-1], self.ids[1] + 'x', self.ids[1][:-1] + '!']
+		res = run(metadata.fetch_artist_dicts(self.client, malformed + self.ids[1:3]))
+		self.assertEqual(sorted(res), sorted(self.ids[1:3]))
+		self.assertEqual(sorted(self.requested), sorted(self.ids[1:3]))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,130 @@
+import asyncio
+import gzip
+import random
+import unittest
+
+try:
+	import fakeredis.aioredis
+except ImportError:
+	fakeredis = None
+
+from benchmarks.graph import artist_id
+import src.responses as responses
+from src.responses import choose_encoding
+
+"""
+Cached JSON responses (src/responses.py) as the routes serve them: revalidation with If-None-Match, the encoding
+chosen from Accept-Encoding, and ETags per encoding. Routes run against the in-process fakes the benchmarks use
+(pip install -r benchmarks/requirements.txt).
+
+python -m unittest discover tests
+"""
+
+
+def run(coroutine):
+	return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+# a chain of artists, with enough metadata that a path between the ends is worth compressing
+def chain_graph(length: int=5):
+	rnd = random.Random(0)
+	ids = [artist_id(rnd) for _ in range(length)]
+	artists = {i: {'name': 'Artist {}'.format(n), 'followers': 1000 * n, 'genres': ['genre {}'.format(g) for g in range(10)]} for n, i in enumerate(ids)}
+	related = {i: [j for j in ids[max(0, n - 1):n + 2] if j != i] for n, i in enumerate(ids)}
+	return ids, {'artists': artists, 'related': related}
+
+
+class ChooseEncodingTest(unittest.TestCase):
+	def test_choice(self):
+		self.assertEqual(choose_encoding('gzip, deflate, br', ['br', 'gzip']), 'br')
+		self.assertEqual(choose_encoding('gzip, deflate', ['br', 'gzip']), 'gzip')
+		self.assertEqual(choose_encoding('br;q=0, gzip;q=0.5', ['br', 'gzip']), 'gzip')
+		self.assertEqual(choose_encoding('*', ['br', 'gzip']), 'br')
+		self.assertEqual(choose_encoding('*, br;q=0', ['br', 'gzip']), 'gzip')
+		self.assertIsNone(choose_encoding('', ['br', 'gzip']))
+		self.assertIsNone(choose_encoding('identity', ['br', 'gzip']))
+		self.assertIsNone(choose_encoding('gzip;q=0', ['gzip']))
+
+
+@unittest.skipIf(fakeredis is None, "needs fakeredis")
+class ResponseRoutesTest(unittest.TestCase):
+	def setUp(self):
+		from benchmarks.run import Bench
+		self.ids, graph = chain_graph()
+		self.bench = Bench(graph)
+		run(self.bench.start())
+		run(self.bench.reset())
+		self.path = '/api/connect/{}/{}'.format(self.ids[0], self.ids[-1])
+
+	def tearDown(self):
+		run(self.bench.stop())
+
+	def get(self, path: str, **headers):
+		async def request():
+			response = await self.bench.client.get(path, headers=headers)
+			return response, await response.get_data()
+		return run(request())
+
+	def test_matching_if_none_match_is_not_modified(self):
+		response, body = self.get(self.path)
+		self.assertEqual(response.status_code, 200)
+		etag = response.headers['ETag']
+		self.assertEqual(response.headers['Cache-Control'], 'public, max-age=3600')
+
+		for if_none_match in [etag, 'W/' + etag, '"other", ' + etag, '*']:
+			response, body = self.get(self.path, **{'If-None-Match': if_none_match})
+			self.assertEqual(response.status_code, 304, if_none_match)
+			self.assertEqual(body, b'')
+			self.assertEqual(response.headers['ETag'], etag)
+		response, body = self.get(self.path, **{'If-None-Match': '"other"'})
+		self.assertEqual(response.status_code, 200)
+
+		# a client holding either representation can revalidate with it
+		gzipped, _ = self.get(self.path, **{'Accept-Encoding': 'gzip'})
+		response, _ = self.get(self.path, **{'Accept-Encoding': 'gzip', 'If-None-Match': gzipped.headers['ETag']})
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response.headers['ETag'], gzipped.headers['ETag'])
+		response, _ = self.get(self.path, **{'If-None-Match': gzipped.headers['ETag']})
+		self.assertEqual(response.status_code, 304)
+
+	def test_encoding_follows_accept_encoding(self):
+		plain, plain_body = self.get(self.path)
+		self.assertNotIn('Content-Encoding', plain.headers)
+		self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+		response, body = self.get(self.path, **{'Accept-Encoding': 'gzip'})
+		self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+		self.assertEqual(gzip.decompress(body), plain_body)
+		self.assertLess(len(body), len(plain_body))
+
+		response, body = self.get(self.path, **{'Accept-Encoding': 'gzip, br'})
+		expected = 'br' if responses.brotli is not None else 'gzip'
+		self.assertEqual(response.headers['Content-Encoding'], expected)
+		if responses.brotli is not None:
+			self.assertEqual(responses.brotli.decompress(body), plain_body)
+
+		response, body = self.get(self.path, **{'Accept-Encoding': 'gzip;q=0, br;q=0'})
+		self.assertNotIn('Content-Encoding', response.headers)
+		self.assertEqual(body, plain_body)
+
+	def test_small_responses_are_not_compressed(self):
+		response, body = self.get('/api/artist/{}'.format(self.ids[0]), **{'Accept-Encoding': 'gzip, br'})
+		self.assertEqual(response.status_code, 200)
+		self.assertNotIn('Content-Encoding', response.headers)
+		self.assertNotIn('Vary', response.headers)
+
+	def test_etags_are_stable_across_encodings(self):
+		def etags():
+			return {encoding: self.get(self.path, **{'Accept-Encoding': encoding})[0].headers['ETag'] for encoding in ['identity', 'gzip']}
+
+		first = etags()
+		# each encoding is its own representation, named after the body's ETag
+		self.assertEqual(first['gzip'], first['identity'][:-1] + '-gzip"')
+		# served from the cache, and rebuilt after it is dropped (gzip output embeds a timestamp, the ETags don't)
+		self.assertEqual(etags(), first)
+		responses.cache.clear()
+		self.assertEqual(etags(), first)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,356 @@
+import asyncio
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+from unittest import mock
+
+from src.custom_types import *
+import src.search as search
+import src.snapshot as snapshot
+
+"""
+Searches checked against plain BFS on seeded random graphs whose related artists are all mutual, where the paths the
+search finds are shortest paths (see src/search.py). Each graph has a few components plus isolated artists, so some
+pairs are not connected.
+
+python -m unittest discover tests
+"""
+
+SEEDS: List[int] = list(range(8))
+PAIRS_PER_GRAPH: int = 40
+
+
+# {artist: related artists}, symmetric, with `components` separate components and a few isolated artists
+def random_graph(seed: int, artists: int=120, components: int=3, edges_per_artist: float=1.5) -> Dict[ArtistID, List[ArtistID]]:
+	rnd = random.Random(seed)
+	ids = ['a{}'.format(i) for i in range(artists)]
+	graph: Dict[ArtistID, set] = {i: set() for i in ids}
+	groups = [ids[start::components] for start in range(components)]
+	for group in groups:
+		# leave the last few of every group isolated
+		members = group[:-2]
+		for _ in range(int(len(members) * edges_per_artist)):
+			a, b = rnd.sample(members, 2)
+			graph[a].add(b)
+			graph[b].add(a)
+	return {i: sorted(related) for i, related in graph.items()}
+
+
+def bfs_depths(graph: Dict[ArtistID, List[ArtistID]], source: ArtistID) -> Dict[ArtistID, int]:
+	depths = {source: 0}
+	queue = deque([source])
+	while queue:
+		i = queue.popleft()
+		for j in graph[i]:
+			if j not in depths:
+				depths[j] = depths[i] + 1
+				queue.append(j)
+	return depths
+
+
+def bfs_distance(graph: Dict[ArtistID, List[ArtistID]], source: ArtistID, target: ArtistID) -> Optional[int]:
+	return bfs_depths(graph, source).get(target)
+
+
+# the same graph with only some links listed both ways
+def one_way_graph(seed: int) -> Dict[ArtistID, List[ArtistID]]:
+	rnd = random.Random(seed)
+	graph = random_graph(seed, edges_per_artist=2.5)
+	return {i: [j for j in related if i < j or rnd.random() < 0.5] for i, related in graph.items()}
+
+
+def expand_from(graph: Dict[ArtistID, List[ArtistID]]) -> search.ExpandFunction:
+	async def expand(artist_ids: List[ArtistID], budget: search.SearchBudget):
+		for i in artist_ids:
+			yield i, graph[i]
+	return expand
+
+
+def run(coroutine):
+	return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class SearchTestCase(unittest.TestCase):
+	# the result is a shortest path between the pair, or says they aren't connected
+	def check_result(self, graph: Dict[ArtistID, List[ArtistID]], source: ArtistID, target: ArtistID, result: search.SearchResult):
+		distance = bfs_distance(graph, source, target)
+		if distance is None:
+			self.assertEqual(result.status, search.DISCONNECTED, (source, target))
+			self.assertEqual(result.path, [])
+			return
+		self.assertEqual(result.status, search.FOUND, (source, target))
+		self.assertEqual(result.path[0], source)
+		self.assertEqual(result.path[-1], target)
+		self.assertEqual(len(result.path) - 1, distance, (source, target, result.path))
+		for a, b in zip(result.path, result.path[1:]):
+			self.assertIn(b, graph[a])
+
+	def pairs(self, graph: Dict[ArtistID, List[ArtistID]], seed: int) -> List[List[ArtistID]]:
+		rnd = random.Random(seed)
+		ids = sorted(graph)
+		return [rnd.sample(ids, 2) for _ in range(PAIRS_PER_GRAPH)] + [[ids[0], ids[0]]]
+
+
+class BidirectionalSearchTest(SearchTestCase):
+	def test_matches_bfs(self):
+		for seed in SEEDS:
+			graph = random_graph(seed)
+			for source, target in self.pairs(graph, seed):
+				result = run(search.BidirectionalSearch(expand_from(graph)).run(source, target))
+				self.check_result(graph, source, target, result)
+
+	def test_known_path_is_returned_once_proven_shortest(self):
+		for seed in SEEDS:
+			graph = random_graph(seed)
+			for source, target in self.pairs(graph, seed):
+				if source == target or bfs_distance(graph, source, target) is None:
+					continue
+				known_path = run(search.BidirectionalSearch(expand_from(graph)).run(source, target)).path
+				result = run(search.BidirectionalSearch(expand_from(graph), known_path=known_path).run(source, target))
+				self.check_result(graph, source, target, result)
+
+	# with links listed one way, a path runs along links listed by the source's side, then by the target's side, and
+	# is no shorter than the shortest such path (one side running out of artists still ends the search)
+	def test_one_way_links(self):
+		for seed in SEEDS:
+			graph = one_way_graph(seed)
+			for source, target in self.pairs(graph, seed):
+				result = run(search.BidirectionalSearch(expand_from(graph)).run(source, target))
+				from_source, from_target = bfs_depths(graph, source), bfs_depths(graph, target)
+				meets = [from_source[i] + from_target[i] for i in from_source if i in from_target]
+				if not meets:
+					self.assertEqual(result.status, search.DISCONNECTED)
+					continue
+				if result.status == search.DISCONNECTED:
+					continue
+				self.assertEqual(result.status, search.FOUND)
+				self.assertEqual((result.path[0], result.path[-1]), (source, target))
+				self.assertGreaterEqual(len(result.path) - 1, min(meets))
+				links = list(zip(result.path, result.path[1:]))
+				self.assertTrue(any(all(b in graph[a] for a, b in links[:m]) and all(a in graph[b] for a, b in links[m:]) for m in range(len(result.path))), result.path)
+
+	def test_budget_exhausted(self):
+		graph = {'a': ['b'], 'b': ['a', 'c'], 'c': ['b', 'd'], 'd': ['c', 'e'], 'e': ['d']}
+		result = run(search.BidirectionalSearch(expand_from(graph), search.SearchBudget(max_expanded=2)).run('a', 'e'))
+		self.assertEqual(result.status, search.BUDGET_EXHAUSTED)
+		self.assertEqual(result.path, [])
+
+		# a longer known path stands in for the shortest one
+		graph['a'].append('x')
+		graph['x'] = ['a', 'y']
+		graph['y'] = ['x', 'z']
+		graph['z'] = ['y', 'w']
+		graph['w'] = ['z', 'e']
+		graph['e'].append('w')
+		known_path = ['a', 'x', 'y', 'z', 'w', 'e']
+		result = run(search.BidirectionalSearch(expand_from(graph), search.SearchBudget(max_expanded=2), known_path).run('a', 'e'))
+		self.assertEqual(result.status, search.APPROXIMATE)
+		self.assertEqual(result.path, known_path)
+
+
+class MultiTargetSearchTest(SearchTestCase):
+	def test_matches_bfs(self):
+		for seed in SEEDS:
+			graph = random_graph(seed)
+			ids = sorted(graph)
+			rnd = random.Random(seed)
+			for source in rnd.sample(ids, 4):
+				# one search per source, shared by its targets like a batch request
+				multi = search.MultiTargetSearch(expand_from(graph), source)
+				for target in rnd.sample(ids, 15) + [source]:
+					self.check_result(graph, source, target, run(multi.run(target)))
+
+	def test_budget_exhausted_then_later_targets(self):
+		for seed in SEEDS:
+			graph = random_graph(seed)
+			ids = sorted(graph)
+			rnd = random.Random(seed)
+			source = ids[0]
+			multi = search.MultiTargetSearch(expand_from(graph), source)
+			for target in rnd.sample(ids, 15):
+				distance = bfs_distance(graph, source, target)
+				result = run(multi.run(target, search.SearchBudget(max_expanded=1)))
+				if result.status == search.BUDGET_EXHAUSTED:
+					self.assertEqual(result.path, [])
+					self.assertNotEqual(distance, 0)
+				else:
+					self.check_result(graph, source, target, result)
+				# an exhausted search doesn't leave the shared side inconsistent
+				self.check_result(graph, source, target, run(multi.run(target)))
+
+
+class ExpandConcurrentlyTest(unittest.TestCase):
+	def test_stopping_early_keeps_started_fetches(self):
+		started: List[ArtistID] = []
+
+		async def fetch(artist_id: ArtistID) -> List[ArtistID]:
+			started.append(artist_id)
+			await asyncio.sleep(0)
+			return [artist_id]
+
+		async def take(count: int):
+			abandoned: List[asyncio.Future] = []
+			results = search.expand_concurrently(['a{}'.format(i) for i in range(50)], fetch, 5, abandoned.extend)
+			taken = []
+			async for artist_id, related_ids in results:
+				taken.append(artist_id)
+				if len(taken) == count:
+					break
+			await results.aclose()
+			return taken, await asyncio.gather(*abandoned)
+
+		taken, left = run(take(3))
+		# no more than `limit` fetches were started beyond those taken, and every one of them finished
+		self.assertLessEqual(len(started), 3 + 5)
+		self.assertEqual(sorted(taken + [artist_id for artist_id, _ in left]), sorted(started))
+		self.assertEqual([related_ids for _, related_ids in left], [[artist_id] for artist_id, _ in left])
+
+
+class GraphSnapshotSearchTest(SearchTestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="six-degrees-test-")
+
+	def tearDown(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def test_matches_bfs(self):
+		for seed in SEEDS:
+			graph = random_graph(seed)
+			snapshot.write(self.path + "/graph", graph)
+			graph_snapshot = snapshot.load(self.path + "/graph")
+			for source, target in self.pairs(graph, seed):
+				self.check_result(graph, source, target, graph_snapshot.search(source, target))
+
+	# continue a snapshot search that stopped short over the whole graph, as the app does with Spotify/Redis
+	def finish(self, graph: Dict[ArtistID, List[ArtistID]], reached, budget: Optional[search.SearchBudget]=None) -> search.SearchResult:
+		if isinstance(reached, search.SearchResult):
+			return reached
+		return run(search.BidirectionalSearch(expand_from(graph), budget).resume(reached))
+
+	def test_partial_snapshot_is_continued(self):
+		for seed in SEEDS:
+			graph = random_graph(seed)
+			rnd = random.Random(seed)
+			known = {i: related for i, related in graph.items() if rnd.random() < 0.7}
+			snapshot.write(self.path + "/graph", known)
+			graph_snapshot = snapshot.load(self.path + "/graph")
+			stopped = 0
+			for source, target in self.pairs(graph, seed):
+				reached = graph_snapshot.search(source, target)
+				stopped += isinstance(reached, search.SearchState)
+				self.check_result(graph, source, target, self.finish(graph, reached))
+			self.assertGreater(stopped, 0)
+
+	def test_unknown_artists_are_left_to_the_fallback(self):
+		graph = random_graph(0)
+		unexpanded = next(i for i in sorted(graph) if graph[i])
+		known = {i: related for i, related in graph.items() if i != unexpanded}
+		snapshot.write(self.path + "/graph", known)
+		graph_snapshot = snapshot.load(self.path + "/graph")
+		graph['missing'] = []
+		reached = graph_snapshot.search(unexpanded, 'missing')
+		self.assertEqual(reached.expanded, 0)
+		self.check_result(graph, unexpanded, 'missing', self.finish(graph, reached))
+		# referenced by its related artists, but its own related artists aren't in the snapshot
+		neighbor = graph[unexpanded][0]
+		reached = graph_snapshot.search(unexpanded, neighbor)
+		self.assertIsInstance(reached, search.SearchState)
+		self.check_result(graph, unexpanded, neighbor, self.finish(graph, reached))
+
+	def test_budget(self):
+		graph = {i: [] for i in 'abcdefg'}
+		for a, b in zip('abcdef', 'bcdefg'):
+			graph[a].append(b)
+			graph[b].append(a)
+		snapshot.write(self.path + "/graph", graph)
+		graph_snapshot = snapshot.load(self.path + "/graph")
+		budget = search.SearchBudget(max_expanded=3)
+		reached = graph_snapshot.search('a', 'g', budget)
+		self.assertIsInstance(reached, search.SearchState)
+		self.assertLessEqual(reached.expanded, 3)
+		result = self.finish(graph, reached, budget)
+		self.assertEqual(result.status, search.BUDGET_EXHAUSTED)
+		self.assertEqual(result.expanded, 3)
+		self.check_result(graph, 'a', 'g', graph_snapshot.search('a', 'g', search.SearchBudget(max_expanded=6)))
+
+# an executor whose processes have died
+class BrokenExecutor(Executor):
+	def submit(self, fn, *args, **kwargs):
+		raise BrokenProcessPool("a search process died")
+
+
+class SearchPoolTest(SearchTestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp(prefix="six-degrees-test-")
+		self.graph = random_graph(0)
+		snapshot.write(self.path + "/graph", self.graph)
+		self.graph_snapshot = snapshot.load(self.path + "/graph")
+
+	def tearDown(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	# with a deadline, as the app's searches have
+	def check_searches(self, pool: snapshot.SearchPool):
+		for source, target in self.pairs(self.graph, 0)[:10]:
+			budget = search.SearchBudget(deadline=60)
+			budget.start()
+			self.check_result(self.graph, source, target, run(pool.search(source, target, budget)))
+
+	# searches that ran on the event loop's thread
+	def loop_searches(self) -> List[bool]:
+		on_loop: List[bool] = []
+		search = self.graph_snapshot.search
+
+		def recording_search(*args):
+			on_loop.append(threading.current_thread() is threading.main_thread())
+			return search(*args)
+		self.graph_snapshot.search = recording_search
+		return on_loop
+
+	def test_searches_in_processes(self):
+		pool = snapshot.SearchPool(self.graph_snapshot, 1)
+		run(pool.start())
+		try:
+			self.assertIsNotNone(pool.executor)
+			on_loop = self.loop_searches()
+			self.check_searches(pool)
+			# the budget crosses to the process too
+			self.assertIsInstance(run(pool.search('a0', 'a3', search.SearchBudget(max_expanded=1))), search.SearchState)
+			self.assertEqual(on_loop, [])
+		finally:
+			pool.stop()
+
+	def test_no_processes_searches_on_a_thread(self):
+		pool = snapshot.SearchPool(self.graph_snapshot, 0)
+		run(pool.start())
+		self.assertIsNone(pool.executor)
+		on_loop = self.loop_searches()
+		self.check_searches(pool)
+		self.assertEqual(on_loop, [False] * 10)
+
+	def test_daemonic_worker_searches_on_a_thread(self):
+		pool = snapshot.SearchPool(self.graph_snapshot, 2)
+		with mock.patch('src.snapshot.multiprocessing.current_process', return_value=mock.Mock(daemon=True)):
+			run(pool.start())
+		self.assertIsNone(pool.executor)
+		on_loop = self.loop_searches()
+		self.check_searches(pool)
+		self.assertEqual(on_loop, [False] * 10)
+
+	def test_broken_pool_falls_back_to_a_thread(self):
+		pool = snapshot.SearchPool(self.graph_snapshot, 1)
+		pool.executor = BrokenExecutor()
+		on_loop = self.loop_searches()
+		self.check_searches(pool)
+		self.assertIsNone(pool.executor)
+		self.assertEqual(on_loop, [False] * 10)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,148 @@
+import asyncio
+import unittest
+from typing import List
+
+from src.singleflight import SingleFlight
+
+"""
+Single-flight coalescing in src/singleflight.py: callers sharing a task, its cancellation once they have all gone
+away, and what it reports and raises reaching each of them.
+
+python -m unittest discover tests
+"""
+
+
+def run(coroutine):
+	return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class SingleFlightTest(unittest.TestCase):
+	def setUp(self):
+		self.flights = SingleFlight()
+		self.calls = 0
+		self.cancelled = 0
+		self.release = asyncio.Event()
+
+	# counts its calls and cancellations, and finishes once released
+	async def work(self, notify) -> int:
+		self.calls += 1
+		try:
+			await self.release.wait()
+		except asyncio.CancelledError:
+			self.cancelled += 1
+			raise
+		return self.calls
+
+	def test_callers_join_one_flight(self):
+		async def main():
+			callers = [asyncio.ensure_future(self.flights.do('key', self.work)) for _ in range(3)]
+			await asyncio.sleep(0)
+			self.assertEqual(len(self.flights), 1)
+			self.release.set()
+			return await asyncio.gather(*callers)
+
+		results = run(main())
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(results, [(1, False), (1, True), (1, True)])
+		# forgotten once done, so the next caller starts a new flight
+		self.assertEqual(len(self.flights), 0)
+		self.assertEqual(run(self.flights.do('key', self.work)), (2, False))
+
+	def test_different_keys_are_separate_flights(self):
+		async def main():
+			callers = [asyncio.ensure_future(self.flights.do(key, self.work)) for key in ('a', 'b')]
+			await asyncio.sleep(0)
+			self.release.set()
+			return await asyncio.gather(*callers)
+
+		self.assertEqual([joined for _, joined in run(main())], [False, False])
+		self.assertEqual(self.calls, 2)
+
+	def test_cancelled_only_after_last_caller_leaves(self):
+		async def main():
+			first = asyncio.ensure_future(self.flights.do('key', self.work))
+			second = asyncio.ensure_future(self.flights.do('key', self.work))
+			await asyncio.sleep(0)
+			first.cancel()
+			await asyncio.sleep(0)
+			# still running for the caller left
+			self.assertEqual(self.cancelled, 0)
+			self.assertEqual(len(self.flights), 1)
+			second.cancel()
+			await asyncio.sleep(0)
+			self.assertEqual(len(self.flights), 0)
+			await asyncio.sleep(0)
+			self.assertEqual(self.cancelled, 1)
+			for caller in (first, second):
+				with self.assertRaises(asyncio.CancelledError):
+					await caller
+
+		run(main())
+
+	def test_caller_after_cancellation_starts_a_new_flight(self):
+		async def main():
+			first = asyncio.ensure_future(self.flights.do('key', self.work))
+			await asyncio.sleep(0)
+			first.cancel()
+			# arrives while the cancelled task is still finishing
+			second = asyncio.ensure_future(self.flights.do('key', self.work))
+			await asyncio.sleep(0)
+			self.release.set()
+			return await second
+
+		self.assertEqual(run(main()), (2, False))
+		self.assertEqual(self.cancelled, 1)
+
+	def test_exception_reaches_every_caller(self):
+		async def fail(notify):
+			self.calls += 1
+			await self.release.wait()
+			raise ValueError("failed")
+
+		async def main():
+			callers = [asyncio.ensure_future(self.flights.do('key', fail)) for _ in range(3)]
+			await asyncio.sleep(0)
+			self.release.set()
+			return await asyncio.gather(*callers, return_exceptions=True)
+
+		results = run(main())
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(len(results), 3)
+		for res in results:
+			self.assertIsInstance(res, ValueError)
+		self.assertEqual(len(self.flights), 0)
+
+	def test_reports_reach_callers_waiting_at_the_time(self):
+		first: List[int] = []
+		second: List[int] = []
+		step = asyncio.Event()
+
+		async def report(notify) -> int:
+			notify(1)
+			await step.wait()
+			notify(2)
+			await self.release.wait()
+			notify(3)
+			return 0
+
+		async def main():
+			a = asyncio.ensure_future(self.flights.do('key', report, first.append))
+			await asyncio.sleep(0)
+			# joins after the first report, and one without a listener changes nothing
+			b = asyncio.ensure_future(self.flights.do('key', report, second.append))
+			c = asyncio.ensure_future(self.flights.do('key', report))
+			await asyncio.sleep(0)
+			step.set()
+			await asyncio.sleep(0)
+			b.cancel()
+			await asyncio.sleep(0)
+			self.release.set()
+			await asyncio.gather(a, c)
+
+		run(main())
+		self.assertEqual(first, [1, 2, 3])
+		self.assertEqual(second, [2])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,149 @@
+import asyncio
+import unittest
+from time import monotonic
+from typing import List
+
+import src.fake_spotify as fake_spotify
+import src.settings as settings
+import src.transport as transport
+from src.transport import BACKGROUND, INTERACTIVE, AdaptiveLimiter, SpotifyHTTPClient
+
+"""
+The Spotify transport in src/transport.py: the AIMD limiter on its own, and the client against the local fake
+Spotify in src/fake_spotify.py (429s with Retry-After, and 401s for revoked tokens).
+
+python -m unittest discover tests
+"""
+
+
+def run(coroutine):
+	return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+	def test_throttled_halves_the_limit(self):
+		limiter = AdaptiveLimiter(8, 1, 32, 1.0)
+		sent = monotonic()
+		limiter.throttled(sent)
+		self.assertEqual(limiter.limit, 4)
+		# sent under the old limit, so not cut again
+		limiter.throttled(sent)
+		self.assertEqual(limiter.limit, 4)
+		for _ in range(5):
+			limiter.throttled(monotonic())
+		self.assertEqual(limiter.limit, 1)
+
+	def test_additive_increase_after_fast_successes(self):
+		limiter = AdaptiveLimiter(4, 1, 6, 1.0)
+		# one more slot about every limit's worth of successes
+		for _ in range(4):
+			limiter.succeeded(monotonic(), 0.01)
+		self.assertEqual(int(limiter.limit), 4)
+		limiter.succeeded(monotonic(), 0.01)
+		self.assertEqual(int(limiter.limit), 5)
+		for _ in range(100):
+			limiter.succeeded(monotonic(), 0.01)
+		self.assertEqual(limiter.limit, 6)
+		# a slow response counts as congestion
+		limiter.succeeded(monotonic(), 2.0)
+		self.assertEqual(limiter.limit, 3)
+
+	def test_admission_by_priority(self):
+		limiter = AdaptiveLimiter(1, 1, 1, 1.0)
+		admitted: List[str] = []
+
+		async def request(name: str, level: int):
+			await limiter.acquire(level)
+			admitted.append(name)
+
+		async def main():
+			await limiter.acquire(INTERACTIVE)
+			waiting = [asyncio.ensure_future(request(name, level)) for name, level in [('b1', BACKGROUND), ('i1', INTERACTIVE), ('b2', BACKGROUND), ('i2', INTERACTIVE), ('i3', INTERACTIVE)]]
+			await asyncio.sleep(0)
+			self.assertEqual(admitted, [])
+			# a cancelled waiter doesn't take a slot
+			waiting[4].cancel()
+			for _ in range(4):
+				limiter.release()
+				await asyncio.sleep(0)
+			await asyncio.gather(*waiting[:4])
+			self.assertEqual(limiter.in_flight, 1)
+
+		run(main())
+		self.assertEqual(admitted, ['i1', 'i2', 'b1', 'b2'])
+
+
+# throttles the next `throttle_next` API requests, and notes when each arrives
+class ScriptedFakeSpotify(fake_spotify.FakeSpotify):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.throttle_next = 0
+		self.arrivals: List[float] = []
+		self.throttled_at: List[float] = []
+
+	async def respond(self, endpoint, body, status=200):
+		self.arrivals.append(monotonic())
+		self.throttle_rate = 1 if self.throttle_next > 0 else 0
+		if self.throttle_next > 0:
+			self.throttle_next -= 1
+			self.throttled_at.append(monotonic())
+		return await super().respond(endpoint, body, status)
+
+
+class SpotifyHTTPClientTest(unittest.TestCase):
+	def setUp(self):
+		transport.tokens.clear()
+		self.fake = ScriptedFakeSpotify({'artists': {'a': {'name': 'A'}}, 'related': {'a': []}}, retry_after=0.2)
+		self.runner = run(fake_spotify.start(self.fake, '127.0.0.1', 0))
+		port = self.runner.addresses[0][1]
+		self.client = SpotifyHTTPClient('id', 'secret', api_url='http://127.0.0.1:{}/v1'.format(port), token_url='http://127.0.0.1:{}/api/token'.format(port))
+
+	def tearDown(self):
+		run(self.client.close())
+		run(self.runner.cleanup())
+		transport.tokens.clear()
+
+	def test_429_halves_the_limit_and_is_retried(self):
+		self.fake.throttle_next = 1
+		data = run(self.client.artist('a'))
+		self.assertEqual(data['id'], 'a')
+		self.assertEqual(self.fake.requests['throttled'], 1)
+		self.assertEqual(self.fake.requests['artist'], 1)
+		# halved, then grown by the success
+		halved = settings.SPOTIFY_CONCURRENCY_INITIAL / 2
+		self.assertAlmostEqual(self.client.limiter.limit, halved + 1 / halved)
+
+	def test_retry_after_holds_every_request(self):
+		async def main():
+			self.fake.throttle_next = 1
+			first = asyncio.ensure_future(self.client.artist('a'))
+			while not self.fake.throttled_at:
+				await asyncio.sleep(0.01)
+			# sent after the 429, so they wait out its Retry-After too
+			others = [self.client.artist('a') for _ in range(3)]
+			await asyncio.gather(first, *others)
+
+		run(main())
+		throttled_at = self.fake.throttled_at[0]
+		later = [t for t in self.fake.arrivals if t > throttled_at]
+		self.assertEqual(len(later), 4)
+		self.assertGreaterEqual(min(later) - throttled_at, self.fake.retry_after - 0.01)
+		self.assertEqual(self.fake.requests['artist'], 4)
+
+	def test_one_token_refresh_after_401(self):
+		run(self.client.artist('a'))
+		self.assertEqual(self.fake.requests['token'], 1)
+		self.fake.revoked.add('fake-token-1')
+
+		async def main():
+			return await asyncio.gather(*[self.client.artist('a') for _ in range(5)])
+
+		self.assertEqual([d['id'] for d in run(main())], ['a'] * 5)
+		self.assertEqual(self.fake.requests['unauthorized'], 5)
+		# every rejected request waits for the one refresh
+		self.assertEqual(self.fake.requests['token'], 2)
+		self.assertEqual(transport.tokens[(self.client.token_url, 'id')][0], 'fake-token-2')
+
+
+if __name__ == '__main__':
+	unittest.main()